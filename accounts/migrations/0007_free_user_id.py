@@ -0,0 +1,49 @@
+# Generated by Django 5.2 on 2026-10-18 06:54
+
+from django.db import migrations, models
+
+
+def fill_free_ids(apps, schema_editor):
+    # Дыры, которые уже есть в id пользователей, сразу становятся свободными
+    User = apps.get_model('accounts', 'User')
+    FreeUserId = apps.get_model('accounts', 'FreeUserId')
+    connection = schema_editor.connection
+    user_table = User._meta.db_table
+
+    if connection.vendor != 'postgresql':
+        taken = set(User.objects.values_list('id', flat=True))
+        if taken:
+            FreeUserId.objects.bulk_create(
+                [FreeUserId(id=i) for i in range(1, max(taken)) if i not in taken], batch_size=1000,
+            )
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {FreeUserId._meta.db_table} (id) '
+            f'SELECT g FROM generate_series(1, (SELECT max(id) FROM {user_table})) g '
+            f'WHERE NOT EXISTS (SELECT 1 FROM {user_table} u WHERE u.id = g)'
+        )
+        # Раньше id всегда задавались руками, и последовательность таблицы стоит на месте - догоняем её
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE((SELECT max(id) FROM {user_table}), 1), "
+            f"(SELECT max(id) FROM {user_table}) IS NOT NULL)",
+            [user_table],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_user_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FreeUserId',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+            ],
+        ),
+        migrations.RunPython(fill_free_ids, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,7 @@
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from adminpanel.models import Group
 
 class CustomUserManager(BaseUserManager):
@@ -17,6 +19,16 @@ class CustomUserManager(BaseUserManager):
         extra_fields.setdefault('is_staff', True)
         return self.create_user(username, password, **extra_fields)
 
+class FreeUserId(models.Model):
+    """
+    id удалённых пользователей: новый пользователь занимает наименьший из них (см. User.get_next_available_id).
+    """
+    id = models.BigIntegerField(primary_key=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
 class User(AbstractBaseUser, PermissionsMixin):
     ROLES = [('студент', 'Student'), ('преподаватель', 'Teacher'), ('админ', 'Admin')]
     name = models.CharField(max_length=255, null=False, default="Ф.И.О.")
@@ -41,9 +53,37 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.username
 
     def save(self, *args, **kwargs):
-        if not self.id:
-            self.id = self.get_next_available_id()
-        super().save(*args, **kwargs)
+        if self.id:
+            if not self._state.adding:
+                return super().save(*args, **kwargs)
+            with transaction.atomic():
+                # id задали руками - из свободных его надо убрать, иначе его выдадут второй раз
+                FreeUserId.objects.filter(id=self.id).delete()
+                super().save(*args, **kwargs)
+                self._advance_id_sequence()
+            return
+        try:
+            with transaction.atomic():
+                self.id = self.get_next_available_id()
+                super().save(*args, **kwargs)
+        except Exception:
+            self.id = None
+            raise
+
+    def _advance_id_sequence(self):
+        """
+        id выше последовательности: догоняем её (как в миграции 0007), иначе nextval потом выдаст этот же id.
+        setval не откатывается с транзакцией и берёт greatest, так что назад последовательность не уходит.
+        """
+        connection = transaction.get_connection()
+        if connection.vendor != 'postgresql':
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT setval(seq, greatest(%s, pg_sequence_last_value(seq))) "
+                "FROM (SELECT pg_get_serial_sequence(%s, 'id')::regclass AS seq) s",
+                [self.id, self._meta.db_table],
+            )
 
     @staticmethod
     def get_next_available_id():
@@ -51,13 +91,18 @@ class User(AbstractBaseUser, PermissionsMixin):
         Это для того чтобы когда удаляются из базы пользователи id был не (max(id) + 1) а первый свободный
         было там 1000 idшников, а потом удалили 521, 33, и 128
         при добавлении нового пользователя будет не 1001 а 33
+
+        Свободные id лежат в FreeUserId (туда их кладёт удаление), так что это один запрос по первичному ключу,
+        а не чтение всех id. Строка блокируется до конца транзакции, параллельные save берут следующую.
+        None - дыр нет, id выдаст последовательность БД. Вызывать внутри transaction.atomic.
         '''
-        # Получаем список всех занятых ID
-        taken_ids = set(User.objects.values_list('id', flat=True))
-        # Генерируем все возможные ID от 1 до max текущего ID + 1
-        all_ids = set(range(1, max(taken_ids) + 2))
-        # Находим все свободные ID
-        free_ids = sorted(list(all_ids - taken_ids))
-        if free_ids:
-            return free_ids[0]  # Возвращаем первый свободный ID
-        return max(taken_ids) + 1  # Если нет свободных, возвращаем следующий номер
\ No newline at end of file
+        free_id = FreeUserId.objects.select_for_update(skip_locked=True).order_by('id').values_list('id', flat=True).first()
+        if free_id is None:
+            return None
+        FreeUserId.objects.filter(id=free_id).delete()
+        return free_id
+
+
+@receiver(post_delete, sender=User)
+def release_user_id(sender, instance, **kwargs):
+    FreeUserId.objects.bulk_create([FreeUserId(id=instance.id)], ignore_conflicts=True)
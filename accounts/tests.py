@@ -1,3 +1,48 @@
-from django.test import TestCase
+from concurrent.futures import ThreadPoolExecutor
 
-# Create your tests here.
+from django.db import connection
+from django.test import TransactionTestCase, skipUnlessDBFeature
+
+from .models import FreeUserId, User
+
+
+@skipUnlessDBFeature('has_select_for_update_skip_locked')
+class UserIdTests(TransactionTestCase):
+    """
+    Выдача id: сначала свободные после удаления, потом последовательность БД - без повторов при параллельных save.
+    """
+
+    def _create(self, i):
+        try:
+            return User.objects.create(username=f'user{i}', role='студент').id
+        finally:
+            # у каждого потока своё соединение
+            connection.close()
+
+    def _create_many(self, numbers):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            return list(pool.map(self._create, numbers))
+
+    def test_concurrent_create_gives_unique_ids(self):
+        ids = self._create_many(range(40))
+        self.assertEqual(len(set(ids)), 40)
+        self.assertEqual(User.objects.count(), 40)
+
+    def test_concurrent_create_reuses_each_free_id_once(self):
+        ids = self._create_many(range(30))
+        freed = sorted(ids)[5:15]
+        User.objects.filter(id__in=freed).delete()
+        self.assertEqual(FreeUserId.objects.count(), 10)
+
+        new_ids = self._create_many(range(100, 120))
+        self.assertEqual(len(set(new_ids)), 20)
+        self.assertTrue(set(freed) <= set(new_ids))
+        self.assertFalse(FreeUserId.objects.exists())
+        self.assertEqual(User.objects.count(), 40)
+
+    def test_explicit_id_above_sequence(self):
+        User.objects.create(username='first', role='студент')
+        explicit = User.objects.create(id=1000, username='explicit', role='студент')
+        # свободных нет - id выдаёт последовательность, и она уже за 1000
+        after = User.objects.create(username='after', role='студент')
+        self.assertGreater(after.id, explicit.id)
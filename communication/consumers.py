@@ -1,17 +1,46 @@
+import asyncio
 import json
+import time
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from .models import Channel, Message, UploadedFile, Stream
-from .serializers import MessageSerializer, StreamSerializer
+from .serializers import MessageSerializer, NotificationSerializer, StreamSerializer
 from django.contrib.auth import get_user_model
-from .utils.minio_client import save_file_to_minio
+from django.conf import settings
+from .utils import channel_events, chat_buffer, metrics, presence, speaking
+from .utils.minio_client import aget_presigned_url
+from .utils.notification_inbox import get_cursor, mark_delivered, newer_than, unread_count, visible_notifications
+from .utils.notification_sender import notification_group_names
+from .utils.sequence import aensure_seq, aget_seq, anext_channel_seq, channel_seq_key
 
 User = get_user_model()
 
+# Существующий канал не проверяется в БД на каждом подключении (шторм переподключений):
+# удалённый канал перестаёт пускать не позже чем через CHANNEL_CACHE_TTL секунд
+CHANNEL_CACHE_TTL = 60
+_known_channels = {}
+
+# Поля update_stream, которые хранятся в БД (is_speaking туда не пишется)
+STREAM_FIELDS = ('has_audio', 'has_video', 'has_webcam', 'is_audio_enabled', 'is_video_enabled')
+
 class ChannelConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.channel_id = self.scope['url_route']['kwargs']['channel_id']
         self.group_name = f"channel_{self.channel_id}"
+        self.heartbeat_task = None
+        self.speaking = None
+
+        # Сообщения попадают в БД с задержкой (utils/chat_buffer.py), поэтому несуществующий канал отсекаем здесь
+        if not await self._channel_exists():
+            await self.close(code=4404)
+            return
+        await aensure_seq(channel_seq_key(self.channel_id), lambda: chat_buffer.alast_seq(self.channel_id))
+
+        self.speaking = speaking.attach(self.channel_id, self.group_name, self.channel_layer)
+        metrics.start_flusher()
+        chat_buffer.start_flusher()
         
 
         # Добавляем этот сокет в группу канала
@@ -21,22 +50,37 @@ class ChannelConsumer(AsyncWebsocketConsumer):
 
         user = self.scope.get('user')
         if user and user.is_authenticated:
-            await self._db_add_participant(user)
-            await self._broadcast_participants()
+            # Онлайн-состав живёт в реестре присутствия (Redis), а не в M2M participants
+            if await presence.join(self.channel_id, user, self.channel_name):
+                await self._broadcast_presence('participant_joined', [user.name])
+            await self._broadcast_presence('participant_left', await presence.heartbeat(self.channel_id, user, self.channel_name))
+            # Полный список - только новому участнику, остальным хватит дельты
+            await self.send(text_data=json.dumps({
+                "type": "participants_update",
+                "participants": list((await presence.members(self.channel_id)).values()),
+            }))
+            self.heartbeat_task = asyncio.create_task(self._heartbeat(user))
+
+        # Снимок потоков с номером версии; дальше клиент получает только stream_delta
+        snapshot = await self._get_stream_snapshot()
+        self.own_stream = None
+        if user and user.is_authenticated:
+            self.own_stream = next((s for s in snapshot["streams"] if s["user"]["id"] == user.id), None)
+        await self.send(text_data=json.dumps({"type": "streams_update", **snapshot}))
 
-        streams = await self._get_all_streams()
-        await self.send(text_data=json.dumps({
-            "type": "streams_update",
-            "streams": streams
-        }))
+        # Переподключение с ?since=<seq>: досылаем только пропущенное (в группе уже состоим, так что ничего не потеряется)
+        since = self._since()
+        if since is not None:
+            await self._replay(since)
 
-        await self.channel_layer.group_send(
-        self.group_name,
-        {
-            "type": "new_participant",
-            "new_user": user.name,
-        }
-        )
+        if user and user.is_authenticated:
+            await self.channel_layer.group_send(
+            self.group_name,
+            {
+                "type": "new_participant",
+                "new_user": user.name,
+            }
+            )
 
 
 
@@ -44,10 +88,28 @@ class ChannelConsumer(AsyncWebsocketConsumer):
         
 
     async def disconnect(self, close_code):
+        if self.speaking is None:
+            return  # канал не найден, connect ничего не открывал
         user = self.scope.get('user')
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+        if user and user.is_authenticated and self.speaking.is_speaking(user.id):
+            self.speaking.report(user.id, False)
+        speaking.detach(self.speaking)
+        if user and user.is_authenticated and settings.SFU['ENABLED']:
+            from .utils import recorder, sfu
+            active = recorder.get_recorder(self.channel_id)
+            if active is not None and active.owner_id == user.id:
+                # Кто запускал запись, тот её и завершает - в том числе уходя
+                try:
+                    await self._stop_recording(user, reply=False)
+                except Exception as e:
+                    print(f"[recorder] Не удалось сохранить запись канала {self.channel_id}: {e}")
+            if await sfu.leave(self.channel_id, user.id):
+                await self._broadcast_sfu('sfu_unpublished', user)
         if user and user.is_authenticated:
-            await self._db_remove_participant(user)
-            await self._broadcast_participants()
+            if await presence.leave(self.channel_id, user, self.channel_name):
+                await self._broadcast_presence('participant_left', [user.name])
 
         await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
@@ -61,65 +123,75 @@ class ChannelConsumer(AsyncWebsocketConsumer):
 
         # WebRTC
         if 'signal_type' in data:
-            await self.channel_layer.group_send(
-                self.group_name,
-                {
-                    'type': 'webrtc.signal',
-                    'signal_type': data['signal_type'],
-                    'signal_data': data['signal_data'],
-                    'from': user.name,
-                    'to': data.get('to'),
-                    'stream_type': data.get('stream_type', 'webcam'),
-                }
-            )
+            event = {
+                'type': 'webrtc.signal',
+                'signal_type': data['signal_type'],
+                'signal_data': data['signal_data'],
+                'from': user.name,
+                'to': data.get('to'),
+                'stream_type': data.get('stream_type', 'webcam'),
+            }
+            if data.get('to'):
+                # Адресный сигнал (offer/answer/ICE) - прямо в сокеты получателя, остальным он не нужен
+                targets = await presence.routes(self.channel_id, data['to'])
+                if targets:
+                    for target in targets:
+                        await self.channel_layer.send(target, event)
+                    metrics.incr('signal_direct')
+                    metrics.incr('signal_direct_deliveries', len(targets))
+                    return
+                # Получателя нет в реестре (другой процесс без Redis) - по-старому через группу
+                metrics.incr('signal_fallback')
+            metrics.incr('signal_group')
+            await self.channel_layer.group_send(self.group_name, event)
             return
 
         # Chat message
         if data.get('message'):
-            if data.get('file_path') and data.get('file_name'):
+            if data.get('file_id'):
+                # Обычный путь: файл уже загружен в MinIO и подтверждён через /upload/confirm/ или /upload/
+                uploaded_file = await self._get_file(data['file_id'], user)
+            elif data.get('file_path') and data.get('file_name'):
                 file_path = data['file_path']
                 file_name = data['file_name']
                 uploaded_file = await self._save_file(file_path, file_name, user)
             else:
                 uploaded_file = None
 
-            msg_obj = await self._db_save_message(user, data['message'], uploaded_file)
-            serializer = MessageSerializer(msg_obj)
+            message_data = await self._buffer_message(user, data['message'], uploaded_file)
+            await channel_events.aremember(
+                self.channel_id, message_data['seq'], {"type": "chat_message", "message": message_data},
+            )
             await self.channel_layer.group_send(
                 self.group_name,
                 {
                     'type': 'chat.message',
-                    'message': serializer.data
+                    'message': message_data
                 }
             )
         elif data.get('action') == 'update_stream':
-            # Обновление состояния потока (например, включил микрофон)
-            await self._update_stream_state(self.scope['user'], data)
-
-            # Рассылаем обновление состояния пользователя
-            await self.channel_layer.group_send(
-                self.group_name,
-                {
-                    'type': 'stream_update',
-                    'user': self.scope['user'].name,
-                    'stream_state': data
-                }
-            )
-
-            # Также рассылаем полный список актуальных потоков
-            streams = await self._get_all_streams()
-            await self.channel_layer.group_send(
-                self.group_name,
-                {
-                    "type": "streams_update",
-                    "streams": streams,
-                }
-            )
+            if 'is_speaking' in data and not self._measured_on_server(user):
+                # Голосовая активность приходит много раз в секунду: мимо БД, через коалесер с тиком
+                self.speaking.report(user.id, data['is_speaking'])
+            if any(field in data for field in STREAM_FIELDS):
+                # Обновление состояния потока (например, включил микрофон): всем уходит только этот поток
+                stream = await self._update_stream_state(self.scope['user'], data, await speaking.aget_speaking(self.channel_id))
+                await self._broadcast_stream(stream)
 
         elif data.get('action') == 'admin_mute':
             # Только для преподавателей и админа
             if self.scope['user'].role == 'преподаватель' or self.scope['user'].role == 'админ':
-                await self._mute_user(data['target_user'], mute=True)
+                stream = await self._mute_user(data['target_user'], await speaking.aget_speaking(self.channel_id), mute=True)
+                if stream is not None:
+                    await self._broadcast_stream(stream)
+
+        elif data.get('action') == 'get_streams':
+            # Клиент заметил пропуск в seq - отдаём свежий снимок
+            snapshot = await self._get_stream_snapshot()
+            await self.send(text_data=json.dumps({"type": "streams_update", **snapshot}))
+
+        elif str(data.get('action', '')).startswith('sfu_') and settings.SFU['ENABLED']:
+            await self._handle_sfu(user, data)
 
 
     async def new_participant(self, event):
@@ -127,14 +199,12 @@ class ChannelConsumer(AsyncWebsocketConsumer):
         if self.scope["user"].name == event["new_user"]:
             return  # не слать самому себе
 
-        streams = await self._get_all_streams()
-        for stream in streams:
-            if stream["user"] == self.scope["user"].name:
-                await self.send(text_data=json.dumps({
-                    "type": "new_participant",
-                    "username": event["new_user"]
-                }))
-                break
+        # Своё состояние consumer знает сам (снимок при подключении + stream_delta), без запроса в БД
+        if self.own_stream is not None:
+            await self.send(text_data=json.dumps({
+                "type": "new_participant",
+                "username": event["new_user"]
+            }))
 
     
     async def chat_message(self, event):
@@ -148,6 +218,11 @@ class ChannelConsumer(AsyncWebsocketConsumer):
             "message": message_serialized
         }))
 
+    @database_sync_to_async
+    def _get_file(self, file_id, user):
+        # Прикрепить можно только свой файл
+        return UploadedFile.objects.filter(id=file_id, user=user).first()
+
     # Метод для сохранения файла в MinIO
     async def _save_file(self, file_path, file_name, user):
         """
@@ -164,6 +239,8 @@ class ChannelConsumer(AsyncWebsocketConsumer):
 
     async def webrtc_signal(self, event):
         if event.get('to') and event['to'] != self.scope['user'].name:
+            # Доставка впустую: должна быть только у сигналов, ушедших через группу
+            metrics.incr('signal_wasted_deliveries')
             return
 
         await self.send(text_data=json.dumps({
@@ -174,120 +251,383 @@ class ChannelConsumer(AsyncWebsocketConsumer):
             "stream_type": event.get("stream_type", "webcam"),
         }))
 
-    async def broadcast_participants(self, event):
+    async def presence_delta(self, event):
         await self.send(text_data=json.dumps({
-            "type": "participants_update",
-            "participants": event["participants"],
+            "type": event["event"],
+            "participant": event["participant"],
         }))
 
+    # = Присутствие
+
+    async def _broadcast_presence(self, event, names):
+        for name in names:
+            await self.channel_layer.group_send(
+                self.group_name,
+                {
+                    'type': 'presence_delta',
+                    'event': event,
+                    'participant': name,
+                }
+            )
+
+    async def _heartbeat(self, user):
+        # Продлеваем своё соединение, пока сокет жив; заодно вычищаем соединения упавших процессов
+        while True:
+            await asyncio.sleep(settings.PRESENCE['HEARTBEAT'])
+            try:
+                gone = await presence.heartbeat(self.channel_id, user, self.channel_name)
+                await self._broadcast_presence('participant_left', gone)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[presence] Heartbeat канала {self.channel_id} не прошёл: {e}")
+
     # = Вспомогательные методы для БД 
 
-    async def _broadcast_participants(self):
-        participants = await self._db_get_participants()
+    async def stream_delta(self, event):
+        # Просто пересылаем: состояние уже сериализовано отправителем, перезапрашивать нечего
+        if event["stream"]["user"]["id"] == self.scope["user"].id:
+            self.own_stream = event["stream"]
+            if settings.SFU['ENABLED']:
+                # Публикация живёт в процессе публикующего: глушим/включаем дорожки здесь, в том числе по admin_mute
+                from .utils import sfu
+                room = sfu.find_room(self.channel_id)
+                if room is not None:
+                    room.apply_state(self.scope["user"].id, event["stream"])
+        await self.send(text_data=json.dumps({
+            "type": "stream_delta",
+            "seq": event["seq"],
+            "stream": event["stream"],
+        }))
+
+    async def speaking_update(self, event):
+        await self.send(text_data=json.dumps({
+            "type": "speaking_update",
+            "seq": event["seq"],
+            "speaking": event["speaking"],
+        }))
+
+    async def active_speakers(self, event):
+        await self.send(text_data=json.dumps({
+            "type": "active_speakers",
+            "speakers": event["speakers"],
+        }))
+
+    async def sfu_event(self, event):
+        await self.send(text_data=json.dumps({
+            "type": event["event"],
+            "user": event["user"],
+        }))
+
+    # = SFU
+
+    async def _broadcast_sfu(self, event, user):
         await self.channel_layer.group_send(
             self.group_name,
             {
-                'type': 'broadcast_participants',
-                'participants': participants,
+                "type": "sfu_event",
+                "event": event,
+                "user": {"id": user.id, "name": user.name},
             }
         )
-    async def stream_update(self, event):
-        streams = await self._get_all_streams()
+
+    def _measured_on_server(self, user):
+        # Звук публикуется через SFU - говорит ли пользователь, сервер слышит сам (utils/audio_levels.py)
+        if not settings.SFU['ENABLED'] or not settings.AUDIO_LEVELS['ENABLED']:
+            return False
+        from .utils import sfu
+        room = sfu.find_room(self.channel_id)
+        return room is not None and room.speakers is not None and user.id in room.speakers.meters
+
+    async def _handle_sfu(self, user, data):
+        # aiortc импортируется, только если SFU включён
+        from .utils import audio_levels, sfu
+
+        action = data['action']
+        room = sfu.get_room(self.channel_id)
+        publisher_id = data.get('publisher')
+        try:
+            if action == 'sfu_publish':
+                if settings.AUDIO_LEVELS['ENABLED']:
+                    audio_levels.attach(room, self.group_name, self.channel_layer)
+                answer = await room.publish(user.id, data['sdp'], data.get('sdp_type', 'offer'))
+                # Публикация = включённые дорожки: отмечаем это в Stream, как update_stream
+                tracks = sfu.tracks_in_offer(data['sdp'])
+                stream = await self._update_stream_state(
+                    user, {'has_audio': tracks['audio'], 'has_video': tracks['video']},
+                    await speaking.aget_speaking(self.channel_id),
+                )
+                room.apply_state(user.id, stream)
+                await self.send(text_data=json.dumps({"type": "sfu_answer", **answer}))
+                await self._broadcast_stream(stream)
+                await self._broadcast_sfu('sfu_published', user)
+            elif action == 'sfu_subscribe':
+                offer = await room.subscribe(user.id, publisher_id, data.get('layer', 'high'))
+                await self.send(text_data=json.dumps({"type": "sfu_offer", "publisher": publisher_id, **offer}))
+            elif action == 'sfu_answer':
+                await room.answer(user.id, publisher_id, data['sdp'], data.get('sdp_type', 'answer'))
+            elif action == 'sfu_layer':
+                await room.set_layer(user.id, publisher_id, data.get('layer', 'high'))
+            elif action == 'sfu_candidate':
+                await room.add_candidate(user.id, publisher_id, data)
+            elif action == 'sfu_unsubscribe':
+                await room.unsubscribe(user.id, publisher_id)
+            elif action == 'sfu_unpublish':
+                if await room.unpublish(user.id):
+                    await self._broadcast_sfu('sfu_unpublished', user)
+            elif action in ('sfu_start_recording', 'sfu_stop_recording'):
+                await self._handle_recording(user, room, data)
+        except sfu.ERRORS as e:
+            await self.send(text_data=json.dumps({"type": "sfu_error", "action": action, "error": str(e) or type(e).__name__}))
+
+    # = Запись лекции
+
+    async def _handle_recording(self, user, room, data):
+        from .utils import recorder
+
+        if user.role not in ('преподаватель', 'админ'):
+            await self.send(text_data=json.dumps({"type": "sfu_error", "action": data['action'], "error": "Forbidden"}))
+            return
+        if data['action'] == 'sfu_start_recording':
+            # По умолчанию пишем собственную публикацию преподавателя
+            await recorder.start_recording(
+                room, data.get('publisher') or user.id, user.id,
+                data.get('file_name') or 'lecture.mp4', data.get('subject'),
+            )
+            await self._broadcast_sfu('recording_started', user)
+        else:
+            await self._stop_recording(user)
+
+    async def _stop_recording(self, user, reply=True):
+        from .utils import recorder
+
+        active, (path, file_name, size) = await recorder.stop_recording(self.channel_id)
+        uploaded = await database_sync_to_async(UploadedFile.objects.create)(
+            user_id=active.owner_id,
+            file_name=file_name,
+            file_type='lecture',
+            path=path,
+        )
+        print(f"[recorder] Лекция канала {self.channel_id} сохранена: {path} ({size} байт)")
+        await self._broadcast_sfu('recording_stopped', user)
+        if not reply:
+            return
+        await self.send(text_data=json.dumps({
+            "type": "recording_saved",
+            "file_id": uploaded.id,
+            "file_name": file_name,
+            "size": size,
+        }))
+
+    async def _broadcast_stream(self, stream):
+        seq = await anext_channel_seq(self.channel_id)
+        await channel_events.aremember(self.channel_id, seq, {"type": "stream_delta", "seq": seq, "stream": stream})
         await self.channel_layer.group_send(
             self.group_name,
             {
-                "type": "streams_update",
-                "streams": streams,
+                "type": "stream_delta",
+                "seq": seq,
+                "stream": stream,
             }
         )
 
-
-    
-
     @database_sync_to_async
-    def _update_stream_state(self, user, state_data):
+    def _update_stream_state(self, user, state_data, speaking_ids):
         stream, _ = Stream.objects.get_or_create(user=user, channel_id=self.channel_id)
-        stream.is_audio_enabled = state_data.get('is_audio_enabled', stream.is_audio_enabled)
-        stream.is_video_enabled = state_data.get('is_video_enabled', stream.is_video_enabled)
-        stream.is_speaking = state_data.get('is_speaking', stream.is_speaking)
+        stream.user = user
+        # Фронт шлёт is_audio_enabled/is_video_enabled, в модели это has_audio/has_video
+        stream.has_audio = state_data.get('has_audio', state_data.get('is_audio_enabled', stream.has_audio))
+        stream.has_video = state_data.get('has_video', state_data.get('is_video_enabled', stream.has_video))
+        stream.has_webcam = state_data.get('has_webcam', stream.has_webcam)
         stream.save()
-    
-    async def streams_update(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "streams_update",
-            "streams": event["streams"]
-        }))
-    
+        return StreamSerializer(stream, context={'speaking': speaking_ids}).data
     
     @database_sync_to_async
-    def _mute_user(self, username, mute=True):
+    def _mute_user(self, username, speaking_ids, mute=True):
         try:
             target = User.objects.get(username=username)
             stream, _ = Stream.objects.get_or_create(user=target, channel_id=self.channel_id)
+            stream.user = target
             stream.is_muted_by_admin = mute
             stream.save()
+            return StreamSerializer(stream, context={'speaking': speaking_ids}).data
         except User.DoesNotExist:
-            pass
+            return None
     
+    async def _get_stream_snapshot(self):
+        # Сначала номер, потом состояние: дельты после этого номера могут повториться в снимке, но не потеряться
+        seq = await aget_seq(channel_seq_key(self.channel_id))
+        return {"seq": seq, "streams": await self._get_all_streams(await speaking.aget_speaking(self.channel_id))}
+
     @database_sync_to_async
-    def _get_all_streams(self):
+    def _get_all_streams(self, speaking_ids):
         streams = Stream.objects.filter(channel_id=self.channel_id).select_related('user')
-        return StreamSerializer(streams, many=True).data
+        return StreamSerializer(streams, many=True, context={'speaking': speaking_ids}).data
 
 
-    @database_sync_to_async
-    def _db_get_participants(self):
-        try:
-            ch = Channel.objects.get(id=self.channel_id)
-            return [u.name for u in ch.participants.all()]
-        except Channel.DoesNotExist:
-            return []
+    # = Повтор пропущенного
 
-    @database_sync_to_async
-    def _db_add_participant(self, user):
+    def _since(self):
+        query = parse_qs(self.scope.get("query_string", b"").decode())
         try:
-            Channel.objects.get(id=self.channel_id).participants.add(user)
-        except Channel.DoesNotExist:
-            pass
+            return int(query["since"][0])
+        except (KeyError, ValueError):
+            return None
 
-    @database_sync_to_async
-    def _db_remove_participant(self, user):
-        try:
-            Channel.objects.get(id=self.channel_id).participants.remove(user)
-        except Channel.DoesNotExist:
-            pass
+    async def _replay(self, since):
+        """
+        Досылает события с seq > since и в конце replay_done с текущим номером.
+
+        Номера общие для сообщений чата, stream_delta и speaking_update. Кольцо повторяет все события,
+        а до его начала досылаются только сообщения (из БД и ещё не записанные): дельты потоков и говорящих
+        не хранятся, их состояние клиент уже получил снимком streams_update. Поэтому после replay_done
+        номера до seq, которых клиент так и не увидел, ждать не надо - это такие события, а не потерянные
+        сообщения. resync_required - повторить нельзя, клиент перечитывает историю и берёт его seq.
+        """
+        current = await aget_seq(channel_seq_key(self.channel_id))
+        if since > current:
+            # Счётчик откатился (Redis потерял ключ и засеян из БД) - номера клиента больше не сопоставимы
+            await self.send(text_data=json.dumps({"type": "resync_required", "seq": current}))
+            return
+        events = []
+        if since < current:
+            events, oldest = await channel_events.areplay(self.channel_id, since)
+            if oldest is None or oldest > since + 1:
+                # Кольцо не покрывает пропуск: сообщения до его начала берём из БД и журнала записи
+                before = oldest if oldest is not None else current + 1
+                missed = await self._get_missed_messages(
+                    since, before, await chat_buffer.aunflushed(self.channel_id, since, before),
+                )
+                if missed is None:
+                    await self.send(text_data=json.dumps({"type": "resync_required", "seq": current}))
+                    return
+                events = missed + events
+        for event in events:
+            await self.send(text_data=json.dumps(event))
+        await self.send(text_data=json.dumps({"type": "replay_done", "seq": current}))
 
     @database_sync_to_async
-    def _db_save_message(self, user, content, uploaded_file=None):
-        ch = Channel.objects.get(id=self.channel_id)
-        return Message.objects.create(
+    def _get_missed_messages(self, since, before, unflushed):
+        # None - пропущено больше REPLAY_LIMIT, клиенту проще перечитать историю через channel_messages
+        limit = settings.CHANNEL_EVENTS['REPLAY_LIMIT']
+        messages = list(
+            Message.objects.filter(channel_id=self.channel_id, seq__gt=since, seq__lt=before)
+            .select_related('sender', 'uploaded_file').order_by('seq')[:limit + 1]
+        )
+        written = {message.id for message in messages}
+        pending = [message for message in unflushed if message.id not in written]
+        if pending:
+            senders = User.objects.in_bulk({message.sender_id for message in pending})
+            files = UploadedFile.objects.in_bulk({m.uploaded_file_id for m in pending if m.uploaded_file_id})
+            pending = [message for message in pending if message.sender_id in senders]
+            for message in pending:
+                message.sender = senders[message.sender_id]
+                message.uploaded_file = files.get(message.uploaded_file_id)
+            messages = sorted(messages + pending, key=lambda message: message.seq)
+        if len(messages) > limit:
+            return None
+        return [{"type": "chat_message", "message": data} for data in MessageSerializer(messages, many=True).data]
+
+    async def _channel_exists(self):
+        expires = _known_channels.get(self.channel_id)
+        if expires is not None and expires > time.monotonic():
+            return True
+        if not await database_sync_to_async(Channel.objects.filter(pk=self.channel_id).exists)():
+            return False
+        _known_channels[self.channel_id] = time.monotonic() + CHANNEL_CACHE_TTL
+        return True
+
+    async def _buffer_message(self, user, content, uploaded_file=None):
+        # id и seq выдаются сразу и сразу рассылаются, сама запись в БД - пачкой позже
+        message = Message(
+            id=await chat_buffer.next_message_id(),
+            seq=await anext_channel_seq(self.channel_id),
+            channel_id=self.channel_id,
             sender=user,
             content=content,
-            channel=ch,
-            uploaded_file=uploaded_file
+            uploaded_file=uploaded_file,
         )
+        await chat_buffer.submit(message)
+        return await self._serialize_message(message)
+
+    async def _serialize_message(self, message):
+        # sender и uploaded_file уже в памяти, запросов нет; ссылку на файл подписывает пул MinIO
+        urls = {}
+        if message.uploaded_file is not None:
+            try:
+                urls[message.uploaded_file.path] = await aget_presigned_url(
+                    message.uploaded_file.path, expires=timedelta(days=7),
+                )
+            except Exception as e:
+                print(f"[minio] Не удалось подписать ссылку на {message.uploaded_file.path}: {e}")
+        return MessageSerializer(message, context={'presigned_urls': urls}).data
 
 
 class NotificationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.group_name = None  # ← добавлено, чтобы избежать ошибки в disconnect
+        self.group_names = []  # ← пустой список, чтобы не упасть в disconnect
 
         self.user = self.scope['user']
         if not self.user.is_authenticated:
             await self.close()
             return
 
-        self.group_name = f"user_notifications_{self.user.id}"
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        # Личная группа + группы рассылки (своя учебная группа и все студенты), см. utils/notification_sender.py
+        self.group_names = notification_group_names(self.user)
+        for group_name in self.group_names:
+            await self.channel_layer.group_add(group_name, self.channel_name)
         await self.accept()
 
+        # Пропущенное, пока сокета не было. В группы уже вошли, так что новое может прийти дважды - клиент сверяет по id
+        self.delivered = None
+        items, has_more, unread = await self._pending_notifications()
+        await self.send(text_data=json.dumps({
+            'type': 'notifications_replay',
+            'items': items,
+            'has_more': has_more,
+            'unread': unread,
+        }))
+
     async def disconnect(self, close_code):
-        if self.group_name:  # ← защита от ошибки
-            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        for group_name in self.group_names:
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+        if self.group_names and self.delivered is not None:
+            await database_sync_to_async(mark_delivered)(self.user, *self.delivered)
+
+    @database_sync_to_async
+    def _pending_notifications(self):
+        """
+        Последние REPLAY_LIMIT уведомлений после курсора доставки; курсор сразу сдвигается на них.
+        """
+        cursor = get_cursor(self.user)
+        limit = settings.NOTIFICATIONS['REPLAY_LIMIT']
+        pending = newer_than(visible_notifications(self.user), cursor.delivered_at, cursor.delivered_id)
+        items = list(pending.order_by('-created_at', '-id')[:limit + 1])
+        has_more = len(items) > limit
+        items = items[:limit][::-1]
+        if items:
+            mark_delivered(self.user, items[-1].created_at, items[-1].id)
+        data = NotificationSerializer(items, many=True, context={'read_cursor': cursor}).data
+        return data, has_more, unread_count(self.user, cursor)
+
+    async def transcription_result(self, event):
+        # Результат распознавания куска от воркера (см. utils/transcription_queue.py)
+        await self.send(text_data=json.dumps({
+            'type': 'transcription_result',
+            'job_id': event['job_id'],
+            'session_id': event['session_id'],
+            'status': event['status'],
+            'text': event['text'],
+            'error': event['error'],
+        }))
 
     async def send_notification(self, event):
+        # Курсор доставки пишется в БД один раз, при отключении
+        self.delivered = (datetime.fromisoformat(event['created_at']), event['id'])
         await self.send(text_data=json.dumps({
             'type': 'notification',
+            'id': event['id'],
+            'created_at': event['created_at'],
             'title': event['title'],
             'message': event['message'],
             'image': event['image'],
@@ -0,0 +1,44 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from communication.utils.audio import SAMPLE_RATE, decode_audio, decode_audio_ffmpeg
+
+
+class Command(BaseCommand):
+    help = "Сравнивает задержку декодирования куска записи: PyAV в памяти против ffmpeg-процесса с временными файлами"
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help='Куски записи (webm/opus, как их шлёт фронт)')
+        parser.add_argument('--repeat', type=int, default=20, help='Сколько раз декодировать каждый кусок')
+
+    def _measure(self, decode, data, repeat):
+        decode(data)  # прогрев: импорт кодеков, кэш файловой системы
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            pcm = decode(data)
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings, len(pcm)
+
+    def handle(self, *args, **options):
+        for path in options['files']:
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.stdout.write(f"{path}: {len(data)} байт")
+
+            for name, decode in (('pyav', decode_audio), ('ffmpeg', decode_audio_ffmpeg)):
+                try:
+                    timings, samples = self._measure(decode, data, options['repeat'])
+                except Exception as e:
+                    self.stdout.write(f"  {name:<7} пропущен: {e}")
+                    continue
+                timings.sort()
+                p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+                self.stdout.write(
+                    f"  {name:<7} {samples / SAMPLE_RATE:6.2f} c звука  "
+                    f"mean {statistics.mean(timings):7.2f} мс  "
+                    f"p50 {statistics.median(timings):7.2f} мс  "
+                    f"p95 {p95:7.2f} мс"
+                )
@@ -0,0 +1,56 @@
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+# Группы с префиксом bench_: настоящим пользователям ничего не уходит
+
+
+class Command(BaseCommand):
+    help = "Сравнивает время рассылки уведомления: group_send на каждого студента против одного group_send на группу"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, nargs='+', default=[100, 1000, 10000], help='Сколько получателей')
+        parser.add_argument('--repeat', type=int, default=3, help='Сколько раз мерить каждый вариант')
+
+    def _message(self):
+        return {"type": "send_notification", "title": "bench", "message": "bench", "image": ""}
+
+    async def _subscribe(self, layer, count):
+        channels = []
+        for i in range(count):
+            channel = await layer.new_channel()
+            await layer.group_add(f"bench_user_notifications_{i}", channel)
+            await layer.group_add("bench_notifications_all", channel)
+            channels.append(channel)
+        return channels
+
+    async def _unsubscribe(self, layer, channels):
+        for i, channel in enumerate(channels):
+            await layer.group_discard(f"bench_user_notifications_{i}", channel)
+            await layer.group_discard("bench_notifications_all", channel)
+
+    def _per_user(self, layer, count):
+        # Как было: отдельный group_send (и отдельный async_to_sync) на каждого
+        for i in range(count):
+            async_to_sync(layer.group_send)(f"bench_user_notifications_{i}", self._message())
+
+    def _group(self, layer, count):
+        async_to_sync(layer.group_send)("bench_notifications_all", self._message())
+
+    def handle(self, *args, **options):
+        layer = get_channel_layer()
+        self.stdout.write(f"Слой: {type(layer).__name__}")
+        for count in options['users']:
+            channels = async_to_sync(self._subscribe)(layer, count)
+            try:
+                for name, send in (('per-user', self._per_user), ('group', self._group)):
+                    timings = []
+                    for _ in range(options['repeat']):
+                        started = time.perf_counter()
+                        send(layer, count)
+                        timings.append((time.perf_counter() - started) * 1000)
+                    self.stdout.write(f"  {count:>6} польз.  {name:<9} min {min(timings):10.2f} мс  max {max(timings):10.2f} мс")
+            finally:
+                async_to_sync(self._unsubscribe)(layer, channels)
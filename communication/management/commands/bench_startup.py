@@ -0,0 +1,64 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+# Выполняется в чистом интерпретаторе, чтобы ничего не было импортировано заранее
+PROBE = """
+import json, os, resource, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+from django.urls import resolve
+for path in sys.argv[1:]:
+    resolve(path)
+urls = time.perf_counter()
+from online_school.asgi import application
+asgi = time.perf_counter()
+print(json.dumps({
+    "setup": setup - started,
+    "urls": urls - setup,
+    "asgi": asgi - urls,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy": [m for m in ("torch", "whisper", "av", "numpy") if m in sys.modules],
+}))
+"""
+
+
+class Command(BaseCommand):
+    help = "Меряет холодный старт: django.setup(), разбор URL и импорт ASGI-приложения в отдельном процессе"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='Сколько раз запускать процесс')
+        parser.add_argument(
+            '--paths', nargs='+', default=['/communication/channels/', '/communication/list/', '/swagger/'],
+            help='Какие пути резолвить после setup()',
+        )
+
+    def handle(self, *args, **options):
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'online_school.settings')
+        runs = []
+        for _ in range(max(1, options['repeat'])):
+            proc = subprocess.run(
+                [sys.executable, '-c', PROBE, *options['paths']],
+                capture_output=True, text=True, env=env,
+            )
+            if proc.returncode != 0:
+                self.stderr.write(proc.stderr)
+                return
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+        for key, title in (('setup', 'django.setup()'), ('urls', 'resolve(URL)'), ('asgi', 'импорт asgi')):
+            values = [r[key] * 1000 for r in runs]
+            self.stdout.write(f"  {title:<15} p50 {statistics.median(values):8.1f} мс  max {max(values):8.1f} мс")
+        total = [(r['setup'] + r['urls'] + r['asgi']) * 1000 for r in runs]
+        self.stdout.write(f"  {'всего':<15} p50 {statistics.median(total):8.1f} мс  max {max(total):8.1f} мс")
+        self.stdout.write(f"  пик памяти      {max(r['rss_mb'] for r in runs):8.1f} МБ")
+        heavy = sorted({m for r in runs for m in r['heavy']})
+        if heavy:
+            self.stdout.write(self.style.WARNING(f"  на веб-пути импортированы тяжёлые модули: {', '.join(heavy)}"))
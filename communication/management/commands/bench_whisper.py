@@ -0,0 +1,69 @@
+import re
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from communication.utils.audio import SAMPLE_RATE, decode_audio
+from communication.utils.whisper_backend import BACKENDS, load_backend
+
+
+def _words(text):
+    return re.findall(r"\w+", text.lower().replace("ё", "е"))
+
+
+def word_error_rate(reference, hypothesis):
+    """
+    WER = (замены + вставки + удаления) / слов в эталоне, через расстояние Левенштейна по словам.
+    """
+    ref, hyp = _words(reference), _words(hypothesis)
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        cur = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = cur
+    return prev[-1] / len(ref)
+
+
+class Command(BaseCommand):
+    help = "Сравнивает бэкенды распознавания на одной записи: real-time factor и WER относительно эталонного текста"
+
+    def add_arguments(self, parser):
+        parser.add_argument('audio', help='Запись (webm/opus, wav, mp3 - всё, что читает PyAV)')
+        parser.add_argument('reference', help='Файл с эталонным текстом записи')
+        parser.add_argument('--backends', default=','.join(BACKENDS), help='Через запятую, по умолчанию все')
+        parser.add_argument('--sizes', default=settings.TRANSCRIPTION['MODEL_SIZE'], help='Размеры моделей через запятую')
+        parser.add_argument('--threads', type=int, default=settings.TRANSCRIPTION['THREADS'])
+        parser.add_argument('--repeat', type=int, default=3, help='Сколько раз распознавать запись')
+        parser.add_argument('--language', default=None, help='Язык записи, иначе определяется автоматически')
+
+    def handle(self, *args, **options):
+        with open(options['audio'], 'rb') as f:
+            audio = decode_audio(f.read())
+        with open(options['reference'], 'r', encoding='utf-8') as f:
+            reference = f.read()
+        duration = len(audio) / SAMPLE_RATE
+        self.stdout.write(f"{options['audio']}: {duration:.1f} c звука, {len(_words(reference))} слов в эталоне")
+
+        for size in options['sizes'].split(','):
+            for name in options['backends'].split(','):
+                started = time.perf_counter()
+                # Загрузка считается вместе с прогревом, в замер RTF он не попадает
+                backend = load_backend(name, size, threads=options['threads'], warmup=True)
+                loaded = time.perf_counter() - started
+
+                timings = []
+                for _ in range(max(1, options['repeat'])):
+                    started = time.perf_counter()
+                    result = backend.transcribe(audio, language=options['language'])
+                    timings.append(time.perf_counter() - started)
+                best = min(timings)
+                self.stdout.write(
+                    f"  {name:<11} {size:<9} загрузка {loaded:6.1f} c  "
+                    f"RTF {best / duration:6.3f}  "
+                    f"WER {word_error_rate(reference, result['text']) * 100:6.2f}%"
+                )
+                del backend
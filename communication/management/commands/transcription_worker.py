@@ -0,0 +1,39 @@
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from communication.utils.transcription_worker import run_redis_worker
+
+
+class Command(BaseCommand):
+    help = "Запускает процессы распознавания речи, которые разбирают очередь транскрипции из Redis"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=settings.TRANSCRIPTION['WORKERS'],
+            help='Сколько процессов (и копий модели) поднять',
+        )
+
+    def handle(self, *args, **options):
+        if settings.TRANSCRIPTION['QUEUE'] != 'redis':
+            self.stderr.write("TRANSCRIPTION['QUEUE'] не 'redis': веб-процессы всё равно будут считать сами")
+
+        processes = max(1, options['processes'])
+        if processes == 1:
+            run_redis_worker()
+            return
+
+        ctx = multiprocessing.get_context('spawn')
+        workers = [ctx.Process(target=run_redis_worker, name=f'transcription-{i}') for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"Запущено воркеров распознавания: {processes}")
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 06:37
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communication', '0010_message_channel_ts_id_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='stream',
+            name='is_speaking',
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2 on 2026-10-18 06:47
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+
+def backfill_seq(apps, schema_editor):
+    # Уже сохранённые сообщения нумеруются по порядку (timestamp, id) внутри своего канала
+    Message = apps.get_model('communication', 'Message')
+    numbered = Message.objects.annotate(
+        number=Window(RowNumber(), partition_by=[F('channel_id')], order_by=[F('timestamp').asc(), F('id').asc()]),
+    ).values_list('id', 'number')
+    batch = []
+    for pk, number in numbered.iterator(chunk_size=2000):
+        batch.append(Message(id=pk, seq=number))
+        if len(batch) >= 2000:
+            Message.objects.bulk_update(batch, ['seq'])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ['seq'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communication', '0012_notification_cursor'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['channel', 'seq'], name='message_channel_seq_idx'),
+        ),
+    ]
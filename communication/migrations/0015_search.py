@@ -0,0 +1,52 @@
+# Generated by Django 5.2 on 2026-10-18 06:51
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Колонка message.search хранимая (STORED): ADD COLUMN переписывает всю таблицу сообщений под ACCESS EXCLUSIVE,
+# чат на это время встаёт. На большой базе эту миграцию катить в окно обслуживания.
+# GIN-индекс по сообщениям строится отдельно и без блокировки записи - см. 0016.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communication', '0014_message_channel_seq_uniq'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Transcript',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(max_length=64, unique=True)),
+                ('file_name', models.CharField(max_length=255)),
+                ('path', models.CharField(max_length=512)),
+                ('text', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('search', models.GeneratedField(db_persist=True, expression=django.contrib.postgres.search.CombinedSearchVector(django.contrib.postgres.search.SearchVector('text', config='russian'), '||', django.contrib.postgres.search.SearchVector('text', config='english'), django.contrib.postgres.search.SearchConfig('russian')), output_field=django.contrib.postgres.search.SearchVectorField())),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='search',
+            field=models.GeneratedField(db_persist=True, expression=django.contrib.postgres.search.CombinedSearchVector(django.contrib.postgres.search.SearchVector('content', config='russian'), '||', django.contrib.postgres.search.SearchVector('content', config='english'), django.contrib.postgres.search.SearchConfig('russian')), output_field=django.contrib.postgres.search.SearchVectorField()),
+        ),
+        migrations.AddField(
+            model_name='transcript',
+            name='channel',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transcripts', to='communication.channel'),
+        ),
+        migrations.AddField(
+            model_name='transcript',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transcripts', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='transcript',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search'], name='transcript_search_gin'),
+        ),
+    ]
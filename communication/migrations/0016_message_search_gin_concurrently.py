@@ -0,0 +1,19 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY не работает внутри транзакции
+    atomic = False
+
+    dependencies = [
+        ('communication', '0015_search'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='message',
+            index=GinIndex(fields=['search'], name='message_search_gin'),
+        ),
+    ]
@@ -1,7 +1,9 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.db import models
+from django.utils import timezone
 from accounts.models import User
 from adminpanel.models import Group
-import whisper
 
 class Channel(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -58,20 +60,60 @@ class Notification(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # keyset-пагинация и подсчёт непрочитанных: всё идёт по (created_at, id)
+            models.Index(fields=['created_at', 'id'], name='notification_ts_id_idx'),
+            models.Index(fields=['group', 'created_at', 'id'], name='notification_group_ts_id_idx'),
+        ]
+
     def __str__(self):
         return self.title
 
 
+class NotificationCursor(models.Model):
+    """
+    Докуда пользователь прочитал уведомления и докуда они ему доставлены по сокету.
+    Позиция - пара (created_at, id) последнего уведомления, как курсоры пагинации.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='notification_cursor')
+    read_at = models.DateTimeField(null=True, blank=True)
+    read_id = models.IntegerField(default=0)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    delivered_id = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user.username}: read {self.read_id}, delivered {self.delivered_id}"
+
+
 class Message(models.Model):
     channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='messages')
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Время ставит consumer в момент рассылки, а в БД сообщение попадает позже пачкой (utils/chat_buffer.py)
+    timestamp = models.DateTimeField(default=timezone.now)
     uploaded_file = models.ForeignKey(UploadedFile, on_delete=models.SET_NULL, null=True, blank=True, related_name='messages')
+    # Номер сообщения в канале (utils/sequence.py), клиент по нему видит пропуски
+    seq = models.PositiveBigIntegerField(null=True, blank=True)
+    # Полнотекстовый индекс (utils/search.py): считает сам Postgres, в том числе при bulk_create из chat_buffer
+    search = models.GeneratedField(
+        expression=SearchVector('content', config='russian') + SearchVector('content', config='english'),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
 
 
     class Meta:
         ordering = ['timestamp']  # Сообщения по порядку
+        indexes = [
+            # keyset-пагинация истории: последние N сообщений канала без скана всей таблицы
+            models.Index(fields=['channel', 'timestamp', 'id'], name='message_channel_ts_id_idx'),
+            GinIndex(fields=['search'], name='message_search_gin'),
+        ]
+        constraints = [
+            # seq выдаёт один счётчик канала (utils/sequence.py); повтор номера - ошибка, а не второе сообщение
+            models.UniqueConstraint(fields=['channel', 'seq'], name='message_channel_seq_uniq'),
+        ]
 
     def __str__(self):
         return f"[{self.timestamp:%Y-%m-%d %H:%M:%S}] {self.sender.username}: {self.content[:30]}"
@@ -89,27 +131,64 @@ class Stream(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     is_muted_by_admin = models.BooleanField(default=False)
-    is_speaking = models.BooleanField(default=False)
+    # is_speaking в БД не хранится - см. communication/utils/speaking.py
 
     class Meta:
         unique_together = ('user', 'channel')  # 1 стрим на пользователя в канале
 
     def __str__(self):
         return f"{self.user.username} in {self.channel.name} (video={self.has_video}, audio={self.has_audio}, webcam={self.has_webcam})"
-    
+
+
+class Transcript(models.Model):
+    """
+    Текст законченной сессии распознавания - копия для поиска; сам файл лежит в MinIO (path).
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='transcripts')
+    channel = models.ForeignKey(Channel, on_delete=models.SET_NULL, null=True, blank=True, related_name='transcripts')
+    session_id = models.CharField(max_length=64, unique=True)
+    file_name = models.CharField(max_length=255)
+    path = models.CharField(max_length=512)
+    text = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    search = models.GeneratedField(
+        expression=SearchVector('text', config='russian') + SearchVector('text', config='english'),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search'], name='transcript_search_gin'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.file_name}"
+
 
 
 class WhisperModel:
-    def __init__(self):
-        self.model = whisper.load_model("base")
+    """
+    Распознавание речи. Бэкенд и размер модели - TRANSCRIPTION['BACKEND'] / ['MODEL_SIZE'].
+    Создаётся только в процессах распознавания, веб и WebSocket его не трогают.
+    """
 
-    def transcribe(self, audio_path):
+    def __init__(self, backend=None, model_size=None):
+        # torch и whisper импортируются только здесь: иначе их тянет каждый manage.py и каждый под daphne
+        from communication.utils.whisper_backend import load_backend
+
+        self.backend = load_backend(backend, model_size)
+
+    def transcribe(self, audio, **options):
+        """
+        audio - путь к файлу или float32-массив 16 кГц.
+        Кроме текста отдаёт сегменты с таймкодами в секундах от начала audio.
+        """
         try:
-            result = self.model.transcribe(audio_path)
-            return {"text": result.get("text", "").strip()}
+            return self.backend.transcribe(audio, **options)
         except Exception as e:
             print(f"[WhisperModel] Ошибка транскрипции: {e}")
-            return {"text": ""}
-
+            return {"text": "", "segments": []}
 
-    
\ No newline at end of file
+    def transcribe_batch(self, audios):
+        return self.backend.transcribe_batch(audios)
@@ -4,6 +4,7 @@ from accounts.models import User
 from adminpanel.models import Group
 from urllib.parse import quote
 from .utils import minio_client
+from .utils.notification_inbox import is_after
 from datetime import timedelta
 from urllib.parse import urlparse
 
@@ -38,10 +39,19 @@ class ChannelSerializer(serializers.ModelSerializer):
 
 
 class NotificationSerializer(serializers.ModelSerializer):
+    # Прочитано ли, по курсору из context['read_cursor'] (NotificationCursor); без курсора - None
+    is_read = serializers.SerializerMethodField()
+
     class Meta:
         model = Notification
         fields = "__all__"
 
+    def get_is_read(self, obj):
+        cursor = self.context.get('read_cursor')
+        if cursor is None:
+            return None
+        return not is_after(obj.created_at, obj.id, cursor.read_at, cursor.read_id)
+
     def validate_image(self, value):
         parsed = urlparse(value)
         if not parsed.netloc == "localhost:9000":
@@ -60,9 +70,13 @@ class UploadedFileSerializer(serializers.ModelSerializer):
         fields = ['id', 'file_name', 'path', 'file_type', 'uploaded_at', 'url', 'is_image']
 
     def get_url(self, obj):
+        # Ссылку могли подписать заранее (ChannelConsumer подписывает в пуле MinIO, не на event loop)
+        urls = self.context.get('presigned_urls')
+        if urls is not None:
+            return urls.get(obj.path)
         try:
             expires = timedelta(days=7)
-            presigned_url = minio_client.client.presigned_get_object("online-school", obj.path, expires=expires)
+            presigned_url = minio_client.get_presigned_url(obj.path, expires=expires)
             return presigned_url
         except Exception as e:
             return None
@@ -76,19 +90,30 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = ['sender', 'content', 'timestamp', 'uploaded_file']
+        fields = ['id', 'seq', 'sender', 'content', 'timestamp', 'uploaded_file']
 
 
 
 class StreamSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
+    # Старые имена полей, которые ждёт фронт
+    is_audio_enabled = serializers.BooleanField(source='has_audio', read_only=True)
+    is_video_enabled = serializers.BooleanField(source='has_video', read_only=True)
+    # Не хранится в БД: передаётся в context['speaking'] из utils/speaking.py
+    is_speaking = serializers.SerializerMethodField()
 
     class Meta:
         model = Stream
         fields = (
             'user',
+            'has_audio',
+            'has_video',
+            'has_webcam',
             'is_audio_enabled',
             'is_video_enabled',
             'is_muted_by_admin',
             'is_speaking',
         )
+
+    def get_is_speaking(self, obj):
+        return obj.user_id in self.context.get('speaking', ())
@@ -1,3 +1,1014 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import threading
+import uuid
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import av
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    import aiortc
+except ImportError:
+    aiortc = None
+
+from accounts.models import User
+from adminpanel.models import Group
+from . import consumers
+from .consumers import ChannelConsumer, NotificationConsumer
+from .models import Channel, Message, Notification, NotificationCursor, Transcript, UploadedFile
+from .utils import channel_events, chat_buffer, metrics, presence, sequence, speaking, transcription_stream
+from .utils.audio import decode_audio
+from .utils.notification_sender import notification_group_names
+from .utils.pagination import encode_cursor
+from .utils.sequence import channel_seq_key
+from .utils.transcription_queue import cleanup_session, session_path
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+@mock.patch('communication.utils.minio_client.get_presigned_url', return_value='http://minio/file')
+class QueryBudgetTests(TestCase):
+    """
+    Число запросов не должно зависеть от количества каналов, участников и сообщений на странице.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.group = Group.objects.create(name='ИВТ-1', student_count=30)
+        cls.teacher = User.objects.create(username='teacher', name='Преподаватель', role='преподаватель')
+        cls.students = [
+            User.objects.create(username=f'student{i}', name=f'Студент {i}', role='студент', group=cls.group)
+            for i in range(5)
+        ]
+        for i in range(20):
+            channel = Channel.objects.create(name=f'channel{i}', created_by=cls.teacher)
+            channel.participants.add(*cls.students)
+            channel.groups_allowed.add(cls.group)
+        cls.channel = Channel.objects.first()
+        upload = UploadedFile.objects.create(user=cls.teacher, file_name='a.png', file_type='user_upload', path='a.png')
+        Message.objects.bulk_create([
+            Message(
+                channel=cls.channel,
+                sender=cls.students[i % 5],
+                content=f'сообщение {i}',
+                uploaded_file=upload if i % 3 == 0 else None,
+                seq=i + 1,
+            )
+            for i in range(60)
+        ])
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_channel_list_for_teacher(self, _):
+        self.client.force_authenticate(self.teacher)
+        # каналы с created_by + participants + groups_allowed
+        with self.assertNumQueries(3):
+            response = self.client.get('/communication/channels/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 20)
+
+    def test_channel_list_for_student(self, _):
+        self.client.force_authenticate(self.students[0])
+        with self.assertNumQueries(3):
+            response = self.client.get('/communication/channels/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 20)
+
+    def test_message_history_page(self, _):
+        self.client.force_authenticate(self.students[0])
+        # канал + страница сообщений с sender и uploaded_file одним JOIN
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/communication/channels/{self.channel.id}/messages/?limit=50')
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(len(body['results']), 50)
+        self.assertTrue(body['has_more_before'])
+
+        # + проверка одной строкой, есть ли что-то новее окна
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/communication/channels/{self.channel.id}/messages/?before={body["before"]}')
+        self.assertEqual(len(response.json()['results']), 10)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class HistoryPaginationTests(TestCase):
+    """
+    Курсоры истории: before/after/around, флаги has_more_*, кривые и чужие курсоры, потолок limit.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='reader', name='Читатель', role='преподаватель')
+        cls.channel = Channel.objects.create(name='history')
+        cls.other = Channel.objects.create(name='other')
+        start = timezone.now() - timedelta(hours=1)
+        cls.messages = Message.objects.bulk_create([
+            Message(channel=cls.channel, sender=cls.user, content=f'{i}', seq=i, timestamp=start + timedelta(seconds=i))
+            for i in range(1, 31)
+        ])
+        cls.foreign = Message.objects.create(
+            channel=cls.other, sender=cls.user, content='чужое', seq=1, timestamp=start + timedelta(seconds=15, milliseconds=500),
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _cursor(self, message):
+        return encode_cursor(message.timestamp, message.id)
+
+    def _page(self, **params):
+        response = self.client.get(f'/communication/channels/{self.channel.id}/messages/', params)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        return [m['seq'] for m in body['results']], body['has_more_before'], body['has_more_after']
+
+    def test_latest_then_before(self):
+        self.assertEqual(self._page(limit=10), (list(range(21, 31)), True, False))
+        self.assertEqual(self._page(limit=10, before=self._cursor(self.messages[20])), (list(range(11, 21)), True, True))
+        self.assertEqual(self._page(limit=10, before=self._cursor(self.messages[10])), (list(range(1, 11)), False, True))
+
+    def test_before_checks_newer_rows_exist(self):
+        cursor = self._cursor(self.messages[29])
+        Message.objects.filter(seq=30, channel=self.channel).delete()
+        self.assertEqual(self._page(limit=10, before=cursor), (list(range(20, 30)), True, False))
+
+    def test_after(self):
+        self.assertEqual(self._page(limit=10, after=self._cursor(self.messages[9])), (list(range(11, 21)), True, True))
+        self.assertEqual(self._page(limit=10, after=self._cursor(self.messages[24])), (list(range(26, 31)), True, False))
+
+    def test_after_checks_older_rows_exist(self):
+        cursor = self._cursor(self.messages[0])
+        Message.objects.filter(seq=1, channel=self.channel).delete()
+        self.assertEqual(self._page(limit=10, after=cursor), (list(range(2, 12)), False, True))
+
+    def test_around(self):
+        self.assertEqual(self._page(limit=10, around=self._cursor(self.messages[14])), (list(range(10, 20)), True, True))
+        self.assertEqual(self._page(limit=10, around=self._cursor(self.messages[1])), (list(range(1, 7)), False, True))
+
+    def test_foreign_cursor_is_only_a_position(self):
+        # Курсор сообщения другого канала - просто точка во времени, чужих сообщений в ответе нет
+        self.assertEqual(self._page(limit=5, before=self._cursor(self.foreign)), (list(range(11, 16)), True, True))
+
+    def test_invalid_params(self):
+        url = f'/communication/channels/{self.channel.id}/messages/'
+        cursor = self._cursor(self.messages[5])
+        for params in ({'before': 'мусор'}, {'after': 'e30'}, {'limit': 0}, {'limit': 'abc'},
+                       {'before': cursor, 'after': cursor}):
+            self.assertEqual(self.client.get(url, params).status_code, 400, params)
+
+    @override_settings(CHAT_HISTORY={'PAGE_SIZE': 3, 'MAX_PAGE_SIZE': 5})
+    def test_limit_default_and_cap(self):
+        self.assertEqual(self._page()[0], [28, 29, 30])
+        self.assertEqual(self._page(limit=100)[0], list(range(26, 31)))
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class TranscriptAccessTests(TestCase):
+    """
+    Текст сессии забирает только её владелец и привязывает только к каналу, где он участник.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(username='owner', name='Владелец', role='студент')
+        cls.other = User.objects.create(username='other', name='Другой', role='студент')
+        cls.channel = Channel.objects.create(name='lecture')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        self.session_id = self.client.post('/communication/transcribe/start/').json()['session_id']
+        self.addCleanup(cleanup_session, self.session_id)
+
+    def test_other_user_cannot_finish_session(self):
+        self.client.force_authenticate(self.other)
+        response = self.client.post('/communication/transcribe/finish/', {'session_id': self.session_id})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Transcript.objects.exists())
+
+    def test_student_cannot_attach_to_foreign_channel(self):
+        response = self.client.post(
+            '/communication/transcribe/finish/', {'session_id': self.session_id, 'channel_id': self.channel.id},
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Transcript.objects.exists())
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class SearchTests(TestCase):
+    """
+    Полнотекстовый поиск: по убыванию релевантности, с подсветкой, студенту - только доступные ему каналы.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        group = Group.objects.create(name='ИВТ-1', student_count=30)
+        other_group = Group.objects.create(name='ИВТ-2', student_count=30)
+        cls.student = User.objects.create(username='student', name='Студент', role='студент', group=group)
+        cls.teacher = User.objects.create(username='teacher', name='Преподаватель', role='преподаватель')
+        cls.open = Channel.objects.create(name='open')
+        cls.own = Channel.objects.create(name='own')
+        cls.own.groups_allowed.add(group)
+        cls.closed = Channel.objects.create(name='closed')
+        cls.closed.groups_allowed.add(other_group)
+        for seq, (channel, content) in enumerate([
+            (cls.open, 'Контрольная по матанализу перенесена на пятницу'),
+            (cls.open, 'Контрольная, контрольная и ещё раз контрольная: вопросы к контрольной'),
+            (cls.own, 'Контрольная для своей группы'),
+            (cls.closed, 'Контрольная в закрытом канале'),
+            (cls.open, 'Про лабораторную'),
+        ], start=1):
+            Message.objects.create(channel=channel, sender=cls.teacher, content=content, seq=seq)
+        for session, (user, channel, text) in enumerate([
+            (cls.student, None, 'Своя запись: контрольная'),
+            (cls.teacher, cls.own, 'Лекция своей группы: контрольная'),
+            (cls.teacher, cls.closed, 'Лекция чужой группы: контрольная'),
+        ]):
+            Transcript.objects.create(
+                user=user, channel=channel, session_id=f's{session}', file_name='t.txt', path='t.txt', text=text,
+            )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.student)
+
+    def _search(self, **params):
+        response = self.client.get('/communication/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_results_are_ranked_and_highlighted(self):
+        self.client.force_authenticate(self.teacher)
+        results = self._search(q='контрольная')['results']
+        self.assertEqual(len(results), 4)
+        self.assertTrue(results[0]['highlight'].startswith('<mark>Контрольная</mark>, <mark>контрольная</mark>'))
+        ranks = [result['rank'] for result in results]
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+    def test_student_sees_only_allowed_channels(self):
+        results = self._search(q='контрольная')['results']
+        self.assertEqual({result['channel']['name'] for result in results}, {'open', 'own'})
+        self.assertEqual(self._search(q='контрольная', channel=self.closed.id)['results'], [])
+
+    def test_student_sees_own_and_allowed_transcripts(self):
+        with mock.patch('communication.utils.search.get_download_url', return_value=None):
+            results = self._search(q='контрольная', type='transcripts')['results']
+        self.assertEqual(
+            sorted(result['highlight'].split(':')[0] for result in results), ['Лекция своей группы', 'Своя запись'],
+        )
+
+    def test_highlight_escapes_text(self):
+        Message.objects.create(channel=self.open, sender=self.teacher, content='зачёт, если 3 < 5 & "сдано"', seq=10)
+        results = self._search(q='зачёт')['results']
+        self.assertEqual(results[0]['highlight'], '<mark>зачёт</mark>, если 3 &lt; 5 &amp; &quot;сдано&quot;')
+
+    @override_settings(SEARCH={**settings.SEARCH, 'PAGE_SIZE': 1})
+    def test_offset_pages_through_results(self):
+        seen, offset = [], 0
+        while offset is not None:
+            page = self._search(q='контрольная', offset=offset)
+            seen += [result['id'] for result in page['results']]
+            offset = page['next_offset']
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(len(set(seen)), 3)
+
+    def test_invalid_params(self):
+        for params in ({}, {'q': 'x', 'type': 'files'}, {'q': 'x', 'offset': '-1'}, {'q': 'x', 'channel': 'abc'}):
+            self.assertEqual(self.client.get('/communication/search/', params).status_code, 400)
+
+
+@override_settings(REDIS_URL=None)
+class ChatBufferTests(TransactionTestCase):
+    """
+    Отложенная запись чата: пачка в БД, повторная доставка без дублей, занятый seq не перенумеровывается.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='writer', name='Писатель', role='студент')
+        self.channel = Channel.objects.create(name='chat')
+        chat_buffer._memory.clear()
+        self.addCleanup(chat_buffer._memory.clear)
+
+    def _message(self, seq, content='привет'):
+        message_id = async_to_sync(chat_buffer.next_message_id)()
+        return Message(id=message_id, channel=self.channel, sender=self.user, content=content, seq=seq)
+
+    def _submit(self, *messages):
+        for message in messages:
+            async_to_sync(chat_buffer.submit)(message)
+
+    def test_flush_writes_buffered_messages(self):
+        self._submit(self._message(1), self._message(2))
+        self.assertFalse(Message.objects.exists())
+        async_to_sync(chat_buffer.flush)('test')
+        self.assertEqual(list(Message.objects.order_by('seq').values_list('seq', flat=True)), [1, 2])
+        self.assertEqual(chat_buffer._memory, [])
+
+    def test_redelivered_rows_are_written_once(self):
+        message = self._message(1)
+        self._submit(message, message)
+        async_to_sync(chat_buffer.flush)('test')
+        self._submit(message)
+        async_to_sync(chat_buffer.flush)('test')
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_taken_seq_is_dropped_not_renumbered(self):
+        Message.objects.create(channel=self.channel, sender=self.user, content='уже в БД', seq=5)
+        conflicts = metrics._counters['chat_seq_conflicts']
+        self._submit(self._message(5, 'дубль'), self._message(6))
+        async_to_sync(chat_buffer.flush)('test')
+        self.assertEqual(
+            list(Message.objects.order_by('seq').values_list('seq', 'content')), [(5, 'уже в БД'), (6, 'привет')],
+        )
+        self.assertEqual(metrics._counters['chat_seq_conflicts'], conflicts + 1)
+
+    def test_last_seq_counts_unflushed_messages(self):
+        Message.objects.create(channel=self.channel, sender=self.user, content='в БД', seq=3)
+        self._submit(self._message(7))
+        self.assertEqual(async_to_sync(chat_buffer.alast_seq)(self.channel.id), 7)
+
+
+@skipUnless(fakeredis, 'нужен fakeredis')
+@override_settings(CHAT_BUFFER={**settings.CHAT_BUFFER, 'CLAIM_IDLE': 0})
+class ChatJournalTests(TransactionTestCase):
+    """
+    Журнал в Redis переживает рестарт: незаписанное умершим процессом дописывает другой.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='writer', name='Писатель', role='студент')
+        self.channel = Channel.objects.create(name='chat')
+        self.server = fakeredis.FakeServer()
+        # У async_to_sync каждый раз свой event loop, а клиент привязан к loop - отдаём новый на общем сервере
+        patcher = mock.patch(
+            'communication.utils.chat_buffer.get_async_redis',
+            side_effect=lambda: fakeredis.FakeAsyncRedis(server=self.server),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        chat_buffer._group_ready = False
+        self.addCleanup(setattr, chat_buffer, '_group_ready', False)
+
+    def _submit(self, seq):
+        message_id = async_to_sync(chat_buffer.next_message_id)()
+        message = Message(id=message_id, channel=self.channel, sender=self.user, content='привет', seq=seq)
+        async_to_sync(chat_buffer.submit)(message)
+
+    def test_entries_of_dead_process_are_claimed(self):
+        self._submit(1)
+        self._submit(2)
+        # Процесс прочитал журнал и упал, не записав пачку
+        with mock.patch('communication.utils.chat_buffer._write', side_effect=RuntimeError('упал')):
+            with self.assertRaises(RuntimeError):
+                async_to_sync(chat_buffer.flush)('dead')
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(async_to_sync(chat_buffer.alast_seq)(self.channel.id), 2)
+
+        async_to_sync(chat_buffer.flush)('alive')
+        self.assertEqual(list(Message.objects.order_by('seq').values_list('seq', flat=True)), [1, 2])
+        redis_client = fakeredis.FakeRedis(server=self.server)
+        self.assertEqual(redis_client.xlen(chat_buffer.JOURNAL_KEY), 0)
+        self.assertEqual(redis_client.xpending(chat_buffer.JOURNAL_KEY, chat_buffer.JOURNAL_GROUP)['pending'], 0)
+
+
+class MessageSerializeTests(TestCase):
+    """
+    Сокет подписывает ссылку на файл сообщения в пуле MinIO, а не на event loop.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='sender', name='Отправитель', role='студент')
+        cls.channel = Channel.objects.create(name='files')
+        cls.upload = UploadedFile.objects.create(user=cls.user, file_name='a.png', file_type='user_upload', path='a.png')
+
+    def test_file_url_is_signed_in_minio_pool(self):
+        threads = []
+
+        def presign(path, expires=None, response_headers=None):
+            threads.append(threading.current_thread().name)
+            return f'http://minio/{path}'
+
+        message = Message(id=1, seq=1, channel=self.channel, sender=self.user, content='файл', uploaded_file=self.upload)
+        with mock.patch('communication.utils.minio_client.get_presigned_url', side_effect=presign):
+            data = async_to_sync(ChannelConsumer()._serialize_message)(message)
+        self.assertEqual(data['uploaded_file']['url'], 'http://minio/a.png')
+        self.assertEqual(data['sender']['username'], 'sender')
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith('minio'))
+
+
+@skipUnless(aiortc, 'нужен aiortc')
+@override_settings(SFU={**settings.SFU, 'ICE_SERVERS': [], 'MAX_SUBSCRIPTIONS': 2})
+class SfuRoomTests(TestCase):
+    """
+    Подписки SFU: упавшее соединение подписчика убирается из комнаты, подписок не больше потолка.
+    """
+
+    async def _room(self):
+        from .utils import sfu
+        from aiortc.mediastreams import AudioStreamTrack
+
+        room = sfu.Room(1)
+        publisher = sfu.Publisher(10, aiortc.RTCPeerConnection())
+        publisher.tracks['audio'] = sfu.GatedTrack(AudioStreamTrack())
+        room.publishers[10] = publisher
+        return room
+
+    def test_closed_subscriber_is_removed(self):
+        async def scenario():
+            room = await self._room()
+            await room.subscribe(20, 10)
+            pc = room.subscriptions[(20, 10)]
+            await pc.close()
+            await asyncio.sleep(0.1)
+            remaining = dict(room.subscriptions)
+            await room.leave(10)
+            return remaining
+
+        self.assertEqual(async_to_sync(scenario)(), {})
+
+    def test_subscriptions_are_capped(self):
+        async def scenario():
+            room = await self._room()
+            await room.subscribe(20, 10)
+            await room.subscribe(21, 10)
+            # Переподписка того же зрителя место не занимает
+            await room.subscribe(21, 10, layer='low')
+            try:
+                await room.subscribe(22, 10)
+            finally:
+                await room.leave(10)
+
+        with self.assertRaises(ValueError):
+            async_to_sync(scenario)()
+
+
+@override_settings(REDIS_URL=None)
+class ReplayTests(TransactionTestCase):
+    """
+    Переподключение с ?since=: из кольца, из БД и журнала записи, или resync_required.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='reader', name='Читатель', role='студент')
+        self.channel = Channel.objects.create(name='replay')
+        self.key = channel_seq_key(self.channel.id)
+        self.addCleanup(sequence._memory.pop, self.key, None)
+        self.addCleanup(channel_events._memory.pop, str(self.channel.id), None)
+        chat_buffer._memory.clear()
+        self.addCleanup(chat_buffer._memory.clear)
+
+        self.consumer = ChannelConsumer()
+        self.consumer.channel_id = self.channel.id
+        self.sent = []
+
+        async def send(text_data):
+            self.sent.append(json.loads(text_data))
+
+        self.consumer.send = send
+
+    def _event(self, seq, kind='speaking_update'):
+        async_to_sync(channel_events.aremember)(self.channel.id, seq, {'type': kind, 'seq': seq})
+
+    def _replay(self, since, current):
+        sequence._memory[self.key] = current
+        async_to_sync(self.consumer._replay)(since)
+        return [(event['type'], event.get('seq', event.get('message', {}).get('seq'))) for event in self.sent]
+
+    def test_ring_covers_gap(self):
+        for seq in (1, 2, 3):
+            self._event(seq)
+        self.assertEqual(
+            self._replay(1, 3), [('speaking_update', 2), ('speaking_update', 3), ('replay_done', 3)],
+        )
+
+    def test_messages_before_ring_come_from_db_and_journal(self):
+        Message.objects.create(channel=self.channel, sender=self.user, content='в БД', seq=2)
+        async_to_sync(chat_buffer.submit)(
+            Message(id=10 ** 9, channel=self.channel, sender=self.user, content='в журнале', seq=3),
+        )
+        # seq 4 - stream_delta, выпавший из кольца: в БД его нет, повторять нечего
+        self._event(5, 'stream_delta')
+        self._event(6, 'stream_delta')
+        self.assertEqual(self._replay(1, 6), [
+            ('chat_message', 2), ('chat_message', 3), ('stream_delta', 5), ('stream_delta', 6), ('replay_done', 6),
+        ])
+        self.assertEqual(self.sent[1]['message']['sender']['username'], 'reader')
+
+    def test_counter_behind_client_requires_resync(self):
+        self.assertEqual(self._replay(10, 4), [('resync_required', 4)])
+
+    @override_settings(CHANNEL_EVENTS={**settings.CHANNEL_EVENTS, 'REPLAY_LIMIT': 1})
+    def test_too_many_missed_requires_resync(self):
+        for seq in (2, 3):
+            Message.objects.create(channel=self.channel, sender=self.user, content='в БД', seq=seq)
+        self.assertEqual(self._replay(1, 3), [('resync_required', 3)])
+
+
+@override_settings(REDIS_URL=None)
+class ConnectLoadTests(TransactionTestCase):
+    """
+    Подключение к каналу: существование канала и засев счётчика не ходят в БД на каждом подключении.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='viewer', name='Зритель', role='студент')
+        self.channel = Channel.objects.create(name='connect')
+        self.key = channel_seq_key(self.channel.id)
+        self.addCleanup(sequence._memory.pop, self.key, None)
+        self.addCleanup(consumers._known_channels.clear)
+        self.seeds = []
+
+    async def _seed(self):
+        self.seeds.append(1)
+        return await chat_buffer.alast_seq(self.channel.id)
+
+    def _exists(self, channel_id):
+        consumer = ChannelConsumer()
+        consumer.channel_id = channel_id
+        return async_to_sync(consumer._channel_exists)()
+
+    def test_known_channel_is_not_queried_again(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(self._exists(self.channel.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(self._exists(self.channel.id))
+
+    def test_missing_channel_is_not_cached(self):
+        missing = self.channel.id + 1000
+        self.assertFalse(self._exists(missing))
+        with self.assertNumQueries(1):
+            self.assertFalse(self._exists(missing))
+
+    def test_memory_counter_is_seeded_once(self):
+        Message.objects.create(channel=self.channel, sender=self.user, content='в БД', seq=4)
+        for _ in range(3):
+            async_to_sync(sequence.aensure_seq)(self.key, self._seed)
+        self.assertEqual(len(self.seeds), 1)
+        self.assertEqual(async_to_sync(sequence.aget_seq)(self.key), 4)
+
+    @skipUnless(fakeredis, 'нужен fakeredis')
+    def test_redis_counter_is_seeded_only_when_missing(self):
+        server = fakeredis.FakeServer()
+        redis_client = fakeredis.FakeRedis(server=server)
+        Message.objects.create(channel=self.channel, sender=self.user, content='в БД', seq=4)
+        with mock.patch(
+            'communication.utils.sequence.get_async_redis',
+            side_effect=lambda: fakeredis.FakeAsyncRedis(server=server),
+        ):
+            async_to_sync(sequence.aensure_seq)(self.key, self._seed)
+            self.assertEqual(int(redis_client.get(self.key)), 4)
+            redis_client.set(self.key, 9)
+            async_to_sync(sequence.aensure_seq)(self.key, self._seed)
+            self.assertEqual(int(redis_client.get(self.key)), 9)
+            # Redis потерял ключ - засеваем заново
+            redis_client.delete(self.key)
+            async_to_sync(sequence.aensure_seq)(self.key, self._seed)
+            self.assertEqual(int(redis_client.get(self.key)), 4)
+        self.assertEqual(len(self.seeds), 2)
+
+
+@override_settings(REDIS_URL=None)
+class PresenceTests(TestCase):
+    """
+    Реестр присутствия: вход по первой вкладке, выход по последней, чистка протухших соединений.
+    """
+
+    def setUp(self):
+        patcher = mock.patch('communication.utils.presence._memory', presence.MemoryPresence())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('communication.utils.presence.time')
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.clock.time.return_value = 1000.0
+        self.anna = User(id=1, name='Анна')
+        self.boris = User(id=2, name='Борис')
+
+    def _join(self, user, conn):
+        return async_to_sync(presence.join)(7, user, conn)
+
+    def _leave(self, user, conn):
+        return async_to_sync(presence.leave)(7, user, conn)
+
+    def _members(self):
+        return async_to_sync(presence.members)(7)
+
+    def test_join_and_leave_by_first_and_last_tab(self):
+        self.assertTrue(self._join(self.anna, 'tab-1'))
+        self.assertFalse(self._join(self.anna, 'tab-2'))
+        self.assertTrue(self._join(self.boris, 'tab-3'))
+        self.assertEqual(self._members(), {'1': 'Анна', '2': 'Борис'})
+
+        self.assertFalse(self._leave(self.anna, 'tab-1'))
+        self.assertEqual(self._members(), {'1': 'Анна', '2': 'Борис'})
+        self.assertTrue(self._leave(self.anna, 'tab-2'))
+        self.assertEqual(self._members(), {'2': 'Борис'})
+
+    def test_leave_twice_is_counted_once(self):
+        self._join(self.anna, 'tab-1')
+        self._join(self.anna, 'tab-2')
+        self.assertFalse(self._leave(self.anna, 'tab-1'))
+        self.assertFalse(self._leave(self.anna, 'tab-1'))
+        self.assertEqual(self._members(), {'1': 'Анна'})
+
+    def test_heartbeat_removes_expired_connections(self):
+        self._join(self.anna, 'tab-1')
+        # Процесс Анны упал, disconnect не пришёл, heartbeat не идёт дольше TTL
+        self.clock.time.return_value += settings.PRESENCE['TTL'] + 1
+        self._join(self.boris, 'tab-2')
+        self.assertEqual(async_to_sync(presence.heartbeat)(7, self.boris, 'tab-2'), ['Анна'])
+        self.assertEqual(self._members(), {'2': 'Борис'})
+        # Второй раз её не вычитают
+        self.assertEqual(async_to_sync(presence.heartbeat)(7, self.boris, 'tab-2'), [])
+        self.assertFalse(self._leave(self.anna, 'tab-1'))
+
+    def test_heartbeat_keeps_own_connection_alive(self):
+        self._join(self.anna, 'tab-1')
+        self.clock.time.return_value += settings.PRESENCE['TTL'] - 1
+        self.assertEqual(async_to_sync(presence.heartbeat)(7, self.anna, 'tab-1'), [])
+        self.clock.time.return_value += settings.PRESENCE['TTL'] - 1
+        # Свой heartbeat продлевает соединение раньше, чем ищет протухшие
+        self.assertEqual(async_to_sync(presence.heartbeat)(7, self.anna, 'tab-1'), [])
+        self.assertEqual(self._members(), {'1': 'Анна'})
+
+
+@skipUnless(fakeredis, 'нужен fakeredis')
+class RedisPresenceTests(PresenceTests):
+    """
+    То же на реестре в Redis (скрипт выхода, zset протухания).
+    """
+
+    def setUp(self):
+        super().setUp()
+        server = fakeredis.FakeServer()
+        patcher = mock.patch(
+            'communication.utils.presence.get_async_redis',
+            side_effect=lambda: fakeredis.FakeAsyncRedis(server=server),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, presence, '_redis_presence', None)
+
+
+class RecordingLayer:
+    def __init__(self):
+        self.sent = []
+        self.groups = {}
+
+    async def group_send(self, group, event):
+        self.sent.append((group, event))
+
+    async def send(self, channel, event):
+        self.sent.append((channel, event))
+
+    async def group_add(self, group, channel):
+        self.groups.setdefault(group, set()).add(channel)
+
+    async def group_discard(self, group, channel):
+        self.groups.get(group, set()).discard(channel)
+
+
+@override_settings(REDIS_URL=None, SPEAKING={'TICK_HZ': 1000})
+class SpeakingCoalescerTests(TransactionTestCase):
+    """
+    is_speaking копится до тика и уходит одним speaking_update на канал, только изменившееся.
+    """
+
+    def setUp(self):
+        self.channel_id = 11
+        self.layer = RecordingLayer()
+        self.addCleanup(sequence._memory.pop, channel_seq_key(self.channel_id), None)
+        self.addCleanup(sequence._fallback.discard, channel_seq_key(self.channel_id))
+        self.addCleanup(channel_events._memory.pop, str(self.channel_id), None)
+        self.addCleanup(speaking._memory_speaking.pop, str(self.channel_id), None)
+        self.addCleanup(speaking._coalescers.pop, self.channel_id, None)
+        # Сокет канала подключён всё время теста - коалесер (и то, что он уже разослал) живёт между тиками
+        self.coalescer = speaking.attach(self.channel_id, 'channel_11', self.layer)
+
+    def _tick(self, *reports):
+        async def run():
+            for user_id, is_speaking in reports:
+                self.coalescer.report(user_id, is_speaking)
+            await self.coalescer.task
+        async_to_sync(run)()
+        return [event['speaking'] for _, event in self.layer.sent]
+
+    def test_tick_sends_last_state_once(self):
+        self.assertEqual(self._tick((1, True), (2, True), (1, False), (1, True)), [
+            [{'user_id': 1, 'is_speaking': True}, {'user_id': 2, 'is_speaking': True}],
+        ])
+        group, event = self.layer.sent[0]
+        self.assertEqual((group, event['type'], event['seq']), ('channel_11', 'speaking_update', 1))
+        self.assertEqual(async_to_sync(speaking.aget_speaking)(self.channel_id), {1, 2})
+        # Событие лежит в кольце повтора под своим seq
+        self.assertEqual(async_to_sync(channel_events.areplay)(self.channel_id, 0), ([event], 1))
+
+    def test_unchanged_state_is_not_sent_again(self):
+        self._tick((1, True))
+        dropped = metrics._counters['speaking_dropped']
+        # Начал и перестал внутри одного тика, и повтор уже разосланного - рассылать нечего
+        self._tick((2, True), (2, False), (1, True))
+        self.assertEqual(len(self.layer.sent), 1)
+        self.assertEqual(metrics._counters['speaking_dropped'], dropped + 3)
+
+    def test_stop_is_sent_after_start(self):
+        self._tick((1, True))
+        self.assertEqual(self._tick((1, False)), [
+            [{'user_id': 1, 'is_speaking': True}], [{'user_id': 1, 'is_speaking': False}],
+        ])
+        self.assertEqual([event['seq'] for _, event in self.layer.sent], [1, 2])
+        self.assertEqual(async_to_sync(speaking.aget_speaking)(self.channel_id), set())
+
+
+@override_settings(REDIS_URL=None)
+class SignalRoutingTests(TestCase):
+    """
+    Адресный сигнал WebRTC идёт прямо в сокеты получателя (presence.routes), без адреса или без маршрута - в группу.
+    """
+
+    def setUp(self):
+        patcher = mock.patch('communication.utils.presence._memory', presence.MemoryPresence())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.anna = User(id=1, name='Анна')
+        self.boris = User(id=2, name='Борис')
+        for user, conn in ((self.anna, 'anna-1'), (self.boris, 'boris-1'), (self.boris, 'boris-2')):
+            async_to_sync(presence.join)(7, user, conn)
+
+        self.layer = RecordingLayer()
+        self.consumer = ChannelConsumer()
+        self.consumer.scope = {'user': self.anna}
+        self.consumer.channel_id = 7
+        self.consumer.group_name = 'channel_7'
+        self.consumer.channel_layer = self.layer
+
+    def _signal(self, **data):
+        async_to_sync(self.consumer.receive)(json.dumps({'signal_type': 'offer', 'signal_data': {'sdp': 'v=0'}, **data}))
+        return sorted(target for target, _ in self.layer.sent)
+
+    def test_addressed_signal_goes_to_every_tab_of_recipient(self):
+        direct = metrics._counters['signal_direct_deliveries']
+        self.assertEqual(self._signal(to='Борис'), ['boris-1', 'boris-2'])
+        event = self.layer.sent[0][1]
+        self.assertEqual((event['type'], event['from'], event['to']), ('webrtc.signal', 'Анна', 'Борис'))
+        self.assertEqual(metrics._counters['signal_direct_deliveries'], direct + 2)
+
+    def test_left_tab_is_not_addressed(self):
+        async_to_sync(presence.leave)(7, self.boris, 'boris-2')
+        self.assertEqual(self._signal(to='Борис'), ['boris-1'])
+
+    def test_unknown_recipient_falls_back_to_group(self):
+        fallback = metrics._counters['signal_fallback']
+        self.assertEqual(self._signal(to='Вера'), ['channel_7'])
+        self.assertEqual(metrics._counters['signal_fallback'], fallback + 1)
+
+    def test_signal_without_recipient_goes_to_group(self):
+        self.assertEqual(self._signal(), ['channel_7'])
+
+    def test_group_delivery_skips_other_recipients(self):
+        sent = []
+
+        async def send(text_data):
+            sent.append(json.loads(text_data))
+
+        self.consumer.send = send
+        event = {'type': 'webrtc.signal', 'signal_type': 'offer', 'signal_data': {}, 'from': 'Борис'}
+        async_to_sync(self.consumer.webrtc_signal)({**event, 'to': 'Вера'})
+        async_to_sync(self.consumer.webrtc_signal)({**event, 'to': 'Анна'})
+        self.assertEqual([(m['type'], m['from']) for m in sent], [('signal', 'Борис')])
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class NotificationFanoutTests(TestCase):
+    """
+    Одно уведомление - один group_send в группу аудитории, а сокет получателя состоит в нужных группах.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.group = Group.objects.create(name='ИВТ-1', student_count=30)
+        cls.other_group = Group.objects.create(name='ИВТ-2', student_count=30)
+        cls.teacher = User.objects.create(username='teacher', name='Преподаватель', role='преподаватель')
+        cls.student = User.objects.create(username='student', name='Студент', role='студент', group=cls.group)
+        cls.outsider = User.objects.create(username='outsider', name='Чужой', role='студент', group=cls.other_group)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.layer = RecordingLayer()
+        patcher = mock.patch('communication.utils.notification_sender.get_channel_layer', return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create(self, user, **data):
+        self.client.force_authenticate(user)
+        return self.client.post('/communication/create/', {
+            'title': 'Пара перенесена',
+            'message': 'В 301 аудитории',
+            'image': 'http://localhost:9000/online-school/system/icons/bell.png',
+            **data,
+        }, format='json')
+
+    def test_group_notification_is_one_send_to_study_group(self):
+        response = self._create(self.teacher, group=self.group.id)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.layer.sent), 1)
+        target, event = self.layer.sent[0]
+        self.assertEqual(target, f'notifications_group_{self.group.id}')
+        self.assertEqual(
+            (event['type'], event['id'], event['title']), ('send_notification', response.data['id'], 'Пара перенесена'),
+        )
+        self.assertIn(target, notification_group_names(self.student))
+        self.assertNotIn(target, notification_group_names(self.outsider))
+
+    def test_notification_without_group_goes_to_all_students(self):
+        self.assertEqual(self._create(self.teacher).status_code, 201)
+        self.assertEqual([target for target, _ in self.layer.sent], ['notifications_all'])
+        self.assertIn('notifications_all', notification_group_names(self.student))
+        self.assertIn('notifications_all', notification_group_names(self.outsider))
+
+    def test_student_cannot_send(self):
+        self.assertEqual(self._create(self.student).status_code, 403)
+        self.assertEqual(self.layer.sent, [])
+
+    def test_group_names_by_role(self):
+        self.assertEqual(notification_group_names(self.student), [
+            f'user_notifications_{self.student.id}', 'notifications_all', f'notifications_group_{self.group.id}',
+        ])
+        # Рассылки идут студентам, преподавателю - только личная группа
+        self.assertEqual(notification_group_names(self.teacher), [f'user_notifications_{self.teacher.id}'])
+
+
+class NotificationReplayTests(TransactionTestCase):
+    """
+    Сокет уведомлений: при подключении досылает пропущенное после курсора доставки, при отключении сдвигает курсор.
+    """
+
+    def setUp(self):
+        self.group = Group.objects.create(name='ИВТ-1', student_count=30)
+        other_group = Group.objects.create(name='ИВТ-2', student_count=30)
+        self.student = User.objects.create(username='student', name='Студент', role='студент', group=self.group)
+        self.everyone = self._notify('Всем')
+        self._notify('Чужой группе', other_group)
+        self.own = self._notify('Своей группе', self.group)
+
+    def _notify(self, title, group=None):
+        return Notification.objects.create(title=title, message='текст', image='http://localhost:9000/x.png', group=group)
+
+    def _connect(self):
+        consumer = NotificationConsumer()
+        consumer.scope = {'user': self.student}
+        consumer.channel_name = 'notifications-socket'
+        consumer.channel_layer = RecordingLayer()
+        consumer.sent = []
+
+        async def accept():
+            pass
+
+        async def send(text_data):
+            consumer.sent.append(json.loads(text_data))
+
+        consumer.accept = accept
+        consumer.send = send
+        async_to_sync(consumer.connect)()
+        return consumer
+
+    def _cursor(self):
+        return NotificationCursor.objects.get(user=self.student).delivered_id
+
+    def test_connect_replays_visible_pending(self):
+        consumer = self._connect()
+        self.assertEqual(sorted(consumer.channel_layer.groups), sorted(notification_group_names(self.student)))
+        replay = consumer.sent[0]
+        self.assertEqual(replay['type'], 'notifications_replay')
+        self.assertEqual([item['title'] for item in replay['items']], ['Всем', 'Своей группе'])
+        self.assertEqual((replay['has_more'], replay['unread']), (False, 2))
+        self.assertEqual(self._cursor(), self.own.id)
+
+        # Всё уже доставлено - при переподключении повторять нечего, непрочитанные остаются
+        replay = self._connect().sent[0]
+        self.assertEqual((replay['items'], replay['unread']), ([], 2))
+
+    @override_settings(NOTIFICATIONS={**settings.NOTIFICATIONS, 'REPLAY_LIMIT': 1})
+    def test_replay_is_limited_to_newest(self):
+        replay = self._connect().sent[0]
+        self.assertEqual([item['title'] for item in replay['items']], ['Своей группе'])
+        self.assertTrue(replay['has_more'])
+
+    def test_disconnect_saves_delivered_cursor(self):
+        consumer = self._connect()
+        late = self._notify('Пока сокет открыт', self.group)
+        async_to_sync(consumer.send_notification)({
+            'type': 'send_notification', 'id': late.id, 'created_at': late.created_at.isoformat(),
+            'title': late.title, 'message': late.message, 'image': late.image,
+        })
+        # Живые уведомления пишут курсор только при отключении
+        self.assertEqual(self._cursor(), self.own.id)
+        async_to_sync(consumer.disconnect)(1000)
+        self.assertEqual(self._cursor(), late.id)
+        self.assertEqual(consumer.channel_layer.groups[f'notifications_group_{self.group.id}'], set())
+        self.assertEqual(self._connect().sent[0]['items'], [])
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class FinishSessionTests(TestCase):
+    """
+    transcribe/finish не ждёт распознавания: 202, пока куски в работе, и текст, когда всё готово.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(username='owner', name='Владелец', role='преподаватель')
+
+    def setUp(self):
+        self.queue = mock.Mock()
+        self.queue.has_stream.return_value = True
+        self.queue.next_seq.return_value = 1
+        patcher = mock.patch('communication.utils.transcription_queue.get_queue', return_value=self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        self.session_id = self.client.post('/communication/transcribe/start/').json()['session_id']
+        self.addCleanup(cleanup_session, self.session_id)
+
+    def _finish(self):
+        return self.client.post('/communication/transcribe/finish/', {'session_id': self.session_id})
+
+    def test_pending_chunks_return_202_with_one_final_job(self):
+        self.queue.pending.return_value = 2
+        first = self._finish()
+        second = self._finish()
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(first.json()['pending'], 2)
+        self.assertEqual(second.json()['job_id'], first.json()['job_id'])
+        self.assertEqual(self.queue.submit.call_count, 1)
+        self.assertFalse(Transcript.objects.exists())
+
+    @mock.patch('communication.views.save_file_to_minio', return_value={
+        'file_name': 'transcript.txt', 'path': 'transcripts/transcript.txt', 'url': 'http://minio/transcript.txt',
+    })
+    def test_idle_session_saves_transcript(self, _):
+        with open(session_path(self.session_id), 'w', encoding='utf-8') as f:
+            f.write('текст лекции')
+        self.queue.pending.return_value = 0
+        response = self._finish()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['url'], 'http://minio/transcript.txt')
+        self.assertEqual(Transcript.objects.get().text, 'текст лекции')
+        self.assertFalse(os.path.exists(session_path(self.session_id)))
+
+
+class StreamChunkTests(TestCase):
+    """
+    Куски MediaRecorder с timeslice: без заголовка WebM и с границей посреди кластера - звук не теряется.
+    """
+
+    @staticmethod
+    def _webm(seconds):
+        buffer = io.BytesIO()
+        out = av.open(buffer, 'w', format='webm', options={'live': '1', 'cluster_time_limit': '1000'})
+        stream = out.add_stream('libopus', rate=48000)
+        stream.layout = 'mono'
+        pcm = (0.3 * np.sin(2 * np.pi * 440 * np.arange(48000 * seconds) / 48000)).astype(np.float32)
+        for i in range(0, len(pcm), 960):
+            frame = av.AudioFrame.from_ndarray(pcm[i:i + 960].reshape(1, -1), format='flt', layout='mono')
+            frame.sample_rate = 48000
+            for packet in stream.encode(frame):
+                out.mux(packet)
+        for packet in stream.encode(None):
+            out.mux(packet)
+        out.close()
+        return buffer.getvalue()
+
+    def test_timeslice_chunks_decode_in_sequence(self):
+        data = self._webm(4)
+        full = len(decode_audio(data))
+        # Режем как MediaRecorder: не по границам кластеров
+        cuts = [0, 700, len(data) // 3, len(data) // 3 * 2, len(data)]
+        session_id = uuid.uuid4().hex
+        self.addCleanup(cleanup_session, session_id)
+        state = {'received_samples': 0}
+        buffer = np.zeros(0, dtype=np.float32)
+        for seq, (start, end) in enumerate(zip(cuts, cuts[1:])):
+            job = {'session_id': session_id, 'seq': seq, 'cumulative': '0'}
+            buffer = transcription_stream._append(state, buffer, job, data[start:end], decode_audio)
+        # Декодер на каждом куске стартует заново - допускаем пару кадров Opus на стыках
+        self.assertAlmostEqual(len(buffer), full, delta=full * 0.02)
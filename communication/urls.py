@@ -4,8 +4,11 @@ from . import views
 urlpatterns = [
     path('channels/', views.get_all_channels),
     path('upload/', views.upload_file, name='upload_file'),                                       #загрузка в minio из чата и сгенеренных файлов
+    path('upload/presign/', views.request_upload_url, name='request_upload_url'),                 #ссылка для загрузки прямо в minio из браузера
+    path('upload/confirm/', views.confirm_upload, name='confirm_upload'),                         #подтверждение прямой загрузки, создаёт UploadedFile
     path("create/", views.create_notification, name="create-notification"),                       #создание уведов
     path('list/', views.NotificationsView.as_view(), name='notification-list'),                   #список уведов
+    path('list/read/', views.mark_notifications_read, name='notification-read'),                  #отметить уведы прочитанными до указанного
     path('channels/create/', views.create_channel, name='create_channel'),                        #создание канала
     path('channels/<int:channel_id>/', views.channel_detail),                                     #просмотр инфы по каналу + редакт(для админпанели)
     path('channels/<int:channel_id>/get/', views.get_channel_details, name="get_channel_details"), #чисто просмотр инфы по каналу, чтобы не слетела загрузка сообщений в чате из бд
@@ -13,9 +16,13 @@ urlpatterns = [
     path('channels/<int:channel_id>/join/', views.join_channel),                                  #апи для подключения к каналу
     path('channels/<int:channel_id>/leave/', views.leave_channel),                                #да, но
     path('channels/<int:channel_id>/messages/', views.channel_messages, name='channel-messages'), #чисто сообщения по каналу, возможно стоит убрать сообщения из инфы по каналу(это надо чтобы восстановить историю чата)
+    path('channels/<int:channel_id>/streams/', views.channel_streams, name='channel-streams'),   #снимок состояния потоков (seq + список) для ресинхронизации
+    path('search/', views.search, name='search'),                                                 #поиск по сообщениям и транскриптам
+    path('metrics/', views.realtime_metrics, name='realtime-metrics'),                           #счётчики real-time части (только админ)
     path('gicons/', views.list_minio_icons, name='list_minio_icons'),                             #получение иконок(пока только для уведомлений, там потом что-то придумаем мб)
     path('channels/<int:channel_id>/delete/', views.delete_channel, name='delete_channel'),       #удаление канала
     path('transcribe/start/', views.start_transcription_session, name='start'),                                 #нейронка
     path('transcribe/chunk/', views.upload_transcription, name='divide'),                                  #нейронка
     path('transcribe/finish/', views.finish_transcription_session, name='finish_transcription_session'), #нейронка
+    path('transcribe/jobs/<str:job_id>/', views.transcription_job_status, name='transcription_job_status'), #статус куска в очереди распознавания
 ]
\ No newline at end of file
@@ -0,0 +1,71 @@
+import io
+import os
+import subprocess
+import tempfile
+import wave
+
+import av
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+
+def decode_audio(data: bytes, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    webm/opus (и всё, что умеет libav) -> float32 моно нужной частоты, целиком в памяти.
+    Ровно такой массив Whisper и ждёт, так что ни временных файлов, ни ffmpeg-процесса.
+    """
+    chunks = []
+    with av.open(io.BytesIO(data), mode="r") as container:
+        stream = next((s for s in container.streams if s.type == "audio"), None)
+        if stream is None:
+            raise ValueError("No audio stream")
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=sample_rate)
+        for frame in container.decode(stream):
+            for out in resampler.resample(frame):
+                chunks.append(out.to_ndarray().reshape(-1))
+        # Досливаем то, что осталось внутри ресемплера
+        for out in resampler.resample(None):
+            chunks.append(out.to_ndarray().reshape(-1))
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks).astype(np.float32, copy=False)
+
+
+def convert_webm_to_wav(webm_path, wav_path):
+    command = [
+        "ffmpeg", "-y",
+        "-i", webm_path,
+        "-ar", "16000",
+        "-ac", "1",
+        wav_path,
+
+    ]
+    proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        print(f"FFmpeg error: {proc.stderr.decode('utf-8')}")
+        raise Exception("FFmpeg conversion failed")
+
+
+def decode_audio_ffmpeg(data: bytes) -> np.ndarray:
+    """
+    Старый путь через два временных файла и ffmpeg. Оставлен для сравнения в bench_audio_decode.
+    """
+    tmp_webm = tempfile.NamedTemporaryFile(delete=False, suffix=".webm")
+    tmp_webm.write(data)
+    tmp_webm.close()
+
+    tmp_wav = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
+    tmp_wav.close()
+
+    try:
+        convert_webm_to_wav(tmp_webm.name, tmp_wav.name)
+        with wave.open(tmp_wav.name, "rb") as wav:
+            pcm = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+        return pcm.astype(np.float32) / 32768.0
+    finally:
+        for f in (tmp_webm.name, tmp_wav.name):
+            try:
+                os.remove(f)
+            except Exception as cleanup_error:
+                print(f"⚠️ Ошибка при удалении {f}: {cleanup_error}")
@@ -0,0 +1,135 @@
+import asyncio
+import math
+
+import numpy as np
+from aiortc.mediastreams import MediaStreamError
+from django.conf import settings
+
+from . import speaking
+
+# Громкость и "кто говорит" по звуку, который сервер и так получает в SFU-режиме.
+# Клиентские is_speaking от публикующих звук игнорируются: один источник правды на комнату.
+
+
+class LevelMeter:
+    """
+    RMS дорожки в окнах по AUDIO_LEVELS['WINDOW'] секунд. speaking - громче порога,
+    с задержкой отпускания HANGOVER окон, чтобы паузы между словами не мигали.
+    """
+
+    def __init__(self, track):
+        self.track = track
+        self.level = -100.0
+        self.speaking = False
+        self.task = None
+        self._quiet_windows = 0
+
+    async def run(self):
+        config = settings.AUDIO_LEVELS
+        energy = 0.0
+        samples = 0
+        while True:
+            try:
+                frame = await self.track.recv()
+            except MediaStreamError:
+                return
+            pcm = frame.to_ndarray()
+            if pcm.dtype == np.int16:
+                pcm = pcm.astype(np.float32) / 32768.0
+            pcm = pcm.reshape(-1)
+            energy += float(np.dot(pcm, pcm))
+            samples += pcm.size
+            if samples >= frame.sample_rate * len(frame.layout.channels) * config['WINDOW']:
+                self._update(20 * math.log10(max(math.sqrt(energy / samples), 1e-5)), config)
+                energy = 0.0
+                samples = 0
+
+    def _update(self, level, config):
+        self.level = level
+        if level >= config['THRESHOLD_DB']:
+            self.speaking = True
+            self._quiet_windows = 0
+        elif self.speaking:
+            self._quiet_windows += 1
+            if self._quiet_windows > config['HANGOVER']:
+                self.speaking = False
+
+
+class ActiveSpeakers:
+    """
+    Все публикующие звук в комнате этого процесса. Раз в 1/RATE секунды ранжирует их по громкости,
+    отдаёт изменения is_speaking в коалесер (utils/speaking.py) и, если порядок поменялся,
+    рассылает active_speakers.
+    """
+
+    def __init__(self, room, group_name, channel_layer):
+        self.room = room
+        self.coalescer = speaking.attach(room.channel_id, group_name, channel_layer)
+        self.channel_layer = channel_layer
+        self.group_name = group_name
+        self.meters = {}
+        self.reported = {}
+        self.ranking = []
+        self.task = asyncio.get_running_loop().create_task(self._tick())
+
+    def add(self, user_id, track):
+        self.remove(user_id)
+        meter = LevelMeter(self.room.relay.subscribe(track, buffered=False))
+        meter.task = asyncio.get_running_loop().create_task(meter.run())
+        self.meters[user_id] = meter
+
+    def remove(self, user_id):
+        meter = self.meters.pop(user_id, None)
+        if meter is not None:
+            meter.task.cancel()
+        if self.reported.pop(user_id, False):
+            self.coalescer.report(user_id, False)
+
+    async def _tick(self):
+        config = settings.AUDIO_LEVELS
+        while True:
+            await asyncio.sleep(1 / config['RATE'])
+            try:
+                await self._rank(config)
+            except Exception as e:
+                print(f"[audio_levels] Канал {self.room.channel_id}: {e}")
+
+    async def _rank(self, config):
+        if not self.meters:
+            return
+        user_ids = list(self.meters)
+        levels = np.array([self.meters[u].level for u in user_ids])
+        speaking = np.array([self.meters[u].speaking for u in user_ids])
+
+        for user_id, is_speaking in zip(user_ids, speaking.tolist()):
+            if self.reported.get(user_id, False) != is_speaking:
+                self.reported[user_id] = is_speaking
+                self.coalescer.report(user_id, is_speaking)
+
+        order = np.argsort(-levels, kind="stable")
+        ranking = [user_ids[i] for i in order if speaking[i]][:config['TOP']]
+        if ranking == self.ranking:
+            return
+        self.ranking = ranking
+        await self.channel_layer.group_send(
+            self.group_name,
+            {
+                "type": "active_speakers",
+                "speakers": [{"user_id": u, "level": round(self.meters[u].level, 1)} for u in ranking],
+            }
+        )
+
+    def close(self):
+        self.task.cancel()
+        for user_id in list(self.meters):
+            self.remove(user_id)
+        speaking.detach(self.coalescer)
+
+
+def attach(room, group_name, channel_layer):
+    """
+    Детектор говорящих комнаты; создаётся при первой публикации, закрывается вместе с комнатой.
+    """
+    if room.speakers is None:
+        room.speakers = ActiveSpeakers(room, group_name, channel_layer)
+    return room.speakers
@@ -0,0 +1,64 @@
+import json
+from collections import deque
+
+import redis
+from django.conf import settings
+
+from .redis_client import get_async_redis, mark_redis_down
+
+# Последние CHANNEL_EVENTS['RING_SIZE'] событий канала с номером - ровно в том виде, в каком они ушли клиентам,
+# чтобы переподключившийся с ?since=<seq> получил только пропущенное, а не всю историю.
+# Redis: zset events:<channel_id>, score - seq. Без Redis - кольцо в памяти процесса.
+
+_memory = {}
+
+
+def _key(channel_id):
+    return f"events:{channel_id}"
+
+
+def _memory_ring(channel_id):
+    ring = _memory.get(str(channel_id))
+    if ring is None:
+        ring = _memory[str(channel_id)] = deque(maxlen=settings.CHANNEL_EVENTS['RING_SIZE'])
+    return ring
+
+
+async def aremember(channel_id, seq, event):
+    """
+    Кладёт событие в кольцо. Вызывать до group_send: тогда клиент, который подключается между ними,
+    увидит событие либо в повторе, либо вживую (а может и дважды - он сверяет по seq).
+    """
+    config = settings.CHANNEL_EVENTS
+    client = get_async_redis()
+    if client is not None:
+        try:
+            pipe = client.pipeline()
+            pipe.zadd(_key(channel_id), {json.dumps(event): seq})
+            pipe.zremrangebyrank(_key(channel_id), 0, -config['RING_SIZE'] - 1)
+            pipe.expire(_key(channel_id), config['TTL'])
+            await pipe.execute()
+            return
+        except redis.RedisError as e:
+            print(f"[channel_events] Redis недоступен: {e}")
+            mark_redis_down()
+    _memory_ring(channel_id).append((seq, event))
+
+
+async def areplay(channel_id, since):
+    """
+    (события с seq > since по возрастанию, самый старый seq в кольце или None, если кольцо пусто).
+    """
+    client = get_async_redis()
+    if client is not None:
+        try:
+            pipe = client.pipeline()
+            pipe.zrange(_key(channel_id), 0, 0, withscores=True)
+            pipe.zrangebyscore(_key(channel_id), f"({since}", "+inf")
+            oldest, events = await pipe.execute()
+            return [json.loads(e) for e in events], int(oldest[0][1]) if oldest else None
+        except redis.RedisError as e:
+            print(f"[channel_events] Redis недоступен: {e}")
+            mark_redis_down()
+    ring = _memory_ring(channel_id)
+    return [event for seq, event in ring if seq > since], ring[0][0] if ring else None
@@ -0,0 +1,272 @@
+import asyncio
+import json
+import os
+import socket
+from collections import deque
+from datetime import datetime
+
+import redis
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Max
+
+from . import metrics
+from ..models import Message
+from .redis_client import get_async_redis, mark_redis_down
+
+# Отложенная запись чата: сообщение получает id и seq сразу и сразу рассылается,
+# а в Postgres уходит пачкой bulk_create раз в CHAT_BUFFER['FLUSH_INTERVAL'].
+# Пока сообщение не записано, оно лежит в Redis Stream (chat:journal) и переживает рестарт процесса:
+# неподтверждённые записи умершего процесса забирает XAUTOCLAIM любого другого.
+# Без Redis - список в памяти процесса, при падении процесса такие сообщения теряются.
+
+JOURNAL_KEY = "chat:journal"
+JOURNAL_GROUP = "chat-writers"
+
+_ids = deque()
+_last_id = 0
+_memory = []
+_flusher = None
+_group_ready = False
+
+
+def _reserve_ids(count):
+    """
+    Блок id из последовательности таблицы сообщений: один запрос на CHAT_BUFFER['ID_BLOCK'] сообщений.
+    """
+    global _last_id
+    table = Message._meta.db_table
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", [table, count]
+            )
+            return [row[0] for row in cursor.fetchall()]
+    # Без последовательностей (sqlite при разработке): после максимального id, годится только для одного процесса
+    start = max(_last_id, Message.objects.aggregate(m=Max("id"))["m"] or 0)
+    _last_id = start + count
+    return list(range(start + 1, start + count + 1))
+
+
+async def next_message_id():
+    if not _ids:
+        _ids.extend(await database_sync_to_async(_reserve_ids)(settings.CHAT_BUFFER['ID_BLOCK']))
+    return _ids.popleft()
+
+
+def _to_row(message):
+    return {
+        "id": message.id,
+        "channel_id": message.channel_id,
+        "sender_id": message.sender_id,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+        "uploaded_file_id": message.uploaded_file_id,
+        "seq": message.seq,
+    }
+
+
+def _from_row(row):
+    return Message(
+        id=row["id"],
+        channel_id=row["channel_id"],
+        sender_id=row["sender_id"],
+        content=row["content"],
+        timestamp=datetime.fromisoformat(row["timestamp"]),
+        uploaded_file_id=row["uploaded_file_id"],
+        seq=row["seq"],
+    )
+
+
+async def submit(message):
+    """
+    Ставит сообщение (с уже выданными id и seq) в очередь на запись.
+    """
+    row = _to_row(message)
+    client = get_async_redis()
+    if client is not None:
+        try:
+            await client.xadd(JOURNAL_KEY, {"data": json.dumps(row)})
+            return
+        except redis.RedisError as e:
+            print(f"[chat_buffer] Redis недоступен: {e}")
+            mark_redis_down()
+    _memory.append(row)
+
+
+def _insert(messages):
+    try:
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+        return None
+    except IntegrityError as e:
+        return e
+
+
+def _write_one(message):
+    """
+    Запись одного сообщения, когда пачка не прошла. True - записано.
+    """
+    error = _insert([message])
+    if error is None:
+        return True
+    if Message.objects.filter(pk=message.pk).exists():
+        # Его уже записал другой процесс (забрал запись из журнала, пока этот тормозил) - это не потеря
+        return False
+    if Message.objects.filter(channel_id=message.channel_id, seq=message.seq).exists():
+        # seq выдан второй раз (без Redis у каждого процесса свой счётчик). Сообщение уже разослано и лежит
+        # в кольце повтора под этим seq - новый номер разошёлся бы с ними, поэтому оно не пишется
+        print(f"[chat_buffer] Сообщение {message.id} не записано: seq {message.seq} в канале "
+              f"{message.channel_id} уже занят")
+        metrics.incr("chat_seq_conflicts")
+        return False
+    # Канал или файл успели удалить
+    print(f"[chat_buffer] Сообщение {message.id} не записано: {error}")
+    metrics.incr("chat_dropped")
+    return False
+
+
+def _write(rows):
+    messages = [_from_row(row) for row in rows]
+    # Пачка могла прийти ещё раз (упали между записью в БД и XACK) - уже записанные id пропускаем
+    written = set(Message.objects.filter(id__in=[m.id for m in messages]).values_list("id", flat=True))
+    messages = [m for m in messages if m.id not in written]
+    if not messages:
+        return
+    if _insert(messages) is None:
+        persisted = len(messages)
+    else:
+        persisted = sum(_write_one(message) for message in messages)
+    metrics.incr("chat_persisted", persisted)
+
+
+@database_sync_to_async
+def _last_written_seq(channel_id):
+    return Message.objects.filter(channel_id=channel_id).aggregate(last=Max("seq"))["last"] or 0
+
+
+async def _apending_rows(channel_id):
+    """
+    Ещё не записанные в БД сообщения канала: память процесса и журнал в Redis.
+    """
+    channel_id = int(channel_id)
+    rows = [row for row in _memory if row["channel_id"] == channel_id]
+    client = get_async_redis()
+    if client is None:
+        return rows
+    try:
+        start = "-"
+        while True:
+            entries = await client.xrange(JOURNAL_KEY, min=start, count=1000)
+            for _, fields in entries:
+                row = json.loads(fields[b"data"])
+                if row["channel_id"] == channel_id:
+                    rows.append(row)
+            if len(entries) < 1000:
+                return rows
+            start = f"({entries[-1][0].decode()}"
+    except redis.RedisError as e:
+        print(f"[chat_buffer] Redis недоступен: {e}")
+        mark_redis_down()
+        return rows
+
+
+async def alast_seq(channel_id):
+    """
+    Последний seq сообщений канала: в БД и ещё не записанных (журнал, память процесса).
+    С него продолжается счётчик, который потерял Redis, - иначе новые сообщения получили бы уже разосланные номера.
+    """
+    rows = await _apending_rows(channel_id)
+    return max([await _last_written_seq(channel_id)] + [row["seq"] or 0 for row in rows])
+
+
+async def aunflushed(channel_id, since, before):
+    """
+    Ещё не записанные сообщения канала с since < seq < before, по возрастанию seq (для повтора из БД).
+    """
+    rows = [row for row in await _apending_rows(channel_id) if since < (row["seq"] or 0) < before]
+    return [_from_row(row) for row in sorted(rows, key=lambda row: row["seq"])]
+
+
+async def _ensure_group(client):
+    global _group_ready
+    if _group_ready:
+        return
+    try:
+        await client.xgroup_create(JOURNAL_KEY, JOURNAL_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+    _group_ready = True
+
+
+async def _read_journal(client, consumer, batch):
+    await _ensure_group(client)
+    # Свои неподтверждённые (запись в БД в прошлый раз не прошла), потом брошенные умершими процессами, потом новые
+    entries = []
+    for _, items in await client.xreadgroup(JOURNAL_GROUP, consumer, {JOURNAL_KEY: "0"}, count=batch):
+        entries += items
+    if len(entries) < batch:
+        claimed = await client.xautoclaim(
+            JOURNAL_KEY, JOURNAL_GROUP, consumer,
+            min_idle_time=settings.CHAT_BUFFER['CLAIM_IDLE'] * 1000, start_id="0-0", count=batch - len(entries),
+        )
+        entries += claimed[1]
+    if len(entries) < batch:
+        for _, items in await client.xreadgroup(JOURNAL_GROUP, consumer, {JOURNAL_KEY: ">"}, count=batch - len(entries)):
+            entries += items
+    return [(entry_id, fields) for entry_id, fields in entries if fields]
+
+
+async def flush(consumer):
+    global _group_ready
+    batch = settings.CHAT_BUFFER['BATCH_SIZE']
+
+    if _memory:
+        rows = _memory[:batch]
+        del _memory[:batch]
+        try:
+            await database_sync_to_async(_write)(rows)
+        except Exception:
+            _memory[:0] = rows
+            raise
+
+    client = get_async_redis()
+    if client is None:
+        return
+    try:
+        while True:
+            entries = await _read_journal(client, consumer, batch)
+            if not entries:
+                return
+            await database_sync_to_async(_write)([json.loads(fields[b"data"]) for _, fields in entries])
+            ids = [entry_id for entry_id, _ in entries]
+            await client.xack(JOURNAL_KEY, JOURNAL_GROUP, *ids)
+            await client.xdel(JOURNAL_KEY, *ids)
+            if len(entries) < batch:
+                return
+    except redis.RedisError as e:
+        print(f"[chat_buffer] Redis недоступен: {e}")
+        mark_redis_down()
+        # Redis мог перезапуститься без данных - группу создадим заново
+        _group_ready = False
+
+
+async def _flush_forever():
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    while True:
+        await asyncio.sleep(settings.CHAT_BUFFER['FLUSH_INTERVAL'])
+        try:
+            await flush(consumer)
+        except Exception as e:
+            print(f"[chat_buffer] Запись пачки не прошла: {e}")
+
+
+def start_flusher():
+    """
+    Запускает фоновую запись сообщений в текущем event loop (один раз на процесс).
+    """
+    global _flusher
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.get_running_loop().create_task(_flush_forever())
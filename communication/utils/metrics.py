@@ -0,0 +1,78 @@
+import asyncio
+import threading
+from collections import Counter
+
+import redis
+
+from .redis_client import get_async_redis, get_redis, mark_redis_down
+
+# Простые счётчики событий real-time части (сколько пришло / сколько разослали и т.п.).
+# Каждый процесс копит у себя и раз в FLUSH_INTERVAL сливает прирост в общий hash в Redis.
+
+METRICS_KEY = "metrics:counters"
+FLUSH_INTERVAL = 5
+
+_counters = Counter()
+_unflushed = Counter()
+_lock = threading.Lock()
+_flusher = None
+
+
+def incr(name, n=1):
+    if not n:
+        return
+    with _lock:
+        _counters[name] += n
+        _unflushed[name] += n
+
+
+async def aflush():
+    with _lock:
+        delta = dict(_unflushed)
+        _unflushed.clear()
+    client = get_async_redis()
+    if not delta or client is None:
+        return
+    try:
+        pipe = client.pipeline()
+        for name, n in delta.items():
+            pipe.hincrby(METRICS_KEY, name, n)
+        await pipe.execute()
+    except redis.RedisError as e:
+        print(f"[metrics] Redis недоступен: {e}")
+        mark_redis_down()
+        # Вернём обратно, сольём в следующий раз
+        with _lock:
+            _unflushed.update(delta)
+
+
+async def _flush_forever():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await aflush()
+
+
+def start_flusher():
+    """
+    Запускает фоновый слив счётчиков в текущем event loop (один раз на процесс).
+    """
+    global _flusher
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.get_running_loop().create_task(_flush_forever())
+
+
+def snapshot():
+    """
+    {"process": счётчики этого процесса, "total": сумма по всем процессам из Redis или None}
+    """
+    with _lock:
+        local = dict(_counters)
+    total = None
+    client = get_redis()
+    if client is not None:
+        try:
+            total = {k.decode(): int(v) for k, v in client.hgetall(METRICS_KEY).items()}
+        except redis.RedisError as e:
+            print(f"[metrics] Redis недоступен: {e}")
+            mark_redis_down()
+    return {"process": local, "total": total}
@@ -1,8 +1,18 @@
 from minio import Minio
 from django.conf import settings
 from uuid import uuid4
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from minio.error import S3Error
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from functools import partial
+import asyncio
+import hashlib
+import queue
+import threading
+import time
+import redis
+from .redis_client import get_redis, mark_redis_down
 
 minio_config = settings.MINIO_STORAGE
 
@@ -16,6 +26,20 @@ client = Minio(
 bucket_name = minio_config['BUCKET_NAME']
 _checked_buckets = set()
 
+_url_cache = OrderedDict()
+_url_cache_lock = threading.Lock()
+
+# Короткие вызовы MinIO из async-кода (подпись ссылок в ChannelConsumer) идут через этот пул:
+# медленный MinIO занимает не больше MAX_WORKERS потоков и никогда не держит event loop.
+# Синхронные вьюхи зовут MinIO напрямую - их поток всё равно ждёт ответа.
+_executor = ThreadPoolExecutor(max_workers=minio_config.get('MAX_WORKERS', 8), thread_name_prefix='minio')
+
+# Потоковая загрузка держит поток всё время, пока идёт файл, поэтому у неё свой пул:
+# несколько долгих загрузок не должны отнимать потоки у коротких вызовов из _executor
+_stream_executor = ThreadPoolExecutor(
+    max_workers=minio_config.get('STREAM_MAX_WORKERS', 16), thread_name_prefix='minio-stream',
+)
+
 
 def ensure_bucket_exists(bucket):
     if bucket in _checked_buckets:
@@ -29,15 +53,12 @@ def ensure_bucket_exists(bucket):
         raise
 
 
-def save_file_to_minio(file, user=None, file_type='user_upload', subject_name=None):
-    # Проверка на наличие файла
-    if file is None:
-        raise ValueError("File is not provided or is invalid")
-
-    ensure_bucket_exists(bucket_name)
-
+def build_object_path(file_name, file_type='user_upload', subject_name=None):
+    """
+    Раскладывает файл по папкам бакета в зависимости от типа. Возвращает (path, filename).
+    """
     # Извлекаем расширение файла, если оно существует
-    ext = file.name.split('.')[-1] if '.' in file.name else 'unknown'
+    ext = file_name.split('.')[-1] if '.' in file_name else 'unknown'
 
     if file_type == 'lecture':
         date_str = datetime.now().strftime('%d.%m.%Y')
@@ -60,6 +81,54 @@ def save_file_to_minio(file, user=None, file_type='user_upload', subject_name=No
         filename = f"{uuid4()}.{ext}"
         path = f"uploads/users/{filename}"
 
+    return path, filename
+
+
+def get_download_url(path, file_name):
+    """
+    Временная ссылка на скачивание (7 дней) с исходным именем файла, None если MinIO ругнулся.
+    """
+    try:
+        expires = timedelta(days=7)
+        return get_presigned_url(path, expires=expires, response_headers={
+            "response-content-disposition": f'attachment; filename="{file_name}"'
+        })
+    except S3Error as e:
+        print(f"MinIO error while generating presigned URL for '{path}': {e}")
+        return None
+
+
+def get_upload_url(path, expires=None):
+    """
+    presigned PUT, чтобы браузер грузил файл прямо в MinIO, минуя Django.
+    """
+    ensure_bucket_exists(bucket_name)
+    expires = expires or timedelta(seconds=minio_config.get('UPLOAD_URL_EXPIRES', 15 * 60))
+    return client.presigned_put_object(bucket_name, path, expires=expires)
+
+
+def get_object_size(path):
+    """
+    Размер объекта в байтах или None, если такого объекта нет.
+    """
+    try:
+        return client.stat_object(bucket_name, path).size
+    except S3Error as e:
+        if e.code in ('NoSuchKey', 'NoSuchObject'):
+            return None
+        print(f"MinIO error while checking object '{path}': {e}")
+        raise
+
+
+def save_file_to_minio(file, user=None, file_type='user_upload', subject_name=None):
+    # Проверка на наличие файла
+    if file is None:
+        raise ValueError("File is not provided or is invalid")
+
+    ensure_bucket_exists(bucket_name)
+
+    path, filename = build_object_path(file.name, file_type, subject_name)
+
     try:
         client.put_object(
             bucket_name,
@@ -72,21 +141,10 @@ def save_file_to_minio(file, user=None, file_type='user_upload', subject_name=No
         print(f"MinIO error while uploading file '{filename}': {e}")
         raise
 
-
-    # Генерация временной ссылки, живущей 7 дней
-    try:
-        expires = timedelta(days=7)
-        presigned_url = client.presigned_get_object(bucket_name, path, expires=expires, response_headers={
-            "response-content-disposition": f'attachment; filename="{file.name}"'
-        })
-    except S3Error as e:
-        print(f"MinIO error while generating presigned URL for '{path}': {e}")
-        presigned_url = None
-
     return {
         "path": path,
         "file_name": file.name,
-        "url": presigned_url,
+        "url": get_download_url(path, file.name),
     }
 
 def get_presigned_icon_url(object_path: str, expires_days: int = 1) -> str | None:
@@ -99,8 +157,198 @@ def get_presigned_icon_url(object_path: str, expires_days: int = 1) -> str | Non
     """
     try:
         expires = timedelta(days=expires_days)
-        presigned_url = client.presigned_get_object(bucket_name, object_path, expires=expires)
+        presigned_url = get_presigned_url(object_path, expires=expires)
         return presigned_url
     except S3Error as e:
         print(f"MinIO error while generating presigned URL for '{object_path}': {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+def get_presigned_url(object_path: str, expires: timedelta = timedelta(days=7), response_headers: dict | None = None) -> str:
+    """
+    presigned GET с кэшем, чтобы не гонять HMAC-подпись на каждый файл в каждом запросе истории.
+
+    Время делится на окна по PRESIGNED_URL_CACHE['PERIOD'] секунд, ссылка подписывается датой
+    начала окна (request_date), поэтому в пределах окна она одинаковая во всех процессах
+    и у неё остаётся не меньше expires - PERIOD жизни. Кэш - память процесса + Redis, если он есть.
+    Ошибки MinIO (S3Error) пробрасываются как раньше.
+    """
+    cache_config = settings.PRESIGNED_URL_CACHE
+    expires_seconds = int(expires.total_seconds())
+    period = max(1, min(cache_config['PERIOD'], expires_seconds // 2))
+    now = time.time()
+    window_start = int(now // period) * period
+    key = (object_path, expires_seconds, tuple(sorted((response_headers or {}).items())), window_start)
+
+    with _url_cache_lock:
+        url = _url_cache.get(key)
+        if url is not None:
+            _url_cache.move_to_end(key)
+            return url
+
+    redis_client = get_redis()
+    redis_key = "presign:" + hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+    url = None
+    if redis_client is not None:
+        try:
+            cached = redis_client.get(redis_key)
+            url = cached.decode("utf-8") if cached else None
+        except redis.RedisError as e:
+            print(f"Redis error while reading presigned URL cache: {e}")
+            mark_redis_down()
+            redis_client = None
+
+    if url is None:
+        url = client.presigned_get_object(
+            bucket_name,
+            object_path,
+            expires=expires,
+            response_headers=response_headers,
+            request_date=datetime.fromtimestamp(window_start, tz=timezone.utc),
+        )
+        if redis_client is not None:
+            try:
+                redis_client.set(redis_key, url, ex=max(1, int(window_start + period - now)))
+            except redis.RedisError as e:
+                print(f"Redis error while writing presigned URL cache: {e}")
+                mark_redis_down()
+
+    with _url_cache_lock:
+        _url_cache[key] = url
+        # Ключи прошлых окон никто больше не спросит - они вытесняются первыми
+        while len(_url_cache) > cache_config['MAX_ENTRIES']:
+            _url_cache.popitem(last=False)
+    return url
+
+
+async def _run_in_minio_pool(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+async def aget_presigned_url(object_path: str, expires: timedelta = timedelta(days=7), response_headers: dict | None = None) -> str:
+    return await _run_in_minio_pool(get_presigned_url, object_path, expires=expires, response_headers=response_headers)
+
+
+_EOF = object()
+_ABORT = object()
+
+
+class MinioStreamWriter:
+    """
+    Запись объекта в MinIO кусками, когда размер заранее неизвестен.
+
+    put_object(length=-1) крутится в пуле потоковых загрузок (или в переданном executor) и читает
+    из ограниченной очереди, которую наполняет write(). Если MinIO не успевает, очередь заполняется
+    и write() блокируется - это и есть back-pressure. В памяти одновременно не больше одной
+    части (PART_SIZE) и STREAM_QUEUE_CHUNKS кусков в очереди.
+
+    Если пул занят и загрузка не началась за STREAM_START_TIMEOUT, или вся загрузка дольше timeout
+    (по умолчанию STREAM_TOTAL_TIMEOUT), write()/close() обрывают её и бросают IOError.
+    """
+
+    def __init__(self, path, content_type='application/octet-stream', part_size=None, timeout=None, executor=None):
+        ensure_bucket_exists(bucket_name)
+        self.path = path
+        self.size = 0
+        self._queue = queue.Queue(maxsize=minio_config.get('STREAM_QUEUE_CHUNKS', 32))
+        self._idle_timeout = minio_config.get('STREAM_IDLE_TIMEOUT', 60)
+        self._leftover = b""
+        self._eof = False
+        self._started = threading.Event()
+        now = time.monotonic()
+        self._start_deadline = now + minio_config.get('STREAM_START_TIMEOUT', 10)
+        self._deadline = now + (timeout or minio_config.get('STREAM_TOTAL_TIMEOUT', 3600))
+        self._future = (executor or _stream_executor).submit(
+            self._upload,
+            length=-1,
+            content_type=content_type or 'application/octet-stream',
+            part_size=part_size or minio_config.get('PART_SIZE', 8 * 1024 * 1024),
+            num_parallel_uploads=1,  # иначе minio копит части в своей очереди и память уже не ограничена
+        )
+
+    def _upload(self, **kwargs):
+        self._started.set()
+        return client.put_object(bucket_name, self.path, self, **kwargs)
+
+    def _check_deadlines(self):
+        now = time.monotonic()
+        if not self._started.is_set() and now > self._start_deadline:
+            self.abort()
+            raise IOError(f"upload of '{self.path}' did not start: no free MinIO stream slot")
+        if now > self._deadline:
+            self.abort()
+            raise IOError(f"upload of '{self.path}' timed out")
+
+    def read(self, size=-1):
+        # Вызывается minio из потока пула: собираем кусок целиком, чтобы minio не склеивал bytes по 64 КБ
+        chunks = [self._leftover] if self._leftover else []
+        have = len(self._leftover)
+        self._leftover = b""
+        while not self._eof and (size < 0 or have < size):
+            try:
+                item = self._queue.get(timeout=self._idle_timeout)
+            except queue.Empty:
+                raise IOError(f"upload of '{self.path}' stalled")
+            if item is _ABORT:
+                raise IOError(f"upload of '{self.path}' aborted")
+            if item is _EOF:
+                self._eof = True
+                break
+            chunks.append(item)
+            have += len(item)
+        data = b"".join(chunks)
+        if size >= 0 and len(data) > size:
+            self._leftover = data[size:]
+            data = data[:size]
+        return data
+
+    def _put(self, item):
+        while True:
+            if self._future.done():
+                # Загрузка уже упала - отдаём её ошибку вызывающему
+                self._future.result()
+                raise IOError(f"upload of '{self.path}' already finished")
+            self._check_deadlines()
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        if data:
+            self._put(bytes(data))
+            self.size += len(data)
+
+    def close(self):
+        """
+        Дописывает объект и ждёт завершения multipart. Возвращает результат put_object.
+        """
+        self._put(_EOF)
+        while True:
+            try:
+                return self._future.result(timeout=1)
+            except FutureTimeout:
+                self._check_deadlines()
+
+    def abort(self):
+        """
+        Обрывает загрузку: minio сам отменяет незавершённый multipart.
+        """
+        # Ещё не начатую загрузку просто снимаем с очереди пула
+        if self._future.done() or self._future.cancel():
+            return
+        try:
+            self._queue.put_nowait(_ABORT)
+        except queue.Full:
+            # Читатель занят - освобождаем место под сигнал
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._queue.put_nowait(_ABORT)
+        try:
+            self._future.result()
+        except Exception:
+            pass
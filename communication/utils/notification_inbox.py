@@ -0,0 +1,55 @@
+from django.db import models
+
+from ..models import Notification, NotificationCursor
+
+# Входящие уведомления пользователя: что ему видно, что прочитано и что уже доставлено по сокету.
+# Курсоры - пара (created_at, id), те же, что у keyset-пагинации (utils/pagination.py).
+
+
+def visible_notifications(user):
+    if user.role == "студент":
+        return Notification.objects.filter(models.Q(group__isnull=True) | models.Q(group=user.group_id))
+    return Notification.objects.all()
+
+
+def newer_than(queryset, created_at, pk):
+    """
+    Уведомления строго после позиции (created_at, pk). Без позиции - все.
+    """
+    if created_at is None:
+        return queryset
+    return queryset.filter(created_at__gte=created_at).filter(
+        models.Q(created_at__gt=created_at) | models.Q(created_at=created_at, id__gt=pk)
+    )
+
+
+def get_cursor(user):
+    cursor, _ = NotificationCursor.objects.get_or_create(user=user)
+    return cursor
+
+
+def unread_count(user, cursor=None):
+    cursor = cursor or get_cursor(user)
+    return newer_than(visible_notifications(user), cursor.read_at, cursor.read_id).count()
+
+
+def is_after(created_at, pk, cursor_at, cursor_id):
+    return cursor_at is None or (created_at, pk) > (cursor_at, cursor_id)
+
+
+def mark_read(user, notification):
+    """
+    Всё до notification включительно считается прочитанным. Курсор только двигается вперёд.
+    """
+    cursor = get_cursor(user)
+    if is_after(notification.created_at, notification.id, cursor.read_at, cursor.read_id):
+        cursor.read_at, cursor.read_id = notification.created_at, notification.id
+        cursor.save(update_fields=['read_at', 'read_id'])
+    return cursor
+
+
+def mark_delivered(user, created_at, pk):
+    cursor = get_cursor(user)
+    if is_after(created_at, pk, cursor.delivered_at, cursor.delivered_id):
+        cursor.delivered_at, cursor.delivered_id = created_at, pk
+        cursor.save(update_fields=['delivered_at', 'delivered_id'])
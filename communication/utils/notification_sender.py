@@ -1,22 +1,48 @@
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-from accounts.models import User
+
+# Сокет уведомлений студента сразу состоит в группах channels своей учебной группы и "всех студентов"
+# (см. NotificationConsumer), поэтому одно уведомление - один group_send, сколько бы ни было получателей.
+
+ALL_STUDENTS_GROUP = "notifications_all"
+
+
+def user_group_name(user_id):
+    return f"user_notifications_{user_id}"
+
+
+def study_group_name(group_id):
+    return f"notifications_group_{group_id}"
+
+
+def notification_group_names(user):
+    """
+    Все группы channels, в которые входит сокет уведомлений пользователя.
+    """
+    names = [user_group_name(user.id)]
+    if user.role == "студент":
+        names.append(ALL_STUDENTS_GROUP)
+        if user.group_id:
+            names.append(study_group_name(user.group_id))
+    return names
+
+
+def notification_target(notification):
+    if notification.group_id:
+        return study_group_name(notification.group_id)
+    return ALL_STUDENTS_GROUP
+
 
 def notify_group_users(notification):
     channel_layer = get_channel_layer()
-
-    if notification.group:
-        users = User.objects.filter(role="студент", group=notification.group)
-    else:
-        users = User.objects.filter(role="студент")
-
-    for user in users:
-        async_to_sync(channel_layer.group_send)(
-            f"user_notifications_{user.id}",
-            {
-                "type": "send_notification",
-                "title": notification.title,
-                "message": notification.message,
-                "image": notification.image,
-            }
-        )
+    async_to_sync(channel_layer.group_send)(
+        notification_target(notification),
+        {
+            "type": "send_notification",
+            "id": notification.id,
+            "created_at": notification.created_at.isoformat(),
+            "title": notification.title,
+            "message": notification.message,
+            "image": notification.image,
+        }
+    )
@@ -0,0 +1,102 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+
+def encode_cursor(value: datetime, pk: int) -> str:
+    """
+    Кодирует позицию (время, id) в непрозрачную строку для клиента.
+    """
+    raw = f"{value.isoformat()}|{pk}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Обратная операция к encode_cursor. Бросает ValueError на мусорном курсоре.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+        value, pk = raw.rsplit("|", 1)
+        return datetime.fromisoformat(value), int(pk)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def parse_limit(raw, default: int, maximum: int) -> int:
+    if raw in (None, ""):
+        return default
+    try:
+        limit = int(raw)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid limit")
+    if limit < 1:
+        raise ValueError("Invalid limit")
+    return min(limit, maximum)
+
+
+def _older(queryset, field, value, pk, inclusive=False):
+    # Лишнее условие field__lte нужно, чтобы индекс (..., field, id) начинал скан сразу с якоря
+    id_lookup = "id__lte" if inclusive else "id__lt"
+    return queryset.filter(**{f"{field}__lte": value}).filter(
+        Q(**{f"{field}__lt": value}) | Q(**{field: value, id_lookup: pk})
+    ).order_by(f"-{field}", "-id")
+
+
+def _newer(queryset, field, value, pk, inclusive=False):
+    id_lookup = "id__gte" if inclusive else "id__gt"
+    return queryset.filter(**{f"{field}__gte": value}).filter(
+        Q(**{f"{field}__gt": value}) | Q(**{field: value, id_lookup: pk})
+    ).order_by(field, "id")
+
+
+def keyset_paginate(queryset, field, limit, before=None, after=None, around=None):
+    """
+    Keyset-пагинация по паре (field, id) вместо OFFSET.
+
+    before/after/around - курсоры из encode_cursor, задать можно только один.
+    Без курсора отдаются последние `limit` записей. Элементы всегда
+    возвращаются по возрастанию (field, id), как их показывает чат.
+    """
+    anchors = [c for c in (before, after, around) if c]
+    if len(anchors) > 1:
+        raise ValueError("Only one of before/after/around is allowed")
+
+    has_more_before = has_more_after = False
+
+    if before:
+        value, pk = decode_cursor(before)
+        items = list(_older(queryset, field, value, pk)[:limit + 1])
+        has_more_before = len(items) > limit
+        items = items[:limit][::-1]
+        # По ту сторону курсора - сам якорь и всё новее, если их не удалили; проверяем одной строкой
+        has_more_after = _newer(queryset, field, value, pk, inclusive=True).exists()
+    elif after:
+        value, pk = decode_cursor(after)
+        items = list(_newer(queryset, field, value, pk)[:limit + 1])
+        has_more_after = len(items) > limit
+        items = items[:limit]
+        has_more_before = _older(queryset, field, value, pk, inclusive=True).exists()
+    elif around:
+        value, pk = decode_cursor(around)
+        older_limit = limit // 2
+        newer_limit = limit - older_limit
+        older = list(_older(queryset, field, value, pk)[:older_limit + 1])
+        newer = list(_newer(queryset, field, value, pk, inclusive=True)[:newer_limit + 1])
+        has_more_before = len(older) > older_limit
+        has_more_after = len(newer) > newer_limit
+        items = older[:older_limit][::-1] + newer[:newer_limit]
+    else:
+        items = list(queryset.order_by(f"-{field}", "-id")[:limit + 1])
+        has_more_before = len(items) > limit
+        items = items[:limit][::-1]
+
+    return {
+        "items": items,
+        "before": encode_cursor(getattr(items[0], field), items[0].pk) if items else None,
+        "after": encode_cursor(getattr(items[-1], field), items[-1].pk) if items else None,
+        "has_more_before": has_more_before,
+        "has_more_after": has_more_after,
+    }
@@ -0,0 +1,227 @@
+import time
+
+import redis
+from django.conf import settings
+
+from .redis_client import get_async_redis, mark_redis_down
+
+# Кто сейчас онлайн в канале. Хранится по соединениям, а не по пользователям:
+# один человек может сидеть с двух вкладок, и уходит он, только когда закрыл последнюю.
+#
+# presence:<channel_id>:conns  - zset "<user_id>|<channel_name>" -> когда соединение протухнет
+# presence:<channel_id>:counts - hash user_id -> сколько у него живых соединений
+# presence:<channel_id>:names  - hash user_id -> имя для рассылки
+# presence:<channel_id>:route:<name> - set channel_name соединений пользователя (адрес для сигналинга WebRTC)
+
+# Убирает соединение и уменьшает счётчик только если соединение ещё было в zset,
+# чтобы disconnect и чистка протухших не вычли одно и то же дважды.
+# -1 - соединения уже нет, 0 - это было последнее соединение пользователя, >0 - осталось столько.
+_LEAVE_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return -1
+end
+redis.call('SREM', KEYS[4], ARGV[3])
+local left = redis.call('HINCRBY', KEYS[2], ARGV[2], -1)
+if left <= 0 then
+    redis.call('HDEL', KEYS[2], ARGV[2])
+    redis.call('HDEL', KEYS[3], ARGV[2])
+    return 0
+end
+return left
+"""
+
+
+def _keys(channel_id):
+    base = f"presence:{channel_id}"
+    return f"{base}:conns", f"{base}:counts", f"{base}:names"
+
+
+def _route_key(channel_id, name):
+    return f"presence:{channel_id}:route:{name}"
+
+
+def _member(user_id, conn):
+    return f"{user_id}|{conn}"
+
+
+class MemoryPresence:
+    """
+    То же самое в памяти процесса: для разработки и на время, пока Redis лежит.
+    Видит только соединения своего процесса.
+    """
+
+    def __init__(self):
+        self._conns = {}
+        self._counts = {}
+        self._names = {}
+        self._routes = {}
+
+    def _channel(self, channel_id):
+        return (
+            self._conns.setdefault(channel_id, {}),
+            self._counts.setdefault(channel_id, {}),
+            self._names.setdefault(channel_id, {}),
+        )
+
+    async def join(self, channel_id, user_id, name, conn, ttl):
+        conns, counts, names = self._channel(channel_id)
+        conns[_member(user_id, conn)] = time.time() + ttl
+        counts[str(user_id)] = counts.get(str(user_id), 0) + 1
+        names[str(user_id)] = name
+        self._routes.setdefault(channel_id, {}).setdefault(name, set()).add(conn)
+        return counts[str(user_id)] == 1
+
+    async def leave(self, channel_id, user_id, name, conn):
+        conns, counts, names = self._channel(channel_id)
+        if conns.pop(_member(user_id, conn), None) is None:
+            return False
+        routes = self._routes.get(channel_id, {})
+        routes.get(name, set()).discard(conn)
+        if not routes.get(name, True):
+            del routes[name]
+        counts[str(user_id)] -= 1
+        if counts[str(user_id)] > 0:
+            return False
+        del counts[str(user_id)]
+        names.pop(str(user_id), None)
+        return True
+
+    async def touch(self, channel_id, user_id, name, conn, ttl):
+        conns, _, _ = self._channel(channel_id)
+        member = _member(user_id, conn)
+        if member in conns:
+            conns[member] = time.time() + ttl
+
+    async def expired(self, channel_id):
+        conns, _, names = self._channel(channel_id)
+        now = time.time()
+        return [(m, names.get(m.split("|", 1)[0], "")) for m, exp in conns.items() if exp <= now]
+
+    async def members(self, channel_id):
+        _, _, names = self._channel(channel_id)
+        return dict(names)
+
+    async def routes(self, channel_id, name):
+        return set(self._routes.get(channel_id, {}).get(name, ()))
+
+
+class RedisPresence:
+    """
+    Реестр в Redis: общий для всех процессов daphne, O(1) команд на соединение.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._leave = client.register_script(_LEAVE_SCRIPT)
+
+    async def join(self, channel_id, user_id, name, conn, ttl):
+        conns, counts, names = _keys(channel_id)
+        pipe = self.client.pipeline()
+        pipe.zadd(conns, {_member(user_id, conn): time.time() + ttl})
+        pipe.hincrby(counts, user_id, 1)
+        pipe.hset(names, user_id, name)
+        pipe.sadd(_route_key(channel_id, name), conn)
+        # Если канал опустел и его никто не чистит, ключи уйдут сами
+        for key in (conns, counts, names, _route_key(channel_id, name)):
+            pipe.expire(key, int(ttl * 10))
+        result = await pipe.execute()
+        return result[1] == 1
+
+    async def leave(self, channel_id, user_id, name, conn):
+        conns, counts, names = _keys(channel_id)
+        left = await self._leave(
+            keys=[conns, counts, names, _route_key(channel_id, name)],
+            args=[_member(user_id, conn), user_id, conn],
+        )
+        return left == 0
+
+    async def touch(self, channel_id, user_id, name, conn, ttl):
+        conns, counts, names = _keys(channel_id)
+        pipe = self.client.pipeline()
+        pipe.zadd(conns, {_member(user_id, conn): time.time() + ttl}, xx=True)
+        for key in (conns, counts, names, _route_key(channel_id, name)):
+            pipe.expire(key, int(ttl * 10))
+        await pipe.execute()
+
+    async def expired(self, channel_id):
+        conns, _, names = _keys(channel_id)
+        stale = await self.client.zrangebyscore(conns, "-inf", time.time())
+        if not stale:
+            return []
+        stale = [m.decode() for m in stale]
+        user_names = await self.client.hmget(names, [m.split("|", 1)[0] for m in stale])
+        return [(m, (n or b"").decode()) for m, n in zip(stale, user_names)]
+
+    async def members(self, channel_id):
+        _, _, names = _keys(channel_id)
+        raw = await self.client.hgetall(names)
+        return {k.decode(): v.decode() for k, v in raw.items()}
+
+    async def routes(self, channel_id, name):
+        return {c.decode() for c in await self.client.smembers(_route_key(channel_id, name))}
+
+
+_memory = MemoryPresence()
+_redis_presence = None
+
+
+def _backend():
+    global _redis_presence
+    client = get_async_redis()
+    if client is None:
+        return _memory
+    if _redis_presence is None or _redis_presence.client is not client:
+        _redis_presence = RedisPresence(client)
+    return _redis_presence
+
+
+async def _call(method, *args):
+    backend = _backend()
+    try:
+        return await getattr(backend, method)(*args)
+    except redis.RedisError as e:
+        print(f"[presence] Redis недоступен, работаем из памяти: {e}")
+        mark_redis_down()
+        return await getattr(_memory, method)(*args)
+
+
+async def join(channel_id, user, conn):
+    """
+    Регистрирует соединение. True - пользователь только что появился в канале (первая вкладка).
+    """
+    return await _call("join", channel_id, str(user.id), user.name, conn, settings.PRESENCE['TTL'])
+
+
+async def leave(channel_id, user, conn):
+    """
+    Снимает соединение. True - это была последняя вкладка, пользователь ушёл.
+    """
+    return await _call("leave", channel_id, str(user.id), user.name, conn)
+
+
+async def heartbeat(channel_id, user, conn):
+    """
+    Продлевает соединение и вычищает чужие протухшие (упавший процесс daphne не зовёт disconnect).
+    Возвращает имена пользователей, которые из-за этого ушли из канала.
+    """
+    await _call("touch", channel_id, str(user.id), user.name, conn, settings.PRESENCE['TTL'])
+    gone = []
+    for member, name in await _call("expired", channel_id):
+        user_id, stale_conn = member.split("|", 1)
+        if await _call("leave", channel_id, user_id, name, stale_conn):
+            gone.append(name)
+    return gone
+
+
+async def members(channel_id):
+    """
+    Кто сейчас в канале: {user_id: имя}.
+    """
+    return await _call("members", channel_id)
+
+
+async def routes(channel_id, name):
+    """
+    channel_name всех живых соединений пользователя с таким именем - чтобы слать ему напрямую, а не группе.
+    """
+    return await _call("routes", channel_id, name)
@@ -0,0 +1,193 @@
+import asyncio
+import fractions
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import av
+from aiortc.mediastreams import MediaStreamError
+from django.conf import settings
+
+from . import metrics
+from .minio_client import MinioStreamWriter, build_object_path
+
+# Запись лекции на сервере: дорожки публикации из SFU-комнаты кодируются в фрагментированный MP4
+# (moov в начале, дальше moof+mdat на каждом ключевом кадре) и сразу уходят в MinIO частями multipart.
+# В памяти - только очередь кадров (RECORDING['QUEUE_FRAMES']) и одна часть загрузки, сколько бы ни шла лекция.
+
+_STOP = object()
+VIDEO_TIME_BASE = fractions.Fraction(1, 90000)
+
+
+class LectureRecorder:
+    def __init__(self, room, publisher_id, owner_id, file_name="lecture.mp4", subject_name=None):
+        publisher = room.publishers.get(publisher_id)
+        if publisher is None or not publisher.tracks:
+            raise LookupError("Publisher not found")
+        self.channel_id = room.channel_id
+        self.publisher_id = publisher_id
+        self.owner_id = owner_id
+        self.path, self.file_name = build_object_path(file_name, 'lecture', subject_name)
+        # Небуферизованная подписка: relay держит только последний кадр, а не растущую очередь
+        self.tracks = {kind: room.relay.subscribe(track, buffered=False) for kind, track in publisher.tracks.items()}
+        self.frames = queue.Queue(maxsize=settings.RECORDING['QUEUE_FRAMES'])
+        self.readers = []
+        self.writer = None
+        self.uploader = None
+        self.thread = None
+        self.error = None
+        self.started_at = None
+
+    async def start(self):
+        # Загрузка лекции держит поток часами - у неё своя нитка, а не место в общих пулах MinIO
+        self.uploader = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"recorder-upload-{self.channel_id}")
+        # Конструктор проверяет бакет в MinIO, это блокирующий вызов - не в event loop
+        self.writer = await asyncio.get_running_loop().run_in_executor(self.uploader, lambda: MinioStreamWriter(
+            self.path, 'video/mp4', timeout=settings.RECORDING['MAX_DURATION'], executor=self.uploader,
+        ))
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(target=self._encode, daemon=True, name=f"recorder-{self.channel_id}")
+        self.thread.start()
+        loop = asyncio.get_running_loop()
+        self.readers = [loop.create_task(self._read(kind, track)) for kind, track in self.tracks.items()]
+
+    async def _read(self, kind, track):
+        while True:
+            try:
+                frame = await track.recv()
+            except MediaStreamError:
+                return
+            try:
+                self.frames.put_nowait((kind, frame, time.monotonic()))
+            except queue.Full:
+                # Кодер не успевает - теряем кадр, а не память
+                metrics.incr("recorder_dropped_frames")
+
+    def _add_streams(self, container, first):
+        config = settings.RECORDING
+        streams = {}
+        if "video" in first:
+            frame = first["video"]
+            stream = container.add_stream("libx264", rate=30, options={
+                "preset": config['PRESET'],
+                "tune": "zerolatency",
+                "g": str(config['KEYFRAME_INTERVAL']),
+            })
+            stream.width = frame.width // 2 * 2
+            stream.height = frame.height // 2 * 2
+            stream.pix_fmt = "yuv420p"
+            stream.codec_context.time_base = VIDEO_TIME_BASE
+            streams["video"] = stream
+        if "audio" in first:
+            frame = first["audio"]
+            stream = container.add_stream("aac", rate=frame.sample_rate)
+            stream.layout = frame.layout.name
+            streams["audio"] = stream
+        return streams
+
+    def _encode(self):
+        container = av.open(self.writer, mode="w", format="mp4", options={
+            "movflags": "frag_keyframe+empty_moov+default_base_moof",
+        })
+        streams = None
+        # Потоки контейнера надо объявить до первого пакета, а размер видео известен только по кадру:
+        # копим первые кадры, пока не увидим каждую дорожку
+        first = {}
+        backlog = []
+        audio_samples = 0
+        try:
+            while True:
+                item = self.frames.get()
+                if item is _STOP:
+                    break
+                kind, frame, arrived = item
+                if streams is None:
+                    first.setdefault(kind, frame)
+                    backlog.append(item)
+                    if len(first) < len(self.tracks) and len(backlog) < self.frames.maxsize:
+                        continue
+                    streams = self._add_streams(container, first)
+                    pending, backlog = backlog, []
+                else:
+                    pending = [item]
+
+                for kind, frame, arrived in pending:
+                    stream = streams.get(kind)
+                    if stream is None:
+                        continue
+                    if kind == "video":
+                        if (frame.width, frame.height) != (stream.width, stream.height) or frame.format.name != "yuv420p":
+                            frame = frame.reformat(width=stream.width, height=stream.height, format="yuv420p")
+                        # Время видео - по приходу кадра: RTP-часы разных дорожек между собой не связаны
+                        frame.pts = int((arrived - self.started_at) / VIDEO_TIME_BASE)
+                        frame.time_base = VIDEO_TIME_BASE
+                    else:
+                        # Звук идёт без пропусков, его время - по числу сэмплов
+                        if audio_samples == 0:
+                            audio_samples = int((arrived - self.started_at) * frame.sample_rate)
+                        frame.pts = audio_samples
+                        frame.time_base = fractions.Fraction(1, frame.sample_rate)
+                        audio_samples += frame.samples
+                    for packet in stream.encode(frame):
+                        container.mux(packet)
+
+            for stream in (streams or {}).values():
+                for packet in stream.encode(None):
+                    container.mux(packet)
+            container.close()
+            self.writer.close()
+        except Exception as e:
+            print(f"[recorder] Запись канала {self.channel_id} упала: {e}")
+            self.error = e
+            self.writer.abort()
+
+    def _finish(self):
+        # Блокирующая часть остановки: дождаться, пока кодер допишет хвост и закроет multipart
+        self.frames.put(_STOP)
+        self.thread.join()
+        self.uploader.shutdown(wait=False)
+
+    async def stop(self):
+        """
+        Останавливает запись и дожидается загрузки. Возвращает (path, file_name, size).
+        """
+        for reader in self.readers:
+            reader.cancel()
+        await asyncio.get_running_loop().run_in_executor(None, self._finish)
+        if self.error is not None:
+            raise self.error
+        return self.path, self.file_name, self.writer.size
+
+
+_recorders = {}
+
+
+def get_recorder(channel_id):
+    return _recorders.get(channel_id)
+
+
+async def start_recording(room, publisher_id, owner_id, file_name="lecture.mp4", subject_name=None):
+    """
+    Одна запись на канал. Бросает LookupError, если публикации нет, ValueError - если уже пишется.
+    """
+    if room.channel_id in _recorders:
+        raise ValueError("Recording already in progress")
+    recorder = LectureRecorder(room, publisher_id, owner_id, file_name, subject_name)
+    # Место занимаем до await: второй старт, пока проверяется бакет, получит ValueError
+    _recorders[room.channel_id] = recorder
+    try:
+        await recorder.start()
+    except Exception:
+        _recorders.pop(room.channel_id, None)
+        if recorder.uploader is not None:
+            recorder.uploader.shutdown(wait=False)
+        raise
+    return recorder
+
+
+async def stop_recording(channel_id):
+    recorder = _recorders.pop(channel_id, None)
+    if recorder is None:
+        raise LookupError("No recording in progress")
+    return recorder, await recorder.stop()
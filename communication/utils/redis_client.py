@@ -0,0 +1,44 @@
+import time
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+_client = None
+_async_client = None
+_down_until = 0.0
+
+# Сколько секунд не трогать Redis после ошибки, чтобы не ловить таймаут на каждом запросе
+RETRY_AFTER = 30
+
+
+def mark_redis_down():
+    global _down_until
+    _down_until = time.monotonic() + RETRY_AFTER
+
+
+def get_redis():
+    """
+    Общий синхронный клиент Redis для кэшей/очередей.
+    Возвращает None, если REDIS_URL не задан или Redis недавно падал (см. mark_redis_down) -
+    тогда вызывающий код работает только с памятью процесса.
+    """
+    global _client
+    url = getattr(settings, 'REDIS_URL', None)
+    if not url or time.monotonic() < _down_until:
+        return None
+    if _client is None:
+        _client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+    return _client
+
+
+def get_async_redis():
+    """
+    То же самое для кода внутри event loop (consumers).
+    """
+    global _async_client
+    url = getattr(settings, 'REDIS_URL', None)
+    if not url or time.monotonic() < _down_until:
+        return None
+    if _async_client is None:
+        _async_client = aioredis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+    return _async_client
@@ -0,0 +1,103 @@
+import html
+
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+from django.db import models
+
+from ..models import Channel, Message, Transcript
+from .minio_client import get_download_url
+
+# Полнотекстовый поиск по сообщениям и транскриптам. tsvector (русский + английский) хранится в колонке search
+# и покрыт GIN-индексом, так что поиск - это индексный скан совпадений, а ранжирование считается только по ним.
+# Подсветка (ts_headline) дорогая, поэтому она считается вторым запросом и только для строк страницы.
+
+# Маркеры подсветки, которых не бывает в тексте: текст экранируется целиком, и только потом они становятся <mark>
+_START = "\x02"
+_STOP = "\x03"
+
+
+def build_query(text):
+    # websearch: "точная фраза", -исключить, or - как в поисковиках
+    return SearchQuery(text, config='russian', search_type='websearch') | \
+        SearchQuery(text, config='english', search_type='websearch')
+
+
+def visible_channels(user):
+    """
+    Каналы, в которые студент может зайти: без ограничения по группам или с его группой.
+    """
+    return Channel.objects.filter(models.Q(groups_allowed__isnull=True) | models.Q(groups_allowed=user.group_id))
+
+
+def _highlight(fragment):
+    return html.escape(fragment).replace(_START, "<mark>").replace(_STOP, "</mark>")
+
+
+def _ranked_page(queryset, field, query, limit, offset):
+    """
+    Страница (по убыванию релевантности) в виде [(obj, rank, headline), ...] и флаг "есть ещё".
+    """
+    ranked = list(
+        queryset.filter(search=query)
+        .annotate(rank=SearchRank(models.F('search'), query))
+        .order_by('-rank', '-id')
+        .values_list('id', 'rank')[offset:offset + limit + 1]
+    )
+    has_more = len(ranked) > limit
+    ranked = ranked[:limit]
+
+    headlines = queryset.filter(id__in=[pk for pk, _ in ranked]).annotate(
+        headline=SearchHeadline(
+            field, query, config='russian', start_sel=_START, stop_sel=_STOP,
+            max_words=35, min_words=15,
+        )
+    )
+    objects = {obj.id: obj for obj in headlines}
+    return [(objects[pk], rank, _highlight(objects[pk].headline)) for pk, rank in ranked if pk in objects], has_more
+
+
+def search_messages(user, text, limit, offset, channel_id=None):
+    messages = Message.objects.select_related('sender', 'channel')
+    if user.role == "студент":
+        messages = messages.filter(channel__in=visible_channels(user))
+    if channel_id is not None:
+        messages = messages.filter(channel_id=channel_id)
+
+    page, has_more = _ranked_page(messages, 'content', build_query(text), limit, offset)
+    return [
+        {
+            "type": "message",
+            "id": message.id,
+            "channel": {"id": message.channel_id, "name": message.channel.name},
+            "seq": message.seq,
+            "sender": {"id": message.sender.id, "name": message.sender.name, "username": message.sender.username},
+            "timestamp": message.timestamp.isoformat(),
+            "rank": rank,
+            "highlight": headline,
+        }
+        for message, rank, headline in page
+    ], has_more
+
+
+def search_transcripts(user, text, limit, offset, channel_id=None):
+    transcripts = Transcript.objects.select_related('user', 'channel')
+    if user.role == "студент":
+        # Студенту - свои транскрипты и транскрипты лекций в доступных ему каналах
+        transcripts = transcripts.filter(models.Q(user=user) | models.Q(channel__in=visible_channels(user)))
+    if channel_id is not None:
+        transcripts = transcripts.filter(channel_id=channel_id)
+
+    page, has_more = _ranked_page(transcripts, 'text', build_query(text), limit, offset)
+    return [
+        {
+            "type": "transcript",
+            "id": transcript.id,
+            "channel": {"id": transcript.channel_id, "name": transcript.channel.name} if transcript.channel else None,
+            "user": {"id": transcript.user.id, "name": transcript.user.name},
+            "file_name": transcript.file_name,
+            "url": get_download_url(transcript.path, transcript.file_name),
+            "created_at": transcript.created_at.isoformat(),
+            "rank": rank,
+            "highlight": headline,
+        }
+        for transcript, rank, headline in page
+    ], has_more
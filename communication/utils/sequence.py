@@ -0,0 +1,139 @@
+import threading
+from collections import Counter
+
+import redis
+
+from . import chat_buffer
+from .redis_client import get_async_redis, get_redis, mark_redis_down
+
+# Монотонные счётчики событий (Redis INCR), чтобы клиент видел пропуски и знал, когда просить снимок.
+# Без Redis - счётчики процесса: с несколькими процессами daphne номера расходятся, клиент уйдёт в resync.
+# Счётчик процесса никогда не ниже последнего номера, который этот процесс получил от Redis, а перед первым
+# номером без Redis догоняет БД и ещё не записанные сообщения (chat_buffer.alast_seq). Когда Redis возвращается,
+# он поднимается до номеров, выданных без него. Номер выдаётся один раз и до рассылки: если без Redis два процесса
+# всё же выдали один seq, второе сообщение не перенумеровывается, а не пишется в БД (см. chat_buffer._write_one).
+
+_memory = Counter()
+_memory_lock = threading.Lock()
+_fallback = set()  # ключи, по которым с последнего падения Redis номера выдавала память
+
+# SET только вверх: устаревший (меньший) счётчик в Redis поднимается, больший не трогается
+_RAISE = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local value = tonumber(ARGV[1])
+if current < value then
+    redis.call('SET', KEYS[1], value)
+    return value
+end
+return current
+"""
+
+
+def channel_seq_key(channel_id):
+    # Один счётчик на канал для всех событий с номером: сообщения чата, stream_delta, speaking_update.
+    # Поэтому у сообщений в БД seq идут с пропусками; что это значит для клиента - ChannelConsumer._replay
+    return f"seq:channel:{channel_id}"
+
+
+async def anext_channel_seq(channel_id):
+    return await anext_seq(channel_seq_key(channel_id), seed=lambda: chat_buffer.alast_seq(channel_id))
+
+
+def _remember(key, value):
+    with _memory_lock:
+        _memory[key] = max(_memory[key], value)
+    return value
+
+
+def _memory_incr(key):
+    with _memory_lock:
+        _memory[key] += 1
+        return _memory[key]
+
+
+def _memory_get(key):
+    with _memory_lock:
+        return _memory[key]
+
+
+def next_seq(key):
+    client = get_redis()
+    if client is not None:
+        try:
+            if key in _fallback:
+                client.eval(_RAISE, 1, key, _memory_get(key))
+                _fallback.discard(key)
+            return _remember(key, client.incr(key))
+        except redis.RedisError as e:
+            print(f"[seq] Redis недоступен: {e}")
+            mark_redis_down()
+    _fallback.add(key)
+    return _memory_incr(key)
+
+
+def get_seq(key):
+    client = get_redis()
+    if client is not None:
+        try:
+            return int(client.get(key) or 0)
+        except redis.RedisError as e:
+            print(f"[seq] Redis недоступен: {e}")
+            mark_redis_down()
+    return _memory_get(key)
+
+
+async def anext_seq(key, seed=None):
+    """
+    seed - корутина-функция с последним уже выданным номером (БД и незаписанные сообщения): им догоняется
+    счётчик процесса перед первым номером без Redis.
+    """
+    client = get_async_redis()
+    if client is not None:
+        try:
+            if key in _fallback:
+                await client.eval(_RAISE, 1, key, _memory_get(key))
+                _fallback.discard(key)
+            return _remember(key, await client.incr(key))
+        except redis.RedisError as e:
+            print(f"[seq] Redis недоступен: {e}")
+            mark_redis_down()
+    if key not in _fallback:
+        if seed is not None:
+            _remember(key, await seed())
+        _fallback.add(key)
+    return _memory_incr(key)
+
+
+async def aget_seq(key):
+    client = get_async_redis()
+    if client is not None:
+        try:
+            return int(await client.get(key) or 0)
+        except redis.RedisError as e:
+            print(f"[seq] Redis недоступен: {e}")
+            mark_redis_down()
+    return _memory_get(key)
+
+
+async def aensure_seq(key, seed):
+    """
+    Засевает счётчик, только если его нет: в Redis - новый канал или Redis потерял данные, в памяти процесса -
+    первый раз. seed - корутина-функция с последним выданным номером (chat_buffer.alast_seq); на обычном
+    подключении её не зовут, так что переподключения не ходят в Postgres.
+    """
+    client = get_async_redis()
+    if client is not None:
+        try:
+            if await client.exists(key):
+                return
+            value = await seed()
+            # Параллельный засев тем же значением безопасен: SET только вверх
+            _remember(key, int(await client.eval(_RAISE, 1, key, value)))
+            return
+        except redis.RedisError as e:
+            print(f"[seq] Redis недоступен: {e}")
+            mark_redis_down()
+    with _memory_lock:
+        seeded = key in _memory
+    if not seeded:
+        _remember(key, await seed())
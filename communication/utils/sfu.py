@@ -0,0 +1,320 @@
+import fractions
+
+import av
+from aiortc import (
+    InvalidAccessError, InvalidStateError, MediaStreamTrack, RTCConfiguration, RTCIceServer, RTCPeerConnection,
+    RTCSessionDescription,
+)
+from aiortc.contrib.media import MediaRelay
+from aiortc.sdp import candidate_from_sdp
+from django.conf import settings
+
+# SFU-режим (SFU['ENABLED']): каждый публикующий отдаёт серверу одну копию своих дорожек,
+# сервер раздаёт их подписчикам. aiortc не пересылает RTP как есть: дорожка декодируется один раз,
+# MediaRelay раздаёт кадры, а кодирует каждый RTCRtpSender подписчика сам - на каждую подписку
+# свой кодер VP8/H.264. Экономится канал публикующего (одна отдача вместо N), но не CPU сервера:
+# одно ядро тянет порядка 10-20 кодеров 640x480, поэтому подписок на комнату не больше
+# SFU['MAX_SUBSCRIPTIONS'], дальше subscribe отвечает ошибкой. Большие лекции - в P2P-сетке
+# (SFU выключен по умолчанию) или на отдельном медиасервере, который пересылает RTP без перекодирования.
+#
+# Состояние комнаты живёт в памяти процесса, поэтому все сокеты одного канала должны попадать
+# в один процесс daphne (липкая маршрутизация по channel_id).
+
+# Ошибки, которые означают кривой запрос клиента или не то состояние соединения, а не сбой сервера:
+# consumer отвечает на них sfu_error и живёт дальше
+ERRORS = (InvalidAccessError, InvalidStateError, LookupError, ValueError, OSError)
+
+
+class GatedTrack(MediaStreamTrack):
+    """
+    Дорожка публикующего, которую можно "выключить" для всех подписчиков сразу:
+    звук заменяется тишиной, видео - чёрным кадром. Управляется Stream (has_audio/has_video, admin_mute).
+    """
+
+    def __init__(self, source):
+        super().__init__()
+        self.kind = source.kind
+        self.source = source
+        self.enabled = True
+
+    async def recv(self):
+        frame = await self.source.recv()
+        if self.enabled:
+            return frame
+        if self.kind == "audio":
+            for plane in frame.planes:
+                plane.update(bytes(plane.buffer_size))
+            return frame
+        black = av.VideoFrame(frame.width, frame.height, "yuv420p")
+        black.planes[0].update(bytes(black.planes[0].buffer_size))
+        for plane in black.planes[1:]:
+            plane.update(b"\x80" * plane.buffer_size)
+        black.pts = frame.pts
+        black.time_base = frame.time_base
+        return black
+
+
+class ScaledTrack(MediaStreamTrack):
+    """
+    Нижний слой видео: меньше разрешение и каждый N-й кадр. Браузерный simulcast aiortc принимать
+    не умеет, поэтому слои делает сервер - один раз на публикующего, а не на каждого подписчика.
+    """
+
+    kind = "video"
+
+    def __init__(self, source, scale, fps_divisor):
+        super().__init__()
+        self.source = source
+        self.scale = scale
+        self.fps_divisor = max(1, fps_divisor)
+        self.count = 0
+
+    async def recv(self):
+        while True:
+            frame = await self.source.recv()
+            self.count += 1
+            if self.count % self.fps_divisor == 0:
+                break
+        # yuv420p требует чётных размеров
+        width = max(2, int(frame.width * self.scale) // 2 * 2)
+        height = max(2, int(frame.height * self.scale) // 2 * 2)
+        scaled = frame.reformat(width=width, height=height, format="yuv420p")
+        scaled.pts = frame.pts
+        scaled.time_base = frame.time_base or fractions.Fraction(1, 90000)
+        return scaled
+
+
+class LayerTrack(MediaStreamTrack):
+    """
+    Видео подписчика. Слой переключается внутри дорожки, без replaceTrack: у каждого слоя свой
+    небуферизованный прокси relay, так что неактивный держит максимум один кадр, а не растущую очередь.
+    Кадры не новее уже отданного выкидываются: на переключении слои отдают один и тот же pts,
+    а два кадра с одной RTP-меткой браузер не декодирует.
+    """
+
+    kind = "video"
+
+    def __init__(self, relay, publisher, layer):
+        super().__init__()
+        self.relay = relay
+        self.publisher = publisher
+        self.layer = layer
+        self.sources = {}
+        self.last_pts = None
+
+    def _source(self):
+        source = self.sources.get(self.layer)
+        if source is None:
+            source = self.sources[self.layer] = self.relay.subscribe(
+                self.publisher.source("video", self.layer), buffered=False,
+            )
+        return source
+
+    async def recv(self):
+        while True:
+            frame = await self._source().recv()
+            if self.last_pts is None or frame.pts > self.last_pts:
+                self.last_pts = frame.pts
+                return frame
+
+    def stop(self):
+        super().stop()
+        for source in self.sources.values():
+            source.stop()
+
+
+def _configuration():
+    return RTCConfiguration(iceServers=[RTCIceServer(**server) for server in settings.SFU['ICE_SERVERS']])
+
+
+async def _add_candidate(pc, data):
+    candidate = data.get("candidate") or ""
+    if not candidate:
+        return
+    ice = candidate_from_sdp(candidate.split(":", 1)[1] if candidate.startswith("candidate:") else candidate)
+    ice.sdpMid = data.get("sdpMid")
+    ice.sdpMLineIndex = data.get("sdpMLineIndex")
+    await pc.addIceCandidate(ice)
+
+
+class Publisher:
+    def __init__(self, user_id, pc):
+        self.user_id = user_id
+        self.pc = pc
+        self.tracks = {}   # kind -> GatedTrack
+        self.layers = {}   # "low" -> ScaledTrack
+
+    def source(self, kind, layer):
+        if kind == "video" and layer == "low" and "low" in self.layers:
+            return self.layers["low"]
+        return self.tracks[kind]
+
+
+class Room:
+    """
+    Публикации и подписки одного канала в этом процессе.
+    """
+
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.relay = MediaRelay()
+        self.publishers = {}      # user_id -> Publisher
+        self.subscriptions = {}   # (subscriber_id, publisher_id) -> RTCPeerConnection
+        self.speakers = None      # audio_levels.ActiveSpeakers, если включён
+
+    async def publish(self, user_id, sdp, sdp_type):
+        """
+        Принимает offer публикующего, возвращает answer. Старая публикация этого пользователя закрывается.
+        """
+        await self.unpublish(user_id)
+        pc = RTCPeerConnection(_configuration())
+        publisher = Publisher(user_id, pc)
+        config = settings.SFU
+
+        @pc.on("track")
+        def on_track(track):
+            gated = GatedTrack(track)
+            publisher.tracks[track.kind] = gated
+            if track.kind == "audio" and self.speakers is not None:
+                # Меряем уже "загейченный" звук: заглушённый не считается говорящим
+                self.speakers.add(user_id, gated)
+            if track.kind == "video":
+                publisher.layers["low"] = ScaledTrack(
+                    self.relay.subscribe(gated), config['LOW_LAYER_SCALE'], config['LOW_LAYER_FPS_DIVISOR'],
+                )
+
+        @pc.on("connectionstatechange")
+        async def on_state():
+            if pc.connectionState in ("failed", "closed") and self.publishers.get(user_id) is publisher:
+                await self.unpublish(user_id)
+
+        self.publishers[user_id] = publisher
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=sdp, type=sdp_type))
+        await pc.setLocalDescription(await pc.createAnswer())
+        return {"sdp": pc.localDescription.sdp, "sdp_type": pc.localDescription.type}
+
+    async def subscribe(self, subscriber_id, publisher_id, layer="high"):
+        """
+        Новое соединение подписчика к публикации. Сервер сам делает offer, клиент отвечает через answer().
+        """
+        publisher = self.publishers.get(publisher_id)
+        if publisher is None:
+            raise LookupError("Publisher not found")
+        await self.unsubscribe(subscriber_id, publisher_id)
+        if len(self.subscriptions) >= settings.SFU['MAX_SUBSCRIPTIONS']:
+            raise ValueError("Too many subscriptions in this room")
+
+        key = (subscriber_id, publisher_id)
+        pc = RTCPeerConnection(_configuration())
+
+        @pc.on("connectionstatechange")
+        async def on_state():
+            # Упавшее соединение подписчика иначе так и тянуло бы кадры из relay до его ухода из канала
+            if pc.connectionState in ("failed", "closed") and self.subscriptions.get(key) is pc:
+                await self.unsubscribe(*key)
+
+        for kind in publisher.tracks:
+            if kind == "video":
+                pc.addTrack(LayerTrack(self.relay, publisher, layer))
+            else:
+                pc.addTrack(self.relay.subscribe(publisher.source(kind, layer)))
+        self.subscriptions[key] = pc
+        await pc.setLocalDescription(await pc.createOffer())
+        return {"sdp": pc.localDescription.sdp, "sdp_type": pc.localDescription.type}
+
+    async def answer(self, subscriber_id, publisher_id, sdp, sdp_type):
+        pc = self.subscriptions.get((subscriber_id, publisher_id))
+        if pc is not None:
+            await pc.setRemoteDescription(RTCSessionDescription(sdp=sdp, type=sdp_type))
+
+    async def set_layer(self, subscriber_id, publisher_id, layer):
+        pc = self.subscriptions.get((subscriber_id, publisher_id))
+        if pc is None:
+            return
+        for sender in pc.getSenders():
+            if isinstance(sender.track, LayerTrack):
+                sender.track.layer = layer
+
+    async def add_candidate(self, user_id, publisher_id, data):
+        if publisher_id is None or publisher_id == user_id:
+            publisher = self.publishers.get(user_id)
+            pc = publisher.pc if publisher else None
+        else:
+            pc = self.subscriptions.get((user_id, publisher_id))
+        if pc is not None:
+            await _add_candidate(pc, data)
+
+    def apply_state(self, user_id, stream):
+        """
+        Включает/глушит дорожки публикующего по состоянию Stream (сериализованному StreamSerializer).
+        """
+        publisher = self.publishers.get(user_id)
+        if publisher is None:
+            return
+        if "audio" in publisher.tracks:
+            publisher.tracks["audio"].enabled = stream["has_audio"] and not stream["is_muted_by_admin"]
+        if "video" in publisher.tracks:
+            publisher.tracks["video"].enabled = stream["has_video"] or stream["has_webcam"]
+
+    async def unsubscribe(self, subscriber_id, publisher_id):
+        pc = self.subscriptions.pop((subscriber_id, publisher_id), None)
+        if pc is not None:
+            await pc.close()
+
+    async def unpublish(self, user_id):
+        """
+        Закрывает публикацию и все подписки на неё. True - публикация была.
+        """
+        publisher = self.publishers.pop(user_id, None)
+        if publisher is None:
+            return False
+        if self.speakers is not None:
+            self.speakers.remove(user_id)
+        for key in [k for k in self.subscriptions if k[1] == user_id]:
+            await self.unsubscribe(*key)
+        await publisher.pc.close()
+        return True
+
+    async def leave(self, user_id):
+        for key in [k for k in self.subscriptions if k[0] == user_id]:
+            await self.unsubscribe(*key)
+        return await self.unpublish(user_id)
+
+    def is_empty(self):
+        return not self.publishers and not self.subscriptions
+
+
+_rooms = {}
+
+
+def get_room(channel_id):
+    room = _rooms.get(channel_id)
+    if room is None:
+        room = _rooms[channel_id] = Room(channel_id)
+    return room
+
+
+def find_room(channel_id):
+    return _rooms.get(channel_id)
+
+
+async def leave(channel_id, user_id):
+    """
+    Пользователь отключился: закрываем его публикацию и подписки. True - он что-то публиковал.
+    """
+    room = _rooms.get(channel_id)
+    if room is None:
+        return False
+    published = await room.leave(user_id)
+    if room.is_empty():
+        _rooms.pop(channel_id, None)
+        if room.speakers is not None:
+            room.speakers.close()
+    return published
+
+
+def tracks_in_offer(sdp):
+    """
+    Какие дорожки публикующий реально отдаёт (по m-строкам offer'а).
+    """
+    return {"audio": "\nm=audio " in "\n" + sdp, "video": "\nm=video " in "\n" + sdp}
@@ -0,0 +1,151 @@
+import asyncio
+
+import redis
+from django.conf import settings
+
+from . import channel_events, metrics
+from .redis_client import get_async_redis, get_redis, mark_redis_down
+from .sequence import anext_channel_seq
+
+# "Кто сейчас говорит" меняется по нескольку раз в секунду на каждого говорящего.
+# В Postgres это не пишется: состояние живёт в памяти процесса и в Redis (speaking:<channel_id> - set user_id),
+# а наружу уходит не чаще TICK_HZ раз в секунду одним сообщением на канал, только реально изменившееся.
+
+_memory_speaking = {}
+
+
+def _key(channel_id):
+    return f"speaking:{channel_id}"
+
+
+def get_speaking(channel_id):
+    """
+    Множество id пользователей, которые сейчас говорят (для снимков состояния).
+    """
+    client = get_redis()
+    if client is not None:
+        try:
+            return {int(u) for u in client.smembers(_key(channel_id))}
+        except redis.RedisError as e:
+            print(f"[speaking] Redis недоступен: {e}")
+            mark_redis_down()
+    return set(_memory_speaking.get(str(channel_id), ()))
+
+
+async def aget_speaking(channel_id):
+    client = get_async_redis()
+    if client is not None:
+        try:
+            return {int(u) for u in await client.smembers(_key(channel_id))}
+        except redis.RedisError as e:
+            print(f"[speaking] Redis недоступен: {e}")
+            mark_redis_down()
+    return set(_memory_speaking.get(str(channel_id), ()))
+
+
+async def _store(channel_id, changes):
+    local = _memory_speaking.setdefault(str(channel_id), set())
+    for user_id, is_speaking in changes.items():
+        if is_speaking:
+            local.add(user_id)
+        else:
+            local.discard(user_id)
+
+    client = get_async_redis()
+    if client is None:
+        return
+    started = [u for u, s in changes.items() if s]
+    stopped = [u for u, s in changes.items() if not s]
+    try:
+        pipe = client.pipeline()
+        if started:
+            pipe.sadd(_key(channel_id), *started)
+        if stopped:
+            pipe.srem(_key(channel_id), *stopped)
+        pipe.expire(_key(channel_id), settings.PRESENCE['TTL'] * 10)
+        await pipe.execute()
+    except redis.RedisError as e:
+        print(f"[speaking] Redis недоступен: {e}")
+        mark_redis_down()
+
+
+class SpeakingCoalescer:
+    """
+    Копит is_speaking от сокетов своего процесса в одном канале и раз в тик рассылает
+    только то, что изменилось с прошлой рассылки. Промежуточные состояния выбрасываются.
+    """
+
+    def __init__(self, channel_id, group_name, channel_layer):
+        self.channel_id = channel_id
+        self.group_name = group_name
+        self.channel_layer = channel_layer
+        self.pending = {}
+        self.emitted = {}
+        self.consumers = 0
+        self.task = None
+
+    def report(self, user_id, is_speaking):
+        metrics.incr("speaking_received")
+        if user_id in self.pending:
+            # Предыдущее состояние так и не ушло - оно уже неактуально
+            metrics.incr("speaking_dropped")
+        self.pending[user_id] = bool(is_speaking)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        interval = 1 / settings.SPEAKING['TICK_HZ']
+        while self.pending:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[speaking] Рассылка канала {self.channel_id} не прошла: {e}")
+        if self.consumers <= 0 and _coalescers.get(self.channel_id) is self:
+            _coalescers.pop(self.channel_id, None)
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        changes = {u: s for u, s in pending.items() if self.emitted.get(u, False) != s}
+        metrics.incr("speaking_dropped", len(pending) - len(changes))
+        if not changes:
+            return
+        for user_id, is_speaking in changes.items():
+            if is_speaking:
+                self.emitted[user_id] = True
+            else:
+                self.emitted.pop(user_id, None)
+
+        await _store(self.channel_id, changes)
+        seq = await anext_channel_seq(self.channel_id)
+        event = {
+            "type": "speaking_update",
+            "seq": seq,
+            "speaking": [{"user_id": u, "is_speaking": s} for u, s in changes.items()],
+        }
+        await channel_events.aremember(self.channel_id, seq, event)
+        await self.channel_layer.group_send(self.group_name, event)
+        metrics.incr("speaking_emitted", len(changes))
+
+    def is_speaking(self, user_id):
+        return self.emitted.get(user_id, False)
+
+
+_coalescers = {}
+
+
+def attach(channel_id, group_name, channel_layer):
+    """
+    Коалесер канала для этого процесса; consumer берёт его при подключении и отдаёт через detach.
+    """
+    coalescer = _coalescers.get(channel_id)
+    if coalescer is None:
+        coalescer = _coalescers[channel_id] = SpeakingCoalescer(channel_id, group_name, channel_layer)
+    coalescer.consumers += 1
+    return coalescer
+
+
+def detach(coalescer):
+    coalescer.consumers -= 1
+    if coalescer.consumers <= 0 and not coalescer.pending:
+        _coalescers.pop(coalescer.channel_id, None)
@@ -0,0 +1,396 @@
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from queue import Empty
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .redis_client import get_redis
+
+# Тексты сессий лежат на диске рядом с приложением, воркеры пишут туда же
+SESS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "sessions")
+os.makedirs(SESS_DIR, exist_ok=True)
+
+QUEUE_KEY = "transcription:jobs"
+
+
+def _job_key(job_id):
+    return f"transcription:job:{job_id}"
+
+
+def _audio_key(job_id):
+    return f"transcription:job:{job_id}:audio"
+
+
+def _pending_key(session_id):
+    # zset job_id -> срок аренды: задача без результата дольше JOB_LEASE больше не считается незаконченной
+    return f"transcription:session:{session_id}:leases"
+
+
+def _seq_key(session_id):
+    return f"transcription:session:{session_id}:seq"
+
+
+def _version_key(session_id):
+    return f"transcription:session:{session_id}:version"
+
+
+def notify_transcription(job):
+    """
+    Пушит результат задачи владельцу через NotificationConsumer (группа user_notifications_<id>).
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None or not job.get("user_id"):
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(
+            f"user_notifications_{job['user_id']}",
+            {
+                "type": "transcription_result",
+                "job_id": job["id"],
+                "session_id": job["session_id"],
+                "status": job["status"],
+                "text": job.get("text", ""),
+                "error": job.get("error", ""),
+            }
+        )
+    except Exception as e:
+        print(f"[transcription] Не удалось отправить результат {job['id']}: {e}")
+
+
+class RedisTranscriptionQueue:
+    """
+    Очередь в Redis: веб кладёт задачи, отдельные процессы `manage.py transcription_worker` их разбирают.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.ttl = settings.TRANSCRIPTION['JOB_TTL']
+        self.lease = settings.TRANSCRIPTION['JOB_LEASE']
+
+    # Сторона веба
+
+    def submit(self, job, audio):
+        pipe = self.client.pipeline()
+        pipe.set(_audio_key(job["id"]), audio, ex=self.ttl)
+        pipe.hset(_job_key(job["id"]), mapping=job)
+        pipe.expire(_job_key(job["id"]), self.ttl)
+        pipe.zadd(_pending_key(job["session_id"]), {job["id"]: time.time() + self.lease})
+        pipe.expire(_pending_key(job["session_id"]), self.ttl)
+        pipe.rpush(QUEUE_KEY, job["id"])
+        pipe.execute()
+
+    def get(self, job_id):
+        raw = self.client.hgetall(_job_key(job_id))
+        return {k.decode(): v.decode() for k, v in raw.items()} or None
+
+    def pending(self, session_id):
+        # Протухшие аренды (воркер умер, задача истекла в очереди) не держат finish
+        return self.client.zcount(_pending_key(session_id), time.time(), "+inf")
+
+    def _incr(self, key):
+        pipe = self.client.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, self.ttl)
+        return pipe.execute()[0] - 1
+
+    def next_seq(self, session_id):
+        # Порядковый номер куска в потоковой сессии, с нуля
+        return self._incr(_seq_key(session_id))
+
+    def next_version(self, session_id):
+        # Номер куска в режиме full: текст сессии перезаписывает только более новый кусок
+        return self._incr(_version_key(session_id))
+
+    def has_stream(self, session_id):
+        return bool(self.client.exists(_seq_key(session_id)))
+
+    def forget(self, session_id):
+        self.client.delete(_seq_key(session_id), _version_key(session_id), _pending_key(session_id))
+
+    # Сторона воркера
+
+    def take(self, timeout=1):
+        item = self.client.blpop([QUEUE_KEY], timeout=timeout)
+        if item is None:
+            return None
+        job_id = item[1].decode()
+        job = self.get(job_id)
+        audio = self.client.get(_audio_key(job_id))
+        self.client.delete(_audio_key(job_id))
+        if job is None or audio is None:
+            # Задача протухла по TTL, пока лежала в очереди; её аренда истечёт сама
+            return None
+        pipe = self.client.pipeline()
+        pipe.hset(_job_key(job_id), "status", "running")
+        pipe.zadd(_pending_key(job["session_id"]), {job_id: time.time() + self.lease})
+        pipe.execute()
+        return job, audio
+
+    def report(self, job):
+        pipe = self.client.pipeline()
+        pipe.hset(_job_key(job["id"]), mapping={k: v for k, v in job.items() if v is not None})
+        pipe.zrem(_pending_key(job["session_id"]), job["id"])
+        pipe.execute()
+        notify_transcription(job)
+
+
+class LocalWorkerSource:
+    """
+    То, что видит воркер локального пула: задачи и результаты ходят через multiprocessing.Queue.
+    """
+
+    def __init__(self, jobs, results):
+        self.jobs = jobs
+        self.results = results
+
+    def take(self, timeout=1):
+        try:
+            job, audio = self.jobs.get(timeout=timeout)
+        except Empty:
+            return None
+        self.results.put({**job, "status": "running"})
+        return job, audio
+
+    def report(self, job):
+        self.results.put(job)
+
+
+class LocalTranscriptionQueue:
+    """
+    Пул процессов рядом с веб-процессом. Модель грузится только в дочерних процессах,
+    сам веб-процесс остаётся лёгким. Состояние задач живёт в памяти веб-процесса:
+    законченных хранится не больше LOCAL_MAX_RESULTS и не дольше JOB_TTL.
+    """
+
+    def __init__(self, workers):
+        ctx = multiprocessing.get_context("spawn")
+        self._jobs = ctx.Queue()
+        self._results = ctx.Queue()
+        self._state = {}
+        self._finished = OrderedDict()  # job_id -> когда закончилась, по порядку
+        self._pending = {}  # session_id -> {job_id: срок аренды}
+        self._seq = Counter()
+        self._versions = Counter()
+        self._lock = threading.Lock()
+        self._workers = workers
+        self._ctx = ctx
+        self._started = False
+
+    def _start(self):
+        # Процессы поднимаются при первой задаче, а не при импорте
+        from .transcription_worker import run_local_worker
+
+        for _ in range(self._workers):
+            self._ctx.Process(target=run_local_worker, args=(self._jobs, self._results), daemon=True).start()
+        threading.Thread(target=self._collect, daemon=True, name="transcription-results").start()
+        self._started = True
+
+    def _finish(self, job):
+        # Вызывать под self._lock
+        self._state[job["id"]] = job
+        self._pending.get(job["session_id"], {}).pop(job["id"], None)
+        self._finished[job["id"]] = time.monotonic()
+        config = settings.TRANSCRIPTION
+        oldest = time.monotonic() - config['JOB_TTL']
+        while self._finished:
+            job_id, finished_at = next(iter(self._finished.items()))
+            if len(self._finished) <= config['LOCAL_MAX_RESULTS'] and finished_at > oldest:
+                break
+            del self._finished[job_id]
+            self._state.pop(job_id, None)
+
+    def _collect(self):
+        while True:
+            job = self._results.get()
+            finished = job["status"] in ("done", "failed")
+            with self._lock:
+                if finished:
+                    self._finish(job)
+                elif job["id"] in self._state:
+                    self._state[job["id"]] = job
+                    leases = self._pending.get(job["session_id"], {})
+                    if job["id"] in leases:
+                        leases[job["id"]] = time.monotonic() + settings.TRANSCRIPTION['JOB_LEASE']
+            if finished:
+                notify_transcription(job)
+
+    def submit(self, job, audio):
+        with self._lock:
+            if not self._started:
+                self._start()
+            self._state[job["id"]] = job
+            leases = self._pending.setdefault(job["session_id"], {})
+            leases[job["id"]] = time.monotonic() + settings.TRANSCRIPTION['JOB_LEASE']
+        self._jobs.put((job, audio))
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._state.get(job_id)
+            return dict(job) if job else None
+
+    def pending(self, session_id):
+        with self._lock:
+            now = time.monotonic()
+            for job_id, deadline in list(self._pending.get(session_id, {}).items()):
+                if deadline <= now:
+                    # Процесс пула умер вместе с задачей - результата уже не будет
+                    self._finish({**self._state.get(job_id, {"id": job_id, "session_id": session_id}),
+                                  "status": "failed", "error": "Transcription worker lost"})
+            return len(self._pending.get(session_id, {}))
+
+    def _incr(self, counter, session_id):
+        with self._lock:
+            value = counter[session_id]
+            counter[session_id] += 1
+            return value
+
+    def next_seq(self, session_id):
+        return self._incr(self._seq, session_id)
+
+    def next_version(self, session_id):
+        return self._incr(self._versions, session_id)
+
+    def has_stream(self, session_id):
+        with self._lock:
+            return session_id in self._seq
+
+    def forget(self, session_id):
+        with self._lock:
+            self._seq.pop(session_id, None)
+            self._versions.pop(session_id, None)
+            self._pending.pop(session_id, None)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            config = settings.TRANSCRIPTION
+            if config['QUEUE'] == 'redis':
+                client = get_redis()
+                if client is None:
+                    raise RuntimeError("TRANSCRIPTION['QUEUE'] = 'redis' requires REDIS_URL")
+                _queue = RedisTranscriptionQueue(client)
+            else:
+                _queue = LocalTranscriptionQueue(config['WORKERS'])
+        return _queue
+
+
+def submit_chunk(session_id, user_id, audio, mode="full", cumulative=False, final=False):
+    """
+    Ставит кусок записи в очередь распознавания. Возвращает описание задачи (id, status).
+
+    mode="full" - в куске вся запись, текст сессии перезаписывается целиком (старое поведение).
+    mode="stream" - кусок продолжает запись (cumulative=True - вся запись с начала, берётся только новое),
+    распознаётся только новый звук, текст дописывается с таймкодами. final=True - дочистить хвост.
+
+    Что может слать клиент в stream-режиме:
+    - куски MediaRecorder.start(timeslice) как есть: первый - с заголовком WebM, следующие - без него,
+      сервер сам приклеивает заголовок и недочитанный кластер прошлого куска (transcription_stream);
+    - каждый кусок отдельным файлом (MediaRecorder перезапускается на кусок, любой формат libav);
+    - cumulative=True: каждый раз вся запись с начала.
+    Куски одной сессии должны идти в порядке записи: порядок задаёт seq, выданный здесь.
+    """
+    queue = get_queue()
+    job = {
+        "id": uuid.uuid4().hex,
+        "session_id": session_id,
+        "user_id": str(user_id),
+        "mode": mode,
+        "status": "queued",
+        "created_at": str(time.time()),
+    }
+    if mode == "stream":
+        job.update({
+            "seq": str(queue.next_seq(session_id)),
+            "cumulative": "1" if cumulative else "0",
+            "final": "1" if final else "0",
+        })
+    else:
+        # Куски full разбирают разные воркеры и заканчивают в любом порядке, см. transcribe_full
+        job["version"] = str(queue.next_version(session_id))
+    queue.submit(job, audio)
+    return job
+
+
+def finish_stream(session_id, user_id):
+    """
+    Для потоковой сессии ставит последнюю задачу, которая распознаёт остаток хвоста. Ставится один раз:
+    повторный transcribe/finish получает id той же задачи. None - сессия не потоковая.
+    """
+    marker = session_path(session_id, "final")
+    if os.path.exists(marker):
+        with open(marker, encoding="utf-8") as f:
+            return f.read().strip() or None
+    if not get_queue().has_stream(session_id):
+        return None
+    try:
+        fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        # Параллельный finish успел первым
+        with open(marker, encoding="utf-8") as f:
+            return f.read().strip() or None
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        try:
+            job = submit_chunk(session_id, user_id, b"", mode="stream", final=True)
+        except Exception:
+            os.remove(marker)
+            raise
+        f.write(job["id"])
+    return job["id"]
+
+
+def set_session_owner(session_id, user_id):
+    with open(session_path(session_id, "owner"), "w", encoding="utf-8") as f:
+        f.write(str(user_id))
+
+
+def is_session_owner(session_id, user_id):
+    """
+    Сессия принадлежит тому, кто её начал: чужой session_id не даёт ни дописать, ни забрать текст.
+    """
+    try:
+        with open(session_path(session_id, "owner"), encoding="utf-8") as f:
+            return f.read().strip() == str(user_id)
+    except FileNotFoundError:
+        return False
+
+
+def cleanup_session(session_id):
+    """
+    Убирает всё, что осталось от сессии: текст, состояние потокового режима, отложенные куски.
+    """
+    for ext in ("txt", "stream.json", "pcm", "version", "lock", "owner", "final", "header", "carry"):
+        try:
+            os.remove(session_path(session_id, ext))
+        except FileNotFoundError:
+            pass
+    shutil.rmtree(session_path(session_id, "pending"), ignore_errors=True)
+    get_queue().forget(session_id)
+
+
+def get_job(job_id):
+    return get_queue().get(job_id)
+
+
+def session_pending(session_id):
+    """
+    Сколько кусков сессии ещё не распознано (задачи умерших воркеров не считаются, см. JOB_LEASE).
+    """
+    return get_queue().pending(session_id)
+
+
+def session_path(session_id, ext="txt"):
+    return os.path.join(SESS_DIR, f"{session_id}.{ext}")
+
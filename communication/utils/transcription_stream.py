@@ -0,0 +1,276 @@
+import json
+import os
+
+import numpy as np
+from django.conf import settings
+from filelock import FileLock
+
+from .audio import SAMPLE_RATE
+from .transcription_queue import session_path
+
+# Распознавание окна упало: кусок коммитится пустым, чтобы его seq закрылся и сессия шла дальше
+FAILED = object()
+
+# ID элементов EBML (начало файла WebM) и Cluster: по ним куски MediaRecorder склеиваются обратно
+_EBML = b"\x1a\x45\xdf\xa3"
+_CLUSTER = b"\x1f\x43\xb6\x75"
+
+
+def _format_ts(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def _load_state(session_id):
+    path = session_path(session_id, "stream.json")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    # tail_start - где (в секундах от начала лекции) начинается недозакоммиченный хвост
+    return {"next_seq": 0, "tail_start": 0.0, "received_samples": 0, "prompt": ""}
+
+
+def _save_state(session_id, state):
+    with open(session_path(session_id, "stream.json"), "w", encoding="utf-8") as f:
+        json.dump(state, f)
+
+
+def _load_tail(session_id):
+    path = session_path(session_id, "pcm")
+    if os.path.exists(path):
+        return np.fromfile(path, dtype=np.float32)
+    return np.zeros(0, dtype=np.float32)
+
+
+def _save_tail(session_id, tail):
+    tail.astype(np.float32).tofile(session_path(session_id, "pcm"))
+
+
+def _stash(session_id, job, audio):
+    # Кусок пришёл раньше предыдущего - откладываем до своей очереди
+    os.makedirs(session_path(session_id, "pending"), exist_ok=True)
+    base = os.path.join(session_path(session_id, "pending"), str(job["seq"]))
+    with open(base + ".bin", "wb") as f:
+        f.write(audio)
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump(job, f)
+
+
+def _unstash(session_id, seq):
+    base = os.path.join(session_path(session_id, "pending"), str(seq))
+    if not os.path.exists(base + ".json"):
+        return None
+    with open(base + ".json", "r", encoding="utf-8") as f:
+        job = json.load(f)
+    with open(base + ".bin", "rb") as f:
+        audio = f.read()
+    os.remove(base + ".json")
+    os.remove(base + ".bin")
+    return job, audio
+
+
+def _read_bytes(session_id, ext):
+    path = session_path(session_id, ext)
+    if not os.path.exists(path):
+        return b""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_bytes(session_id, ext, data):
+    with open(session_path(session_id, ext), "wb") as f:
+        f.write(data)
+
+
+def _decode_continuation(state, job, audio, decode):
+    """
+    Кусок MediaRecorder с timeslice - продолжение одного файла: заголовок WebM есть только в первом,
+    а граница куска может прийтись на середину кластера. Перед куском ставится сохранённый заголовок и
+    последний (может быть, недочитанный) кластер прошлого куска; уже отданные из него сэмплы отрезаются.
+    """
+    session_id = job["session_id"]
+    if audio.startswith(_EBML):
+        # Первый кусок или самостоятельный файл (клиент перезапускает MediaRecorder) - со своим заголовком
+        cluster = audio.find(_CLUSTER)
+        header = audio if cluster < 0 else audio[:cluster]
+        _write_bytes(session_id, "header", header)
+        data, skip = audio[len(header):], 0
+    else:
+        header = _read_bytes(session_id, "header")
+        if not header:
+            # Не WebM: каждый кусок - самостоятельный файл
+            return decode(audio)
+        data, skip = _read_bytes(session_id, "carry") + audio, state.get("carry_samples", 0)
+    pcm = decode(header + data)[skip:]
+    carry = data[max(data.rfind(_CLUSTER), 0):]
+    _write_bytes(session_id, "carry", carry)
+    state["carry_samples"] = len(decode(header + carry)) if carry else 0
+    return pcm
+
+
+def _append(state, tail, job, audio, decode):
+    """
+    Декодирует кусок и приклеивает к хвосту. Возвращает буфер, который надо распознать.
+    """
+    pcm = np.zeros(0, dtype=np.float32)
+    if audio:
+        try:
+            if str(job.get("cumulative")) == "1":
+                pcm = decode(audio)
+            else:
+                pcm = _decode_continuation(state, job, audio, decode)
+        except Exception as e:
+            # Битый кусок пропускаем, иначе вся сессия встанет в ожидании его seq
+            print(f"[transcription] Кусок {job['seq']} сессии {job['session_id']} не декодировался: {e}")
+    if str(job.get("cumulative")) == "1":
+        # Клиент шлёт всю запись с начала - берём только то, чего ещё не видели
+        pcm = pcm[state["received_samples"]:]
+    state["received_samples"] += len(pcm)
+    return np.concatenate([tail, pcm]) if len(tail) else pcm
+
+
+def _needs_decode(buffer, final):
+    duration = len(buffer) / SAMPLE_RATE
+    if duration == 0:
+        return False
+    return final or duration >= settings.TRANSCRIPTION['STREAM_OVERLAP'] * 2
+
+
+def _transcribe(model, state, buffer, final):
+    if not _needs_decode(buffer, final):
+        return None
+    try:
+        return model.transcribe(buffer, initial_prompt=state["prompt"] or None)["segments"]
+    except Exception as e:
+        print(f"[transcription] Окно сессии не распозналось: {e}")
+        return FAILED
+
+
+def _commit(state, buffer, segments, final):
+    """
+    Коммитит устоявшиеся сегменты и возвращает (строки для транскрипта, новый хвост).
+    Сегмент устоялся, если закончился раньше, чем за STREAM_OVERLAP секунд до конца буфера:
+    последние слова Whisper ещё может переиграть, когда придёт продолжение.
+    segments=None - буфер ещё не распознавали (слишком короткий), FAILED - распознавание упало,
+    звук окна выбрасывается без текста.
+    """
+    if segments is None:
+        return [], buffer
+    if segments is FAILED:
+        state["tail_start"] += len(buffer) / SAMPLE_RATE
+        return [], buffer[:0]
+
+    config = settings.TRANSCRIPTION
+    overlap = config['STREAM_OVERLAP']
+    max_window = config['STREAM_MAX_WINDOW']
+    duration = len(buffer) / SAMPLE_RATE
+    segments = [s for s in segments if s["text"]]
+
+    if final:
+        stable, cut = segments, duration
+    else:
+        stable = [s for s in segments if s["end"] <= duration - overlap]
+        if not stable and duration > max_window:
+            # Один длинный сегмент на всё окно: ждать дальше - значит распознавать его снова и снова
+            stable = segments[:1]
+        if stable:
+            cut = stable[-1]["end"]
+        elif duration > max_window:
+            # Тишина: выкидываем всё, кроме перекрытия
+            cut = duration - overlap
+        else:
+            cut = 0.0
+
+    lines = [f"[{_format_ts(state['tail_start'] + s['start'])}] {s['text']}" for s in stable]
+    if stable:
+        state["prompt"] = " ".join(s["text"] for s in stable)[-200:]
+    state["tail_start"] += cut
+    return lines, buffer[int(cut * SAMPLE_RATE):]
+
+
+class StreamWindow:
+    """
+    Очередной кусок потоковой сессии, готовый к распознаванию. Окно владеет своим seq:
+    замок сессии на время распознавания отпущен, а следующие куски, пока окно не закрыто,
+    откладываются (next_seq в состоянии сессии всё ещё указывает на это окно).
+    """
+
+    def __init__(self, job, state, buffer):
+        self.job = job
+        self.session_id = job["session_id"]
+        self.state = state
+        self.buffer = buffer
+        self.final = str(job.get("final")) == "1"
+
+    @property
+    def duration(self):
+        return len(self.buffer) / SAMPLE_RATE
+
+    @property
+    def needs_decode(self):
+        return _needs_decode(self.buffer, self.final)
+
+
+def _session_lock(session_id):
+    # Держится только на чтение и запись файлов сессии, не на время распознавания
+    return FileLock(session_path(session_id, "lock"), timeout=60)
+
+
+def open_window(job, audio, decode):
+    """
+    Готовит буфер куска. None - кусок пришёл раньше своей очереди и отложен.
+    """
+    session_id = job["session_id"]
+    if not os.path.exists(session_path(session_id)):
+        raise Exception("Session file does not exist")
+
+    with _session_lock(session_id):
+        state = _load_state(session_id)
+        if int(job["seq"]) != state["next_seq"]:
+            _stash(session_id, job, audio)
+            return None
+        buffer = _append(state, _load_tail(session_id), job, audio, decode)
+    return StreamWindow(job, state, buffer)
+
+
+def close_window(model, window, segments, decode):
+    """
+    Коммитит результат распознавания окна (segments=FAILED - пустым) и дожёвывает
+    отложенные следующие куски. Возвращает закоммиченный текст.
+    """
+    session_id = window.session_id
+    state = window.state
+    buffer, final = window.buffer, window.final
+    committed = []
+    while True:
+        lines, tail = _commit(state, buffer, segments, final)
+        committed.extend(lines)
+        with _session_lock(session_id):
+            state["next_seq"] += 1
+            if lines:
+                with open(session_path(session_id), "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+            _save_tail(session_id, tail)
+            _save_state(session_id, state)
+            # Следующий кусок уже ждёт - он теперь наш, его seq никто другой не возьмёт
+            item = _unstash(session_id, state["next_seq"])
+            if item is None:
+                return "\n".join(committed)
+            job, audio = item
+            buffer = _append(state, tail, job, audio, decode)
+        final = str(job.get("final")) == "1"
+        segments = _transcribe(model, state, buffer, final)
+
+
+def process_stream_job(model, job, audio, decode):
+    """
+    Потоковый режим: каждый кусок - продолжение записи, распознаётся только новый звук
+    плюс небольшой хвост. Куски одной сессии обрабатываются строго по seq, даже если
+    их разобрали разные воркеры. decode(bytes) -> float32 16 кГц.
+    Возвращает текст, который закоммитили этим вызовом.
+    """
+    window = open_window(job, audio, decode)
+    if window is None:
+        return ""
+    segments = _transcribe(model, window.state, window.buffer, window.final)
+    return close_window(model, window, segments, decode)
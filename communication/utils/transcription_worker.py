@@ -0,0 +1,180 @@
+import os
+import time
+
+from django.conf import settings
+from filelock import FileLock
+
+from .audio import decode_audio
+from .transcription_queue import session_path
+from .transcription_stream import FAILED, close_window, open_window, process_stream_job
+
+# Дальше 30 секунд энкодер Whisper не смотрит, длинные окна идут через обычный transcribe()
+BATCH_MAX_WINDOW = 30
+
+
+def transcribe_full(model, job, audio):
+    """
+    Старый режим: клиент присылает всю запись целиком, текст сессии перезаписывается.
+    """
+    result = model.transcribe(decode_audio(audio))
+    text = result.get("text", "")
+    print(f"📥 Сессия {job['session_id']}, транскрибированный текст: {text}")
+
+    path_txt = session_path(job["session_id"])
+    if not os.path.exists(path_txt):
+        raise Exception("Session file does not exist")
+
+    version = int(job.get("version", 0))
+    path_version = session_path(job["session_id"], "version")
+    with FileLock(session_path(job["session_id"], "lock"), timeout=5):
+        # Более старый кусок мог распознаваться дольше нового - его текст уже устарел
+        if os.path.exists(path_version):
+            with open(path_version, "r", encoding="utf-8") as f:
+                if int(f.read() or -1) > version:
+                    return text.strip()
+        with open(path_txt, "w", encoding="utf-8") as f:
+            f.write(text.strip() + "\n")
+        with open(path_version, "w", encoding="utf-8") as f:
+            f.write(str(version))
+    return text.strip()
+
+
+def _done(job, text):
+    return {**job, "status": "done", "text": text, "error": ""}
+
+
+def _failed(job, error):
+    print(f"[transcription] Задача {job['id']} упала: {error}")
+    return {**job, "status": "failed", "text": "", "error": str(error)}
+
+
+def process_job(model, job, audio):
+    try:
+        if job.get("mode") == "stream":
+            text = process_stream_job(model, job, audio, decode_audio)
+        else:
+            text = transcribe_full(model, job, audio)
+        return _done(job, text)
+    except Exception as e:
+        return _failed(job, e)
+
+
+def take_batch(source, size, max_delay):
+    """
+    Ждёт первую задачу, потом добирает ещё до size штук, но не дольше max_delay секунд.
+    """
+    first = source.take(timeout=1)
+    if first is None:
+        return []
+    batch = [first]
+    deadline = time.monotonic() + max_delay
+    while len(batch) < size:
+        remaining = deadline - time.monotonic()
+        # BLPOP с нулевым таймаутом висит вечно
+        if remaining < 0.01:
+            break
+        item = source.take(timeout=remaining)
+        if item is not None:
+            batch.append(item)
+    return batch
+
+
+def process_batch(model, batch):
+    """
+    Окна потоковых сессий распознаются одним батчем (по одному окну на сессию),
+    остальное - по одной задаче, как раньше. Возвращает задачи с итоговым статусом.
+    """
+    results = []
+    windows = []
+    singles = []
+    sessions = set()
+    for job, audio in batch:
+        if job.get("mode") != "stream" or job["session_id"] in sessions:
+            # Следующий кусок той же сессии ждёт, пока закоммитится предыдущий
+            singles.append((job, audio))
+            continue
+        sessions.add(job["session_id"])
+        try:
+            window = open_window(job, audio, decode_audio)
+        except Exception as e:
+            results.append(_failed(job, e))
+            continue
+        if window is None:
+            results.append(_done(job, ""))
+        else:
+            windows.append(window)
+
+    batched = [w for w in windows if w.needs_decode and w.duration <= BATCH_MAX_WINDOW]
+    segments = {}
+    if len(batched) > 1:
+        try:
+            outputs = model.transcribe_batch([w.buffer for w in batched])
+            segments = {id(w): out["segments"] for w, out in zip(batched, outputs)}
+        except Exception as e:
+            print(f"[transcription] Батч из {len(batched)} окон упал, распознаём по одному: {e}")
+
+    for window in windows:
+        error = None
+        try:
+            if id(window) in segments:
+                window_segments = segments[id(window)]
+            elif window.needs_decode:
+                window_segments = model.transcribe(window.buffer, initial_prompt=window.state["prompt"] or None)["segments"]
+            else:
+                window_segments = None
+        except Exception as e:
+            # Окно всё равно закрываем (пустым): иначе его seq не закроется и следующие куски сессии встанут
+            error = e
+            window_segments = FAILED
+        try:
+            text = close_window(model, window, window_segments, decode_audio)
+            results.append(_failed(window.job, error) if error else _done(window.job, text))
+        except Exception as e:
+            results.append(_failed(window.job, e))
+
+    for job, audio in singles:
+        results.append(process_job(model, job, audio))
+    return results
+
+
+def run_worker(source, stop=None):
+    """
+    Основной цикл воркера: модель грузится один раз на процесс, задачи берутся из source
+    пачками (TRANSCRIPTION['BATCH_SIZE'] / ['BATCH_MAX_DELAY']).
+    source - RedisTranscriptionQueue или LocalWorkerSource.
+    """
+    from communication.models import WhisperModel
+
+    config = settings.TRANSCRIPTION
+    model = WhisperModel()
+    print(f"[transcription] Воркер {os.getpid()} готов")
+    while stop is None or not stop.is_set():
+        batch = take_batch(source, config['BATCH_SIZE'], config['BATCH_MAX_DELAY'])
+        if not batch:
+            continue
+        for job in process_batch(model, batch):
+            source.report(job)
+
+
+def run_local_worker(jobs, results):
+    # Точка входа процесса локального пула (spawn): Django в нём ещё не поднят
+    import django
+    django.setup()
+
+    from .transcription_queue import LocalWorkerSource
+
+    run_worker(LocalWorkerSource(jobs, results))
+
+
+def run_redis_worker():
+    # Точка входа процессов `manage.py transcription_worker`
+    import django
+    django.setup()
+
+    import redis
+    from django.conf import settings
+    from .transcription_queue import RedisTranscriptionQueue
+
+    # Свой клиент без socket_timeout: BLPOP висит дольше секунды
+    client = redis.Redis.from_url(settings.REDIS_URL)
+    run_worker(RedisTranscriptionQueue(client))
@@ -0,0 +1,61 @@
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from .minio_client import MinioStreamWriter, build_object_path
+
+
+class MinioUploadedFile(UploadedFile):
+    """
+    Файл, который уже лежит в MinIO: вместо содержимого у него путь объекта.
+    """
+
+    def __init__(self, path, name, content_type, size, charset=None, content_type_extra=None):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.path = path
+
+
+class MinioUploadHandler(FileUploadHandler):
+    """
+    Upload handler, который сразу льёт тело запроса в MinIO multipart.
+
+    Обычные обработчики Django сначала складывают большой файл во временный файл,
+    а потом мы читаем его ещё раз для put_object. Здесь каждый кусок запроса
+    уходит в MinioStreamWriter, так что память постоянная и копия одна.
+    Ставится на запрос до первого обращения к request.FILES.
+    """
+
+    def __init__(self, request=None, file_type='user_upload'):
+        super().__init__(request)
+        self.file_type = file_type
+        self.writer = None
+        self.path = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.path, _ = build_object_path(self.file_name, self.file_type)
+        self.writer = MinioStreamWriter(self.path, content_type=self.content_type)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.writer.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.writer.close()
+        file = MinioUploadedFile(
+            self.path,
+            self.file_name,
+            self.content_type,
+            file_size,
+            self.charset,
+            self.content_type_extra,
+        )
+        self.writer = None
+        return file
+
+    def upload_interrupted(self):
+        self.abort()
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
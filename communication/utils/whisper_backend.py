@@ -0,0 +1,128 @@
+import time
+
+import numpy as np
+import torch
+import whisper
+from django.conf import settings
+
+from .audio import SAMPLE_RATE
+
+
+def _to_result(result):
+    return {
+        "text": result.get("text", "").strip(),
+        "segments": [
+            {"start": s["start"], "end": s["end"], "text": s["text"].strip()}
+            for s in result.get("segments", [])
+        ],
+    }
+
+
+class TorchWhisperBackend:
+    """
+    Обычный openai-whisper на PyTorch, fp32 на CPU.
+    """
+
+    name = "torch"
+
+    def __init__(self, model_size):
+        self.model_size = model_size
+        self.model = whisper.load_model(model_size, device="cpu")
+
+    def transcribe(self, audio, **options):
+        """
+        audio - путь к файлу или float32-массив 16 кГц.
+        Кроме текста отдаёт сегменты с таймкодами в секундах от начала audio.
+        """
+        options.setdefault("fp16", False)
+        return _to_result(self.model.transcribe(audio, **options))
+
+    def transcribe_batch(self, audios):
+        """
+        Распознаёт несколько окон не длиннее 30 секунд за один проход энкодера и декодера.
+        audios - список float32-массивов 16 кГц. Возвращает список того же вида, что transcribe().
+        """
+        mel = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(a)), n_mels=self.model.dims.n_mels)
+            for a in audios
+        ]).to(self.model.device)
+        # Язык определяется для каждого окна отдельно, prompt в батче не поддерживается
+        options = whisper.DecodingOptions(fp16=False, without_timestamps=False)
+        with torch.no_grad():
+            results = whisper.decode(self.model, mel, options)
+
+        tokenizer = whisper.tokenizer.get_tokenizer(
+            self.model.is_multilingual, num_languages=self.model.num_languages, task="transcribe"
+        )
+        return [
+            {"text": r.text.strip(), "segments": self._parse_segments(tokenizer, r.tokens, len(a) / SAMPLE_RATE)}
+            for r, a in zip(results, audios)
+        ]
+
+    @staticmethod
+    def _parse_segments(tokenizer, tokens, duration):
+        # Токены вида <|0.00|> текст <|2.40|><|2.40|> текст <|5.00|>, шаг таймкода 20 мс
+        segments = []
+        start = None
+        text_tokens = []
+        for token in tokens:
+            if token < tokenizer.timestamp_begin:
+                text_tokens.append(token)
+                continue
+            ts = (token - tokenizer.timestamp_begin) * 0.02
+            if start is not None and text_tokens:
+                segments.append({"start": start, "end": ts, "text": tokenizer.decode(text_tokens).strip()})
+                start, text_tokens = None, []
+            else:
+                start = ts
+        if text_tokens:
+            # Декодер оборвал последний сегмент без закрывающего таймкода
+            segments.append({"start": start or 0.0, "end": duration, "text": tokenizer.decode(text_tokens).strip()})
+        return segments
+
+
+class Int8WhisperBackend(TorchWhisperBackend):
+    """
+    Тот же whisper, но линейные слои динамически квантованы в int8: заметно меньше CPU
+    и памяти ценой небольшой потери точности. Свёртки и эмбеддинги остаются fp32.
+    """
+
+    name = "torch-int8"
+
+    def __init__(self, model_size):
+        super().__init__(model_size)
+        # whisper.model.Linear - подкласс nn.Linear, а quantize_dynamic сверяет тип точно
+        for module in self.model.modules():
+            if isinstance(module, torch.nn.Linear):
+                module.__class__ = torch.nn.Linear
+        self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+BACKENDS = {
+    TorchWhisperBackend.name: TorchWhisperBackend,
+    Int8WhisperBackend.name: Int8WhisperBackend,
+}
+
+
+def load_backend(name=None, model_size=None, threads=None, warmup=None):
+    """
+    Поднимает бэкенд по настройкам TRANSCRIPTION (аргументы их перекрывают).
+    """
+    config = settings.TRANSCRIPTION
+    name = name or config['BACKEND']
+    model_size = model_size or config['MODEL_SIZE']
+    threads = config['THREADS'] if threads is None else threads
+    warmup = config['WARMUP'] if warmup is None else warmup
+
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown transcription backend: {name}")
+    if threads:
+        torch.set_num_threads(threads)
+
+    started = time.perf_counter()
+    backend = BACKENDS[name](model_size)
+    if warmup:
+        # Первый вызов платит за инициализацию ядер и кэшей, пусть это будет не запрос пользователя
+        backend.transcribe(np.zeros(SAMPLE_RATE, dtype=np.float32))
+    print(f"[WhisperModel] {name}/{model_size} готова за {time.perf_counter() - started:.1f} c, потоков {torch.get_num_threads()}")
+    return backend
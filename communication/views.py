@@ -6,108 +6,95 @@ from rest_framework import status
 from rest_framework.views import APIView
 from django.http import JsonResponse
 from django.db import models
-from .models import Channel, UploadedFile, Notification, Message, WhisperModel
-from .serializers import ChannelSerializer, UserSerializer, NotificationSerializer, MessageSerializer
+from django.conf import settings
+from django.core import signing
+from .models import Channel, UploadedFile, Notification, Message, Stream, Transcript
+from .serializers import ChannelSerializer, UserSerializer, NotificationSerializer, MessageSerializer, StreamSerializer
 from accounts.models import User
 from adminpanel.models import Group
-from .utils.minio_client import save_file_to_minio, client, get_presigned_icon_url
+from .utils.minio_client import (
+    build_object_path, client, get_download_url, get_object_size, get_presigned_icon_url, get_upload_url,
+    save_file_to_minio,
+)
+from .utils.upload_handlers import MinioUploadHandler
+from .utils.notification_inbox import get_cursor, mark_read, unread_count, visible_notifications
 from .utils.notification_sender import notify_group_users
-import tempfile
-import whisper
+from .utils.pagination import keyset_paginate, parse_limit
+from .utils.search import search_messages, search_transcripts
+from .utils import metrics
+from .utils.sequence import get_seq, channel_seq_key
+from .utils.speaking import get_speaking
+from .utils.transcription_queue import (
+    cleanup_session, finish_stream, get_job, is_session_owner, session_path, session_pending, set_session_owner,
+    submit_chunk,
+)
 import uuid
-import threading
 import os
 from io import BytesIO
-import subprocess
-from filelock import FileLock
 
 
 
 
 
-SESS_DIR = os.path.join(os.path.dirname(__file__), "sessions")
-os.makedirs(SESS_DIR, exist_ok=True)
-locks = {}
-
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def start_transcription_session(request):
     session_id = str(uuid.uuid4())
-    print(f"🚀 Начата сессия: {session_id}")
-    path_txt = os.path.join(SESS_DIR, f"{session_id}.txt")
+    path_txt = session_path(session_id)
     open(path_txt, "w", encoding="utf-8").close()
-    locks[session_id] = threading.Lock()
+    set_session_owner(session_id, request.user.id)
     return Response({"session_id": session_id})
 
 
-model = WhisperModel()
-
-
-
-def convert_webm_to_wav(webm_path, wav_path):
-    command = [
-        "ffmpeg", "-y",
-        "-i", webm_path,
-        "-ar", "16000",
-        "-ac", "1",
-        wav_path,
-        
-    ]
-    proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) 
-    if proc.returncode != 0:
-        print(f"FFmpeg error: {proc.stderr.decode('utf-8')}")
-        raise Exception("FFmpeg conversion failed")
-
-
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 @parser_classes([MultiPartParser])
 def upload_transcription(request):
+    """
+    Кладёт кусок записи в очередь распознавания и сразу отвечает 202 с job_id.
+    Результат - через GET transcribe/jobs/<job_id>/ или пушем transcription_result в сокет уведомлений.
+    """
     session_id = request.data.get("session_id")
     audio_file = request.FILES.get("file")
+    mode = request.data.get("mode", "full")  # "stream" - распознавать только новый звук, см. submit_chunk
 
     if not session_id or not audio_file:
         return Response({"error": "Missing session_id or file"}, status=400)
+    if mode not in ("full", "stream"):
+        return Response({"error": "Unknown mode"}, status=400)
 
-    tmp_webm = tempfile.NamedTemporaryFile(delete=False, suffix=".webm")
-    for part in audio_file.chunks():
-        tmp_webm.write(part)
-    tmp_webm.close()
-
-    tmp_wav = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-    tmp_wav.close()
+    if not os.path.exists(session_path(session_id)) or not is_session_owner(session_id, request.user.id):
+        return Response({"error": "Session file does not exist"}, status=404)
 
+    audio = b"".join(audio_file.chunks())
     try:
-        # Конвертация
-        convert_webm_to_wav(tmp_webm.name, tmp_wav.name)
-
-        # Транскрипция всей записи
-        result = model.transcribe(tmp_wav.name)
-        text = result.get("text", "")
-        print(f"📥 Получен файл для сессии {session_id}, транскрибированный текст: {text}")
-
-        # Запись текста в файл
-        path_txt = os.path.join(SESS_DIR, f"{session_id}.txt")
-        lock_path = os.path.join(SESS_DIR, f"{session_id}.lock")
-
-        if not os.path.exists(path_txt):
-            return Response({"error": "Session file does not exist"}, status=404)
-
-        with FileLock(lock_path, timeout=5):
-            with open(path_txt, "w", encoding="utf-8") as f:
-                f.write(text.strip() + "\n")
-
-        return Response({"message": "File processed successfully"}, status=200)
-
+        job = submit_chunk(
+            session_id,
+            request.user.id,
+            audio,
+            mode=mode,
+            cumulative=str(request.data.get("cumulative", "")).lower() in ("1", "true"),
+        )
     except Exception as e:
         return Response({"error": f"Processing failed: {str(e)}"}, status=500)
 
-    finally:
-        for f in (tmp_webm.name, tmp_wav.name):
-            try:
-                os.remove(f)
-            except Exception as cleanup_error:
-                print(f"⚠️ Ошибка при удалении {f}: {cleanup_error}")
+    print(f"📥 Получен файл для сессии {session_id}, задача {job['id']}")
+    return Response({"message": "File queued", "job_id": job["id"], "status": job["status"]}, status=202)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def transcription_job_status(request, job_id):
+    job = get_job(job_id)
+    if not job or job.get("user_id") != str(request.user.id):
+        return Response({"error": "Job not found"}, status=404)
+    return Response({
+        "job_id": job["id"],
+        "session_id": job["session_id"],
+        "status": job["status"],
+        "text": job.get("text", ""),
+        "error": job.get("error", ""),
+    })
 
 
 
@@ -118,10 +105,30 @@ def finish_transcription_session(request):
     if not session_id:
         return Response({"error": "Missing session_id"}, status=400)
 
-    path_txt = os.path.join(SESS_DIR, f"{session_id}.txt")
-    if not os.path.exists(path_txt):
+    path_txt = session_path(session_id)
+    if not os.path.exists(path_txt) or not is_session_owner(session_id, request.user.id):
+        return Response({"error": "Session not found"}, status=404)
+
+    # Транскрипт канала видят в поиске все его участники, поэтому привязать его можно только к своему каналу
+    channel = None
+    channel_id = str(request.data.get("channel_id", ""))
+    if channel_id:
+        channel = Channel.objects.filter(pk=channel_id).first() if channel_id.isdigit() else None
+        if channel is None:
+            return Response({"error": "Channel not found"}, status=404)
+        if request.user.role not in ['преподаватель', 'админ'] and \
+                not channel.participants.filter(pk=request.user.pk).exists():
+            return Response({"error": "Access denied"}, status=status.HTTP_403_FORBIDDEN)
+    if Transcript.objects.filter(session_id=session_id).exclude(user=request.user).exists():
         return Response({"error": "Session not found"}, status=404)
 
+    # Пока куски распознаются, транскрипт не готов. Поток запроса их не ждёт: 202, и клиент повторяет
+    # transcribe/finish после transcription_result последней задачи (сокет уведомлений) или опроса transcribe/jobs/
+    final_job_id = finish_stream(session_id, request.user.id)
+    pending = session_pending(session_id)
+    if pending:
+        return Response({"status": "in_progress", "pending": pending, "job_id": final_job_id}, status=202)
+
     # читаем текстовый файл и превращаем в файлоподобный объект
     with open(path_txt, "r", encoding="utf-8") as f:
         file_content = f.read()
@@ -133,6 +140,7 @@ def finish_transcription_session(request):
     transcript_file.content_type = "text/plain"
 
     try:
+        # Вьюха синхронная: поток запроса всё равно ждёт загрузку, так что зовём MinIO напрямую
         minio_result = save_file_to_minio(
             transcript_file,
             user=request.user,
@@ -141,9 +149,20 @@ def finish_transcription_session(request):
     except Exception as e:
         return Response({"error": f"MinIO upload failed: {str(e)}"}, status=500)
 
+    # Копия текста для поиска (utils/search.py); channel - если это запись лекции в канале
+    Transcript.objects.update_or_create(
+        session_id=session_id,
+        user=request.user,
+        defaults={
+            'channel': channel,
+            'file_name': minio_result["file_name"],
+            'path': minio_result["path"],
+            'text': file_content,
+        },
+    )
+
     # очищаем сессию
-    os.remove(path_txt)
-    locks.pop(session_id, None)
+    cleanup_session(session_id)
 
     return Response({"url": minio_result["url"]})
 
@@ -157,21 +176,48 @@ def get_all_channels(request):
     else:
         # Для студентов: фильтруем каналы по разрешённым группам
         channels = Channel.objects.filter(groups_allowed=user.group)
+    # ChannelSerializer лезет в participants/groups_allowed/created_by - тянем всё заранее, а не на каждый канал
+    channels = channels.select_related('created_by').prefetch_related('participants', 'groups_allowed')
     serializer = ChannelSerializer(channels, many=True)
     return Response(serializer.data)
 
 
+def _paginate_channel_messages(channel, params):
+    """
+    Окно истории канала по курсорам before/after/around (см. utils/pagination.py).
+    Бросает ValueError на кривых параметрах.
+    """
+    history = settings.CHAT_HISTORY
+    limit = parse_limit(params.get("limit"), history['PAGE_SIZE'], history['MAX_PAGE_SIZE'])
+    page = keyset_paginate(
+        Message.objects.filter(channel=channel).select_related('sender', 'uploaded_file'),
+        "timestamp",
+        limit,
+        before=params.get("before"),
+        after=params.get("after"),
+        around=params.get("around"),
+    )
+    page["items"] = MessageSerializer(page["items"], many=True).data
+    return page
+
+
 def get_channel_details(request, channel_id):
     try:
         channel = Channel.objects.get(id=channel_id)
         participants = channel.participants.all().values("username", "name")  # получаем участников канала
-        messages = Message.objects.filter(channel=channel)
-        message_serializer = MessageSerializer(messages, many=True)
+        try:
+            page = _paginate_channel_messages(channel, request.GET)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
         return JsonResponse({
             "id": channel.id,
             "name": channel.name,
             "participants": list(participants),
-            "messages": message_serializer.data
+            "messages": page["items"],  # только последнее окно, остальное - через /messages/?before=
+            "messages_before": page["before"],
+            "messages_after": page["after"],
+            "has_more_before": page["has_more_before"],
+            "has_more_after": page["has_more_after"],
         })
     except Channel.DoesNotExist:
         return JsonResponse({"error": "Канал не найден или не существует"}, status=404)    
@@ -230,28 +276,107 @@ def create_channel(request):
 @permission_classes([IsAuthenticated])
 @parser_classes([MultiPartParser])
 def upload_file(request):
-    file = request.FILES.get('file')
+    # Файл льётся в MinIO прямо во время разбора multipart, без временного файла на диске
+    handler = MinioUploadHandler(request)
+    request.upload_handlers = [handler]
+    try:
+        file = request.FILES.get('file')
+    except Exception:
+        handler.abort()
+        raise
     if not file:
         return Response({'error': 'No file provided'}, status=400)
 
-    minio_result = save_file_to_minio(file, user=request.user)
-
     uploaded = UploadedFile.objects.create(
         user=request.user,
         file_name=file.name,
         file_type='user_upload',
-        path=minio_result['path']
+        path=file.path
     )
 
     return Response({
+        'id': uploaded.id,
         'status': 'uploaded',
         'file_name': file.name,
-        'path': minio_result['path'],
-        'url': minio_result['url'],  # временная ссылка (presigned)
+        'path': file.path,
+        'url': get_download_url(file.path, file.name),  # временная ссылка (presigned)
         'is_image': file.name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp'))
     }, status=201)
 
 
+UPLOAD_TOKEN_SALT = 'communication.direct-upload'
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def request_upload_url(request):
+    """
+    Шаг 1 прямой загрузки: выдаём presigned PUT и подписанный токен с путём объекта.
+    Байты файла идут из браузера прямо в MinIO, Django их не видит.
+    """
+    file_name = request.data.get('file_name')
+    if not file_name:
+        return Response({'error': 'Missing file_name'}, status=400)
+
+    path, _ = build_object_path(file_name, 'user_upload')
+    expires_in = settings.MINIO_STORAGE['UPLOAD_URL_EXPIRES']
+    try:
+        upload_url = get_upload_url(path)
+    except Exception as e:
+        return Response({'error': f'MinIO presign failed: {str(e)}'}, status=500)
+
+    token = signing.dumps({'path': path, 'file_name': file_name, 'user': request.user.id}, salt=UPLOAD_TOKEN_SALT)
+    return Response({
+        'upload_url': upload_url,  # сюда PUT-ом сам файл
+        'path': path,
+        'upload_token': token,     # его потом в /upload/confirm/
+        'expires_in': expires_in,
+    }, status=201)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def confirm_upload(request):
+    """
+    Шаг 2 прямой загрузки: проверяем, что объект реально появился в MinIO, и заводим UploadedFile.
+    Повторный confirm с тем же токеном вернёт ту же запись.
+    """
+    token = request.data.get('upload_token')
+    if not token:
+        return Response({'error': 'Missing upload_token'}, status=400)
+
+    try:
+        # Токен живёт чуть дольше ссылки: загрузка могла начаться в последний момент
+        payload = signing.loads(token, salt=UPLOAD_TOKEN_SALT, max_age=settings.MINIO_STORAGE['UPLOAD_URL_EXPIRES'] * 2)
+    except signing.BadSignature:
+        return Response({'error': 'Invalid or expired upload_token'}, status=400)
+    if payload['user'] != request.user.id:
+        return Response({'error': 'Forbidden'}, status=403)
+
+    try:
+        size = get_object_size(payload['path'])
+    except Exception as e:
+        return Response({'error': f'MinIO check failed: {str(e)}'}, status=500)
+    if size is None:
+        return Response({'error': 'File was not uploaded'}, status=400)
+
+    uploaded, _ = UploadedFile.objects.get_or_create(
+        user=request.user,
+        path=payload['path'],
+        defaults={'file_name': payload['file_name'], 'file_type': 'user_upload'},
+    )
+
+    return Response({
+        'id': uploaded.id,
+        'status': 'uploaded',
+        'file_name': uploaded.file_name,
+        'path': uploaded.path,
+        'size': size,
+        'url': get_download_url(uploaded.path, uploaded.file_name),
+        'is_image': uploaded.file_name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp'))
+    }, status=201)
+
+
 
 
 @api_view(["POST"])
@@ -273,19 +398,96 @@ class NotificationsView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
+        """
+        Страница уведомлений по курсорам before/after (как история чата), новые сверху,
+        плюс число непрочитанных.
+        """
         user = request.user
+        config = settings.NOTIFICATIONS
+
+        try:
+            limit = parse_limit(request.query_params.get("limit"), config['PAGE_SIZE'], config['MAX_PAGE_SIZE'])
+            page = keyset_paginate(
+                visible_notifications(user),
+                "created_at",
+                limit,
+                before=request.query_params.get("before"),
+                after=request.query_params.get("after"),
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+
+        cursor = get_cursor(user)
+        serializer = NotificationSerializer(page["items"][::-1], many=True, context={'read_cursor': cursor})
+        return Response({
+            "results": serializer.data,
+            "before": page["before"],
+            "after": page["after"],
+            "has_more_before": page["has_more_before"],
+            "has_more_after": page["has_more_after"],
+            "unread": unread_count(user, cursor),
+        })
 
-        if user.role == "студент":
-            notifications = Notification.objects.filter(
-                models.Q(group__isnull=True) | models.Q(group=user.group)
-            ).order_by('-created_at')
-        else:
-            notifications = Notification.objects.all().order_by('-created_at')
 
-        serializer = NotificationSerializer(notifications, many=True)
-        return Response(serializer.data)
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def mark_notifications_read(request):
+    """
+    {"id": N} - прочитано всё до уведомления N включительно, без id - всё, что есть.
+    """
+    user = request.user
+    notifications = visible_notifications(user)
+    if request.data.get("id") is not None:
+        try:
+            notification = notifications.get(pk=request.data["id"])
+        except (Notification.DoesNotExist, ValueError, TypeError):
+            return Response({"error": "Notification not found"}, status=404)
+    else:
+        notification = notifications.order_by('-created_at', '-id').first()
+        if notification is None:
+            return Response({"unread": 0})
+
+    cursor = mark_read(user, notification)
+    return Response({"unread": unread_count(user, cursor)})
     
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search(request):
+    """
+    Полнотекстовый поиск: ?q=...&type=messages|transcripts&channel=<id>&limit=&offset=
+    Результаты по убыванию релевантности, с подсветкой совпадений (<mark>).
+    """
+    params = request.query_params
+    text = params.get("q", "").strip()
+    if not text:
+        return Response({"error": "Missing q"}, status=400)
+    kind = params.get("type", "messages")
+    if kind not in ("messages", "transcripts"):
+        return Response({"error": "Unknown type"}, status=400)
+
+    config = settings.SEARCH
+    try:
+        limit = parse_limit(params.get("limit"), config['PAGE_SIZE'], config['MAX_PAGE_SIZE'])
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+    offset = params.get("offset") or "0"
+    if not offset.isdigit() or int(offset) > config['MAX_OFFSET']:
+        return Response({"error": "Invalid offset"}, status=400)
+    channel = params.get("channel") or ""
+    if channel and not channel.isdigit():
+        return Response({"error": "Invalid channel"}, status=400)
+    offset = int(offset)
+    channel_id = int(channel) if channel else None
+
+    search_in = search_messages if kind == "messages" else search_transcripts
+    results, has_more = search_in(request.user, text, limit, offset, channel_id)
+    return Response({
+        "results": results,
+        "next_offset": offset + limit if has_more else None,
+    })
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def channel_messages(request, channel_id):
@@ -294,9 +496,44 @@ def channel_messages(request, channel_id):
     except Channel.DoesNotExist:
         return Response({"error": "Channel not found"}, status=404)
 
-    messages = Message.objects.filter(channel=channel).order_by('timestamp')
-    serializer = MessageSerializer(messages, many=True)
-    return Response(serializer.data)
+    try:
+        page = _paginate_channel_messages(channel, request.query_params)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+
+    return Response({
+        "results": page["items"],
+        "before": page["before"],
+        "after": page["after"],
+        "has_more_before": page["has_more_before"],
+        "has_more_after": page["has_more_after"],
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def channel_streams(request, channel_id):
+    """
+    Снимок состояния потоков канала для ресинхронизации: клиент применяет stream_delta с seq больше этого.
+    """
+    if not Channel.objects.filter(pk=channel_id).exists():
+        return Response({"error": "Channel not found"}, status=404)
+
+    seq = get_seq(channel_seq_key(channel_id))
+    streams = Stream.objects.filter(channel_id=channel_id).select_related('user')
+    context = {'speaking': get_speaking(channel_id)}
+    return Response({"seq": seq, "streams": StreamSerializer(streams, many=True, context=context).data})
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def realtime_metrics(request):
+    """
+    Счётчики real-time части (speaking_received/emitted и т.п.): этого процесса и сумма по всем из Redis.
+    """
+    if request.user.role != 'админ':
+        return Response({"detail": "Недостаточно прав."}, status=status.HTTP_403_FORBIDDEN)
+    return Response(metrics.snapshot())
 
 
 def list_minio_icons(request):
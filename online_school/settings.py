@@ -190,6 +190,101 @@ MINIO_STORAGE = {
     'SECRET_KEY': '12344321',
     'BUCKET_NAME': 'online-school',
     'SECURE': False,  # заменить на True при проде HTTPS
+    'MAX_WORKERS': 8,  # сколько одновременных запросов к MinIO на процесс
+    'PART_SIZE': 8 * 1024 * 1024,  # размер части multipart при потоковой загрузке (минимум 5 МБ)
+    'STREAM_QUEUE_CHUNKS': 32,  # сколько кусков по 64 КБ ждут отправки, дальше загрузка притормаживает клиента
+    'STREAM_IDLE_TIMEOUT': 60,  # секунд без данных, после которых загрузка считается оборванной
+    'STREAM_MAX_WORKERS': 16,  # сколько потоковых загрузок одновременно, у них свой пул потоков
+    'STREAM_START_TIMEOUT': 10,  # секунд ждать свободного места в этом пуле, потом загрузка отклоняется
+    'STREAM_TOTAL_TIMEOUT': 60 * 60,  # потолок длительности одной потоковой загрузки, секунд
+    'UPLOAD_URL_EXPIRES': 15 * 60,  # сколько секунд живёт presigned PUT для прямой загрузки из браузера
+}
+
+# Общий Redis для кэшей и очередей приложения (не путать с channel layer). None - только память процесса
+REDIS_URL = 'redis://127.0.0.1:6379/1'
+
+PRESIGNED_URL_CACHE = {
+    'PERIOD': 6 * 60 * 60,  # раз в сколько секунд переподписывать ссылку (у неё остаётся >= expires - PERIOD)
+    'MAX_ENTRIES': 10000,   # сколько ссылок держать в памяти процесса
+}
+
+TRANSCRIPTION = {
+    'BACKEND': 'torch',      # 'torch' - whisper fp32, 'torch-int8' - линейные слои квантованы в int8 (быстрее на CPU)
+    'MODEL_SIZE': 'base',    # tiny / base / small / medium / large-v3 ...
+    'THREADS': 0,            # потоков PyTorch на процесс распознавания, 0 - по умолчанию torch
+    'WARMUP': True,          # прогнать секунду тишины сразу после загрузки модели
+    'QUEUE': 'local',        # 'local' - пул процессов рядом с веб-процессом, 'redis' - отдельный `manage.py transcription_worker`
+    'WORKERS': 2,            # процессов распознавания (в каждом своя копия модели)
+    'JOB_TTL': 24 * 60 * 60, # сколько хранить задачи и их результаты
+    'JOB_LEASE': 10 * 60,    # задача без результата дольше этого (воркер умер) перестаёт держать transcribe/finish
+    'LOCAL_MAX_RESULTS': 1000, # локальная очередь: сколько законченных задач помнить в памяти веб-процесса
+    'STREAM_OVERLAP': 1.0,   # потоковый режим: последние N секунд не коммитятся до следующего куска
+    'STREAM_MAX_WINDOW': 30, # потоковый режим: хвост длиннее этого коммитится принудительно
+    'BATCH_SIZE': 8,         # сколько окон разных сессий воркер распознаёт за один проход модели
+    'BATCH_MAX_DELAY': 0.2,  # сколько секунд воркер добирает батч после первой задачи (потолок задержки)
+}
+
+PRESENCE = {
+    'TTL': 60,        # через сколько секунд без heartbeat соединение считается мёртвым
+    'HEARTBEAT': 20,  # как часто consumer продлевает своё соединение
+}
+
+SPEAKING = {
+    'TICK_HZ': 10,    # сколько раз в секунду рассылать изменения is_speaking по каналу
+}
+
+SFU = {
+    'ENABLED': False,              # медиа через сервер (aiortc) вместо P2P-сетки; все сокеты канала - в одном процессе
+    'ICE_SERVERS': [{'urls': 'stun:stun.l.google.com:19302'}],
+    'LOW_LAYER_SCALE': 0.5,        # нижний слой видео: доля разрешения
+    'LOW_LAYER_FPS_DIVISOR': 2,    # нижний слой видео: каждый N-й кадр
+    'MAX_SUBSCRIPTIONS': 20,       # подписок на комнату: на каждую сервер держит свой кодер видео
+}
+
+AUDIO_LEVELS = {
+    'ENABLED': True,         # в SFU-режиме is_speaking считает сервер по звуку, клиентский игнорируется
+    'WINDOW': 0.1,           # окно RMS, секунд
+    'THRESHOLD_DB': -45,     # громче - говорит (dBFS)
+    'HANGOVER': 5,           # сколько тихих окон подряд, прежде чем "замолчал"
+    'RATE': 5,               # ранжирование говорящих, раз в секунду
+    'TOP': 3,                # сколько говорящих в active_speakers
+}
+
+RECORDING = {
+    'QUEUE_FRAMES': 256,        # кадров в очереди к кодеру; если он не успевает, лишние кадры теряются
+    'PRESET': 'veryfast',       # пресет libx264
+    'KEYFRAME_INTERVAL': 60,    # ключевой кадр (и фрагмент MP4) каждые N кадров
+    'MAX_DURATION': 6 * 60 * 60, # потолок длительности одной записи, секунд; дальше загрузка обрывается
+}
+
+NOTIFICATIONS = {
+    'PAGE_SIZE': 20,        # уведомлений на страницу списка
+    'MAX_PAGE_SIZE': 100,   # потолок для ?limit=
+    'REPLAY_LIMIT': 50,     # сколько пропущенных досылать по сокету при подключении, остальное - через список
+}
+
+CHAT_BUFFER = {
+    'FLUSH_INTERVAL': 0.5,  # раз в сколько секунд накопленные сообщения пишутся в БД
+    'BATCH_SIZE': 500,      # сообщений на один bulk_create
+    'ID_BLOCK': 100,        # сколько id сообщений резервировать из последовательности за раз
+    'CLAIM_IDLE': 30,       # через сколько секунд незаписанное сообщение умершего процесса забирает другой
+}
+
+CHANNEL_EVENTS = {
+    'RING_SIZE': 1000,      # сколько последних событий канала (сообщения, stream_delta, speaking_update) держать для повтора
+    'TTL': 60 * 60,         # сколько живёт кольцо неактивного канала в Redis
+    'REPLAY_LIMIT': 500,    # больше пропущенных сообщений из БД не досылаем - resync_required
+}
+
+SEARCH = {
+    'PAGE_SIZE': 20,        # результатов поиска на страницу
+    'MAX_PAGE_SIZE': 50,    # потолок для ?limit=
+    'MAX_OFFSET': 1000,     # дальше листать поиск смысла нет - уточняйте запрос
+}
+
+CHAT_HISTORY = {
+    'PAGE_SIZE': 50,        # сколько сообщений отдавать по умолчанию
+    'MAX_PAGE_SIZE': 200,   # потолок для ?limit=
 }
 
 